@@ -17,7 +17,28 @@ CONTROLLER_HEART_BEAT_EXPIRATION = int(
 )
 WORKER_HEART_BEAT_INTERVAL = int(os.getenv("FASTCHAT_WORKER_HEART_BEAT_INTERVAL", 30))
 WORKER_API_TIMEOUT = int(os.getenv("FASTCHAT_WORKER_API_TIMEOUT", 100))
-WORKER_API_EMBEDDING_BATCH_SIZE = int(os.getenv("WORKER_API_EMBEDDING_BATCH_SIZE", 4))
+# The texts of /v1/embeddings are sent to the workers in batches of at most
+# this many estimated tokens and texts, and this many batches at a time.
+WORKER_API_EMBEDDING_BATCH_TOKENS = int(
+    os.getenv("FASTCHAT_WORKER_API_EMBEDDING_BATCH_TOKENS", 4096)
+)
+WORKER_API_EMBEDDING_BATCH_SIZE = int(os.getenv("WORKER_API_EMBEDDING_BATCH_SIZE", 256))
+WORKER_API_EMBEDDING_MAX_INFLIGHT = int(
+    os.getenv("FASTCHAT_WORKER_API_EMBEDDING_MAX_INFLIGHT", 8)
+)
+# The longest time the controller holds a long poll of the routing table
+ROUTING_TABLE_POLL_TIMEOUT = int(os.getenv("FASTCHAT_ROUTING_TABLE_POLL_TIMEOUT", 30))
+# The connection pool shared by all HTTP requests of a process
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("FASTCHAT_HTTP_POOL_MAX_CONNECTIONS", 1000))
+HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("FASTCHAT_HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS", 100)
+)
+HTTP_POOL_KEEPALIVE_EXPIRY = int(os.getenv("FASTCHAT_HTTP_POOL_KEEPALIVE_EXPIRY", 60))
+
+# For compressed (--load-8bit) models. One of auto (tiled), tiled, int8, decompress.
+COMPRESSION_BACKEND = os.getenv("FASTCHAT_COMPRESSION_BACKEND", "auto")
+# The checkpoint shards read in parallel when loading a model
+MODEL_LOAD_NUM_THREADS = int(os.getenv("FASTCHAT_MODEL_LOAD_NUM_THREADS", 4))
 
 
 class ErrorCode(IntEnum):
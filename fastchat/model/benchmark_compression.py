@@ -0,0 +1,93 @@
+"""
+Benchmark the backends of the compressed linear layer used by --load-8bit.
+
+Usage:
+python3 -m fastchat.model.benchmark_compression --shapes 4096x4096 11008x4096 --num-tokens 1 16 128
+"""
+import argparse
+import time
+
+import torch
+
+from fastchat.model.compression import (
+    COMPRESSION_BACKENDS,
+    CLinear,
+    default_compression_config,
+    get_compression_backend,
+)
+
+
+def benchmark_compression(shapes, num_tokens, backends, device, dtype, num_iters):
+    print(
+        f"{'shape':>12} {'tokens':>6} {'backend':>10} {'ms':>9} {'speedup':>8} "
+        f"{'rel err':>8}"
+    )
+    for out_features, in_features in shapes:
+        weight = torch.randn(out_features, in_features, dtype=dtype, device=device)
+        weight *= in_features**-0.5
+        layers = {
+            backend: CLinear(weight, None, device, backend) for backend in backends
+        }
+        for n in num_tokens:
+            x = torch.randn(n, in_features, dtype=dtype, device=device)
+            expected = x @ weight.t()
+            baseline = None
+            for backend, layer in layers.items():
+                with torch.inference_mode():
+                    output = layer(x)
+                    if device == "cuda":
+                        torch.cuda.synchronize()
+                    tic = time.perf_counter()
+                    for _ in range(num_iters):
+                        layer(x)
+                    if device == "cuda":
+                        torch.cuda.synchronize()
+                elapsed = (time.perf_counter() - tic) / num_iters * 1e3
+                baseline = baseline or elapsed
+                error = (output.float() - expected.float()).norm() / (
+                    expected.float().norm()
+                )
+                name = get_compression_backend(
+                    backend, layer.weight, default_compression_config
+                )
+                print(
+                    f"{out_features:>5}x{in_features:<6} {n:>6} {name:>10} "
+                    f"{elapsed:>9.2f} {baseline / elapsed:>7.2f}x {error:>8.4f}"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--shapes",
+        type=str,
+        nargs="+",
+        default=["4096x4096", "11008x4096", "4096x11008"],
+        help="The weight shapes as out_features x in_features",
+    )
+    parser.add_argument("--num-tokens", type=int, nargs="+", default=[1, 16, 128])
+    parser.add_argument(
+        "--backends",
+        type=str,
+        nargs="+",
+        default=["decompress", "tiled", "int8"],
+        choices=COMPRESSION_BACKENDS,
+        help="The first backend is the baseline of the speedup",
+    )
+    parser.add_argument(
+        "--device", type=str, choices=["cpu", "cuda", "mps"], default="cpu"
+    )
+    parser.add_argument(
+        "--dtype", type=str, choices=["float32", "float16"], default="float32"
+    )
+    parser.add_argument("--num-iters", type=int, default=10)
+    args = parser.parse_args()
+
+    benchmark_compression(
+        [tuple(int(x) for x in shape.split("x")) for shape in args.shapes],
+        args.num_tokens,
+        args.backends,
+        args.device,
+        getattr(torch, args.dtype),
+        args.num_iters,
+    )
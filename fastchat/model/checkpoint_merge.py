@@ -0,0 +1,253 @@
+"""
+Merge two checkpoints tensor by tensor, e.g. to apply or make delta weights.
+
+No model is ever loaded as a whole:
+
+- the inputs are memory-mapped, safetensors preferred over .bin pickles, and
+  read in chunks whose pages are dropped again after use;
+- the output shards are safetensors files written chunk by chunk, since
+  their headers are known before any tensor is computed;
+- a pool of processes computes the output shards in parallel.
+
+The chunk size and the number of processes keep the tensors in flight
+within `max_memory`, on top of about one interpreter per process.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import dataclasses
+import json
+import multiprocessing
+import os
+import pickle
+from typing import Dict, List, Optional
+
+from huggingface_hub import snapshot_download
+import torch
+from tqdm import tqdm
+
+from fastchat.model import safetensors_mmap
+from fastchat.model.model_loader import get_checkpoint_files, load_state_dict
+
+GB = 1 << 30
+DEFAULT_MAX_SHARD_SIZE = 2 * GB
+OPERATIONS = ("add", "sub")
+# Buffers that models compute at init and that only some checkpoints save.
+# A merge skips them if one of the checkpoints has none.
+OPTIONAL_TENSOR_SUFFIXES = (".inv_freq",)
+# The bytes of an element in flight: the mapped inputs, their float32 copies
+# and the cast result
+BYTES_PER_ELEMENT = 24
+MIN_CHUNK_ELEMENTS = 1 << 20
+
+
+@dataclasses.dataclass
+class TensorInfo:
+    name: str
+    filename: str
+    dtype: torch.dtype
+    shape: List[int]
+
+
+def resolve_model_path(model_path: str) -> str:
+    """Download a Hugging Face repo ID, or return a local folder."""
+    if os.path.isdir(model_path):
+        return model_path
+    return snapshot_download(repo_id=model_path)
+
+
+def get_tensor_infos(model_path: str) -> Dict[str, TensorInfo]:
+    """Get the file, dtype and shape of every tensor of a checkpoint
+    without reading the tensors."""
+    files = get_checkpoint_files(model_path)
+    if not files:
+        raise ValueError(f"No checkpoint files in {model_path}.")
+    infos = {}
+    for filename in files:
+        if filename.endswith(".safetensors"):
+            tensor_infos = safetensors_mmap.read_tensor_infos(filename)
+            for name, (dtype, shape) in tensor_infos.items():
+                infos[name] = TensorInfo(name, filename, dtype, shape)
+        else:
+            for name, tensor in load_state_dict(filename).items():
+                infos[name] = TensorInfo(
+                    name, filename, tensor.dtype, list(tensor.shape)
+                )
+    return infos
+
+
+class _InputFile:
+    """A checkpoint file read one chunk at a time."""
+
+    def __init__(self, filename: str):
+        self.mapped_file = None
+        self.state_dict = None
+        # Whether the tensors of `state_dict` map the file
+        self.mapped = False
+        if filename.endswith(".safetensors"):
+            self.mapped_file = safetensors_mmap.MappedFile(filename)
+            return
+        try:
+            self.state_dict = torch.load(
+                filename, map_location="cpu", mmap=True, weights_only=True
+            )
+            self.mapped = True
+        except (RuntimeError, TypeError, ValueError, pickle.UnpicklingError):
+            # Files in the legacy format can't be mapped, and files with
+            # other objects than tensors can't be loaded with `weights_only`.
+            # Local checkpoints are trusted.
+            self.state_dict = torch.load(
+                filename, map_location="cpu", weights_only=False
+            )
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        if self.mapped_file is not None:
+            return self.mapped_file.get_tensor(name).reshape(-1)
+        return self.state_dict[name].reshape(-1)
+
+    def release(self, name: str, begin: int, end: int):
+        """Drop the bytes [begin, end) of a tensor from memory."""
+        if self.mapped_file is not None:
+            self.mapped_file.release(name, begin, end)
+        elif self.mapped and self.state_dict[name].is_contiguous():
+            safetensors_mmap.drop_pages(
+                self.state_dict[name].data_ptr() + begin, end - begin
+            )
+
+
+def _merge_shard(
+    output_file: str,
+    tensors: List[tuple],
+    operation: str,
+    metadata: Dict[str, str],
+    chunk_elements: int,
+):
+    """Write one output shard. `tensors` has the (name, file of the first
+    input, file of the second input, output dtype, shape) of its tensors."""
+    inputs = {}
+
+    def get_input(filename):
+        if filename not in inputs:
+            inputs[filename] = _InputFile(filename)
+        return inputs[filename]
+
+    with open(output_file, "wb") as f:
+        safetensors_mmap.write_header(
+            f, [(name, dtype, shape) for name, _, _, dtype, shape in tensors], metadata
+        )
+        for name, file_a, file_b, dtype, _ in tensors:
+            input_a, input_b = get_input(file_a), get_input(file_b)
+            a, b = input_a.get_tensor(name), input_b.get_tensor(name)
+            for begin in range(0, a.numel(), chunk_elements):
+                end = min(begin + chunk_elements, a.numel())
+                if dtype.is_floating_point:
+                    # Round the inputs to the output dtype first, as if both
+                    # models were loaded in that dtype.
+                    x, y = a[begin:end].to(dtype).float(), b[begin:end].to(dtype)
+                    x = x.add_(y) if operation == "add" else x.sub_(y)
+                else:
+                    # Buffers like position ids are not weights.
+                    x = a[begin:end]
+                f.write(x.to(dtype).view(torch.uint8).numpy().data)
+                input_a.release(name, begin * a.element_size(), end * a.element_size())
+                input_b.release(name, begin * b.element_size(), end * b.element_size())
+
+
+def merge_checkpoints(
+    path_a: str,
+    path_b: str,
+    output_path: str,
+    operation: str,
+    dtype: torch.dtype = torch.float16,
+    max_memory: int = 4 * GB,
+    num_workers: Optional[int] = None,
+    max_shard_size: int = DEFAULT_MAX_SHARD_SIZE,
+):
+    """Write `a + b` or `a - b` of every tensor of checkpoint `a` as a
+    sharded safetensors checkpoint. Floating-point tensors are computed in
+    `dtype`, and the others are copied from `a`."""
+    if operation not in OPERATIONS:
+        raise ValueError(f"Invalid operation: {operation}")
+    infos_a, infos_b = get_tensor_infos(path_a), get_tensor_infos(path_b)
+    missing = [name for name in infos_a if name not in infos_b]
+    required = [name for name in missing if not name.endswith(OPTIONAL_TENSOR_SUFFIXES)]
+    if required:
+        raise ValueError(
+            f"{len(required)} tensors like {required[0]} are not in {path_b}."
+        )
+    if missing:
+        print(f"Skipping {len(missing)} optional tensors like {missing[0]}.")
+
+    # Group the tensors into output shards in checkpoint order.
+    shards = [[]]
+    shard_size = total_size = 0
+    for name, info in infos_a.items():
+        if name not in infos_b:
+            continue
+        if info.shape != infos_b[name].shape:
+            raise ValueError(
+                f"The shapes of {name} differ: {info.shape} and {infos_b[name].shape}."
+            )
+        out_dtype = dtype if info.dtype.is_floating_point else info.dtype
+        element_size = torch.empty((), dtype=out_dtype).element_size()
+        num_bytes = torch.Size(info.shape).numel() * element_size
+        if shards[-1] and shard_size + num_bytes > max_shard_size:
+            shards.append([])
+            shard_size = 0
+        shards[-1].append(
+            (name, info.filename, infos_b[name].filename, out_dtype, info.shape)
+        )
+        shard_size += num_bytes
+        total_size += num_bytes
+
+    num_workers = num_workers or os.cpu_count() or 1
+    num_workers = min(
+        num_workers,
+        len(shards),
+        max(max_memory // (MIN_CHUNK_ELEMENTS * BYTES_PER_ELEMENT), 1),
+    )
+    chunk_elements = max(max_memory // num_workers // BYTES_PER_ELEMENT, 1)
+
+    os.makedirs(output_path, exist_ok=True)
+    if len(shards) == 1:
+        filenames = ["model.safetensors"]
+    else:
+        filenames = [
+            f"model-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+            for i in range(len(shards))
+        ]
+    args = [
+        (os.path.join(output_path, filename), tensors, operation, {"format": "pt"})
+        for filename, tensors in zip(filenames, shards)
+    ]
+    print(
+        f"Merging {len(infos_a) - len(missing)} tensors into {len(shards)} shards "
+        f"with {num_workers} processes"
+    )
+    if num_workers == 1:
+        for arg in tqdm(args):
+            _merge_shard(*arg, chunk_elements)
+    else:
+        # Spawned, since forking a process that runs torch can deadlock.
+        with ProcessPoolExecutor(
+            num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=torch.set_num_threads,
+            initargs=(1,),
+        ) as executor:
+            futures = [
+                executor.submit(_merge_shard, *arg, chunk_elements) for arg in args
+            ]
+            for future in tqdm(futures):
+                future.result()
+
+    if len(shards) > 1:
+        weight_map = {
+            name: filename
+            for filename, tensors in zip(filenames, shards)
+            for name, *_ in tensors
+        }
+        with open(os.path.join(output_path, "model.safetensors.index.json"), "w") as f:
+            json.dump(
+                {"metadata": {"total_size": total_size}, "weight_map": weight_map},
+                f,
+                indent=2,
+            )
@@ -1,17 +1,31 @@
 import dataclasses
+import fnmatch
+import functools
 import gc
-import glob
+import json
+import logging
 import os
+import time
+from typing import List, Optional, Tuple, Union
 
-from accelerate import init_empty_weights
 from accelerate.utils import set_module_tensor_to_device
 import torch
 from torch import Tensor
 import torch.nn as nn
 from torch.nn import functional as F
-from tqdm import tqdm
 from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig
 
+from fastchat.constants import COMPRESSION_BACKEND
+from fastchat.model import safetensors_mmap
+from fastchat.model.model_loader import (
+    LoadTimings,
+    get_checkpoint_files,
+    load_shards,
+    skip_init,
+)
+
+logger = logging.getLogger(__name__)
+
 
 @dataclasses.dataclass
 class CompressionConfig:
@@ -28,36 +42,217 @@ default_compression_config = CompressionConfig(
     num_bits=8, group_size=256, group_dim=1, symmetric=True, enabled=True
 )
 
+# A compression policy maps module name patterns to compression configs.
+# The first pattern that matches a module wins, and modules that match no
+# pattern use `default_compression_config`.
+CompressionPolicy = List[Tuple[str, CompressionConfig]]
+
+
+def parse_compression_policy(spec: str) -> CompressionPolicy:
+    """Parse a policy like "lm_head=8,*.mlp.*=4a,*=8:128".
+
+    Every entry is a module name pattern, then the number of bits and an
+    optional group size. An "a" after the bits selects an asymmetric
+    quantization. "none" keeps the matching modules uncompressed.
+    """
+    policy = []
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        pattern, _, value = entry.strip().rpartition("=")
+        if not pattern or not value:
+            raise ValueError(f"Invalid compression policy entry: {entry}")
+        if value.lower() == "none":
+            config = dataclasses.replace(default_compression_config, enabled=False)
+        else:
+            num_bits, _, group_size = value.partition(":")
+            config = dataclasses.replace(
+                default_compression_config,
+                num_bits=int(num_bits.rstrip("a")),
+                group_size=int(group_size or default_compression_config.group_size),
+                symmetric=not num_bits.endswith("a"),
+            )
+            if not 2 <= config.num_bits <= 8:
+                raise ValueError(f"Unsupported number of bits: {entry}")
+        policy.append((pattern, config))
+    return policy
+
+
+def get_compression_config(
+    name: str, policy: Optional[CompressionPolicy] = None
+) -> CompressionConfig:
+    """Get the compression config of the module `name`."""
+    for pattern, config in policy or []:
+        if fnmatch.fnmatchcase(name, pattern):
+            return config
+    return default_compression_config
+
+
+COMPRESSION_BACKENDS = ("auto", "int8", "tiled", "decompress")
+# The number of weight elements the tiled backend dequantizes at once
+TILED_DEQUANT_NUM_ELEMENTS = 2**22
+# The weights file of a checkpoint saved by `save_compressed_model`
+COMPRESSED_WEIGHTS_NAME = "compressed_model.safetensors"
+
 
 class CLinear(nn.Module):
-    """Compressed Linear Layer."""
+    """Compressed Linear Layer.
+
+    The forward pass runs on the quantized weight with one of the backends:
+
+    - "tiled": dequantizes a few rows of the weight at a time.
+    - "int8": quantizes the input to int8 per token and group, and multiplies
+      it with the int8 weight group by group. Needs a symmetric quantization
+      and a working `torch._int_mm`, and runs on CPU. It also quantizes the
+      activations, so it is opt-in.
+    - "decompress": dequantizes the whole weight on every forward pass.
 
-    def __init__(self, weight=None, bias=None, device=None):
+    "auto" picks "tiled". Unsupported backends fall back to "tiled".
+    """
+
+    def __init__(self, weight=None, bias=None, device=None, backend=None, config=None):
         super().__init__()
+        self.config = config or default_compression_config
         if weight is None:
             self.weight = None
         elif isinstance(weight, Tensor):
-            self.weight = compress(weight.data.to(device), default_compression_config)
+            self.weight = compress(weight.data.to(device), self.config)
         else:
             self.weight = weight
         self.bias = bias
+        self.backend = backend or COMPRESSION_BACKEND
+        if self.backend not in COMPRESSION_BACKENDS:
+            raise ValueError(f"Unknown compression backend: {self.backend}")
+
+    def _apply(self, fn, *args, **kwargs):
+        # Move the compressed weight with the module, e.g. in `model.to()`.
+        super()._apply(fn, *args, **kwargs)
+        if isinstance(self.weight, Tensor):
+            self.weight = fn(self.weight)
+        elif self.weight is not None:
+            self.weight = tuple(
+                fn(x) if isinstance(x, Tensor) else x for x in self.weight
+            )
+        return self
 
     def forward(self, input: Tensor) -> Tensor:
-        weight = decompress(self.weight, default_compression_config)
+        config = self.config
+        backend = get_compression_backend(self.backend, self.weight, config)
+        if backend == "int8":
+            return int8_linear(input, self.weight, config, self.bias)
+        if backend == "tiled":
+            return tiled_linear(input, self.weight, config, self.bias)
+        weight = decompress(self.weight, config)
         return F.linear(input.to(weight.dtype), weight, self.bias)
 
 
-def compress_module(module, target_device):
+def get_compression_backend(backend, packed_data, config):
+    """Get the backend that runs a compressed linear layer, falling back to
+    the next supported one."""
+    if not config.enabled or config.group_dim != 1 or len(packed_data[-1]) != 2:
+        return "decompress"
+    if backend == "decompress":
+        return backend
+    if (
+        backend == "int8"
+        and config.symmetric
+        and packed_data[0].device.type == "cpu"
+        and is_int8_matmul_supported()
+    ):
+        return "int8"
+    return "tiled"
+
+
+@functools.lru_cache(maxsize=None)
+def is_int8_matmul_supported() -> bool:
+    """Whether `torch._int_mm` runs on CPU, tried on a small product in the
+    layout of `int8_linear`."""
+    if not hasattr(torch, "_int_mm"):
+        return False
+    try:
+        x = torch.ones((32, 32), dtype=torch.int8)
+        product = torch._int_mm(x, x.t())
+    except (RuntimeError, NotImplementedError):
+        return False
+    return bool((product == 32).all())
+
+
+def int8_linear(input, packed_data, config, bias=None):
+    """A linear layer on a symmetric group-wise int8 weight.
+
+    Every group of the input is quantized to int8 with its own scale, so
+    the product of a group is an exact int32 matmul, which is then scaled
+    and summed in float32.
+    """
+    data, scale, original_shape = packed_data
+    out_features, in_features = original_shape
+    num_groups = data.shape[1]
+
+    x = input.reshape(-1, in_features).float()
+    pad_len = num_groups * config.group_size - in_features
+    if pad_len:
+        x = F.pad(x, (0, pad_len))
+    x = x.view(-1, num_groups, config.group_size)
+    x_scale = x.abs().amax(dim=-1, keepdim=True).clamp_(min=1e-8) / 127
+    x = (x / x_scale).round_().to(torch.int8)
+    # [num_groups, out_features]
+    weight_scale = (1 / scale[..., 0].float()).t()
+
+    output = torch.zeros(
+        (x.shape[0], out_features), dtype=torch.float32, device=input.device
+    )
+    for i in range(num_groups):
+        weight = _get_quantized_data(data[:, i], config, config.group_size)
+        # The transposed view has the column-major layout of the int8 matmul.
+        product = torch._int_mm(x[:, i].contiguous(), weight.t())
+        output.addcmul_(product.float(), x_scale[:, i] * weight_scale[i])
+    if bias is not None:
+        output += bias
+    return output.to(scale.dtype).view(*input.shape[:-1], out_features)
+
+
+def tiled_linear(input, packed_data, config, bias=None):
+    """A linear layer that dequantizes a few rows of the weight at a time."""
+    if config.symmetric:
+        data, scale, original_shape = packed_data
+    else:
+        data, mn, scale, original_shape = packed_data
+    out_features, in_features = original_shape
+    num_rows = max(TILED_DEQUANT_NUM_ELEMENTS // data[0].numel(), 1)
+
+    input = input.to(scale.dtype)
+    outputs = []
+    for start in range(0, out_features, num_rows):
+        end = min(start + num_rows, out_features)
+        weight = _get_quantized_data(data[start:end], config, config.group_size)
+        weight = weight / scale[start:end]
+        if not config.symmetric:
+            weight.add_(mn[start:end])
+        weight = weight.view(end - start, -1)[:, :in_features]
+        outputs.append(
+            F.linear(input, weight, None if bias is None else bias[start:end])
+        )
+    return torch.cat(outputs, dim=-1)
+
+
+def compress_module(module, target_device, policy=None, prefix=""):
     for attr_str in dir(module):
         target_attr = getattr(module, attr_str)
         if type(target_attr) == torch.nn.Linear:
+            full_name = f"{prefix}.{attr_str}" if prefix else attr_str
             setattr(
                 module,
                 attr_str,
-                CLinear(target_attr.weight, target_attr.bias, target_device),
+                CLinear(
+                    target_attr.weight,
+                    target_attr.bias,
+                    target_device,
+                    config=get_compression_config(full_name, policy),
+                ),
             )
     for name, child in module.named_children():
-        compress_module(child, target_device)
+        child_prefix = f"{prefix}.{name}" if prefix else name
+        compress_module(child, target_device, policy, child_prefix)
 
 
 def get_compressed_list(module, prefix=""):
@@ -76,63 +271,176 @@ def get_compressed_list(module, prefix=""):
     return compressed_list
 
 
-def apply_compressed_weight(module, compressed_state_dict, target_device, prefix=""):
+def apply_compressed_weight(
+    module, compressed_state_dict, target_device, prefix="", policy=None
+):
     for attr_str in dir(module):
         target_attr = getattr(module, attr_str)
         if type(target_attr) == torch.nn.Linear:
-            full_name = (
-                f"{prefix}.{attr_str}.weight" if prefix else f"{attr_str}.weight"
-            )
+            full_name = f"{prefix}.{attr_str}" if prefix else attr_str
             setattr(
                 module,
                 attr_str,
                 CLinear(
-                    compressed_state_dict[full_name], target_attr.bias, target_device
+                    compressed_state_dict[f"{full_name}.weight"],
+                    target_attr.bias,
+                    target_device,
+                    config=get_compression_config(full_name, policy),
                 ),
             )
     for name, child in module.named_children():
         child_prefix = f"{prefix}.{name}" if prefix else name
         apply_compressed_weight(
-            child, compressed_state_dict, target_device, child_prefix
+            child, compressed_state_dict, target_device, child_prefix, policy
         )
 
 
-def load_compress_model(model_path, device, torch_dtype):
+def load_compress_model(
+    model_path,
+    device,
+    torch_dtype,
+    compression_policy: Optional[Union[str, CompressionPolicy]] = None,
+):
+    if isinstance(compression_policy, str):
+        compression_policy = parse_compression_policy(compression_policy)
+
+    timings = LoadTimings()
+    start = time.perf_counter()
+
     # partially load model
     tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
-    base_pattern = os.path.join(model_path, "pytorch_model-*.bin")
-    files = glob.glob(base_pattern)
+    files = get_checkpoint_files(model_path)
+    if not files:
+        raise ValueError(f"No checkpoint files in {model_path}")
 
-    with init_empty_weights():
+    with skip_init():
         config = AutoConfig.from_pretrained(
             model_path, low_cpu_mem_usage=True, torch_dtype=torch_dtype
         )
         model = AutoModelForCausalLM.from_config(config)
-        linear_weights = get_compressed_list(model)
+        linear_weights = set(get_compressed_list(model))
 
     compressed_state_dict = {}
 
-    for filename in tqdm(files):
-        tmp_state_dict = torch.load(filename)
-        for name in tmp_state_dict:
+    def compress_shard(filename, state_dict):
+        # The shards are memory-mapped, so only one tensor of a shard is
+        # in memory before it is compressed.
+        for name, tensor in state_dict.items():
             if name in linear_weights:
-                tensor = tmp_state_dict[name].to(device).data.to(torch_dtype)
+                tensor = tensor.to(device=device, dtype=torch_dtype)
                 compressed_state_dict[name] = compress(
-                    tensor, default_compression_config
+                    tensor,
+                    get_compression_config(name[: -len(".weight")], compression_policy),
                 )
             else:
-                compressed_state_dict[name] = tmp_state_dict[name].to(device)
-            tmp_state_dict[name] = None
-            tensor = None
-            gc.collect()
-            torch.cuda.empty_cache()
+                compressed_state_dict[name] = tensor.to(device)
+
+    timings.init = time.perf_counter() - start
+    load_shards(files, compress_shard, timings=timings)
+    gc.collect()
+    torch.cuda.empty_cache()
 
     for name in model.state_dict():
         if name not in linear_weights:
             set_module_tensor_to_device(
                 model, name, device, value=compressed_state_dict[name]
             )
-    apply_compressed_weight(model, compressed_state_dict, device)
+    apply_compressed_weight(
+        model, compressed_state_dict, device, policy=compression_policy
+    )
+
+    model.to(device)
+    timings.total = time.perf_counter() - start
+    logger.info(f"Compressed {len(files)} checkpoint files of {model_path} ({timings})")
+
+    return model, tokenizer
+
+
+def get_compressed_tensor_names(name, config):
+    """Get the checkpoint names of the tensors of a compressed weight."""
+    if not config.enabled:
+        return [name]
+    if config.symmetric:
+        return [f"{name}.data", f"{name}.scale"]
+    return [f"{name}.data", f"{name}.mn", f"{name}.scale"]
+
+
+def save_compressed_model(model, tokenizer, output_path):
+    """Save a model compressed by `compress_module` as a checkpoint that
+    `load_compressed_checkpoint` maps without compressing it again."""
+    from safetensors.torch import save_file
+
+    tensors = {
+        name: tensor.detach().cpu().contiguous()
+        for name, tensor in model.state_dict().items()
+    }
+    compressed_weights = {}
+    for module_name, module in model.named_modules():
+        if isinstance(module, CLinear):
+            name = f"{module_name}.weight"
+            weight = module.weight
+            packed_data = weight[:-1] if module.config.enabled else [weight]
+            names = get_compressed_tensor_names(name, module.config)
+            for key, tensor in zip(names, packed_data):
+                tensors[key] = tensor.detach().cpu().contiguous()
+            compressed_weights[name] = {
+                "config": dataclasses.asdict(module.config),
+                "original_shape": list(
+                    weight[-1] if module.config.enabled else weight.shape
+                ),
+            }
+
+    os.makedirs(output_path, exist_ok=True)
+    save_file(
+        tensors,
+        os.path.join(output_path, COMPRESSED_WEIGHTS_NAME),
+        metadata={"format": "pt", "compressed_weights": json.dumps(compressed_weights)},
+    )
+    model.config.save_pretrained(output_path)
+    tokenizer.save_pretrained(output_path)
+
+
+def is_compressed_checkpoint(model_path):
+    return os.path.isfile(os.path.join(model_path, COMPRESSED_WEIGHTS_NAME))
+
+
+def load_compressed_checkpoint(model_path, device, torch_dtype):
+    """Load a checkpoint saved by `save_compressed_model`.
+
+    The weights are memory-mapped instead of loaded and quantized, so the
+    peak memory stays near the size of the compressed model.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
+    tensors, metadata = safetensors_mmap.load_file(
+        os.path.join(model_path, COMPRESSED_WEIGHTS_NAME), device
+    )
+    for name, tensor in tensors.items():
+        if tensor.is_floating_point() and tensor.dtype != torch_dtype:
+            tensors[name] = tensor.to(torch_dtype)
+
+    with skip_init():
+        config = AutoConfig.from_pretrained(model_path)
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=torch_dtype)
+
+    compressed_state_dict = {}
+    policy = []
+    for name, entry in json.loads(metadata["compressed_weights"]).items():
+        compression_config = CompressionConfig(**entry["config"])
+        packed_data = tuple(
+            tensors.pop(key)
+            for key in get_compressed_tensor_names(name, compression_config)
+        )
+        if compression_config.enabled:
+            packed_data += (torch.Size(entry["original_shape"]),)
+        else:
+            packed_data = packed_data[0]
+        compressed_state_dict[name] = packed_data
+        policy.append((name[: -len(".weight")], compression_config))
+
+    for name in model.state_dict():
+        if name not in compressed_state_dict:
+            set_module_tensor_to_device(model, name, device, value=tensors[name])
+    apply_compressed_weight(model, compressed_state_dict, device, policy=policy)
 
     model.to(device)
 
@@ -178,6 +486,8 @@ def compress(tensor, config):
         scale = B / torch.max(data.abs(), dim=group_dim + 1, keepdim=True)[0]
         data = data * scale
         data = data.clamp_(-B, B).round_().to(torch.int8)
+        if num_bits < 8:
+            data = pack_bits((data + B).to(torch.uint8), num_bits)
         return data, scale, original_shape
     else:
         B = 2**num_bits - 1
@@ -189,6 +499,8 @@ def compress(tensor, config):
         data.mul_(scale)
 
         data = data.clamp_(0, B).round_().to(torch.uint8)
+        if num_bits < 8:
+            data = pack_bits(data, num_bits)
         return data, mn, scale, original_shape
 
 
@@ -207,10 +519,14 @@ def decompress(packed_data, config):
     # Dequantize
     if symmetric:
         data, scale, original_shape = packed_data
-        data = data / scale
     else:
         data, mn, scale, original_shape = packed_data
-        data = data / scale
+    if group_dim == len(original_shape) - 1:
+        length = group_size
+    else:
+        length = original_shape[-1]
+    data = _get_quantized_data(data, config, length) / scale
+    if not symmetric:
         data.add_(mn)
 
     # Unpad
@@ -226,3 +542,61 @@ def decompress(packed_data, config):
         return data[indices].contiguous()
     else:
         return data.view(original_shape)
+
+
+def pack_bits(data: Tensor, num_bits: int) -> Tensor:
+    """Pack unsigned `num_bits`-bit values along the last dimension.
+
+    Every 8 values take `num_bits` bytes, e.g. two 4-bit values per byte.
+    The last dimension is padded to a multiple of 8 values.
+    """
+    if num_bits == 8:
+        return data
+    pad_len = -data.shape[-1] % 8
+    if pad_len:
+        data = F.pad(data, (0, pad_len))
+
+    if 8 % num_bits == 0:
+        # The values fit in whole bytes.
+        data = data.view(*data.shape[:-1], -1, 8 // num_bits)
+        packed = data[..., 0].clone()
+        for i in range(1, data.shape[-1]):
+            packed |= data[..., i] << (num_bits * i)
+        return packed
+
+    data = data.view(*data.shape[:-1], -1, 8).long()
+    words = data[..., 0].clone()
+    for i in range(1, 8):
+        words |= data[..., i] << (num_bits * i)
+    packed = torch.stack([(words >> (8 * i)) & 0xFF for i in range(num_bits)], -1)
+    return packed.to(torch.uint8).flatten(-2)
+
+
+def unpack_bits(packed: Tensor, num_bits: int, length: int) -> Tensor:
+    """Unpack the first `length` values of `pack_bits` along the last dimension."""
+    if num_bits == 8:
+        return packed
+    mask = (1 << num_bits) - 1
+
+    if 8 % num_bits == 0:
+        data = torch.stack(
+            [(packed >> (num_bits * i)) & mask for i in range(8 // num_bits)], -1
+        )
+    else:
+        packed = packed.view(*packed.shape[:-1], -1, num_bits).long()
+        words = packed[..., 0].clone()
+        for i in range(1, num_bits):
+            words |= packed[..., i] << (8 * i)
+        data = torch.stack([(words >> (num_bits * i)) & mask for i in range(8)], -1)
+        data = data.to(torch.uint8)
+    return data.flatten(-2)[..., :length]
+
+
+def _get_quantized_data(data, config, length):
+    """Unpack the quantized values, which are signed for a symmetric
+    quantization."""
+    if config.num_bits < 8:
+        data = unpack_bits(data, config.num_bits, length)
+        if config.symmetric:
+            data = data.to(torch.int8) - (2 ** (config.num_bits - 1) - 1)
+    return data
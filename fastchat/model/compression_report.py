@@ -0,0 +1,159 @@
+"""
+Report the accuracy and the memory of a model under compression policies.
+
+Every policy compresses the linear layers of the model, which is then
+compared with the uncompressed model on a text: the perplexity, the
+agreement of the top-1 next tokens and the KL divergence of the next token
+distributions.
+
+Usage:
+python3 -m fastchat.model.compression_report --model-path ~/model_weights/vicuna-7b --policies "*=8" "lm_head=8,*.mlp.*=4" "lm_head=8,*=4a:128" "lm_head=8,*=3a:64"
+"""
+import argparse
+import math
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+from fastchat.model.compression import (
+    CLinear,
+    get_compression_config,
+    parse_compression_policy,
+)
+from fastchat.model.model_adapter import load_model
+
+DEFAULT_TEXT = (
+    "The Industrial Revolution was the transition to new manufacturing processes "
+    "in Great Britain, continental Europe, and the United States, that occurred "
+    "during the period from around 1760 to about 1820-1840. This transition "
+    "included going from hand production methods to machines, new chemical "
+    "manufacturing and iron production processes, the increasing use of steam "
+    "power and water power, the development of machine tools and the rise of the "
+    "mechanized factory system. Output greatly increased, and a result was an "
+    "unprecedented rise in population and in the rate of population growth."
+)
+
+
+def get_linear_layers(model):
+    """Get the name, parent and attribute name of every linear layer."""
+    layers = []
+    for parent_name, parent in model.named_modules():
+        for attr, module in parent.named_children():
+            if type(module) == nn.Linear:
+                name = f"{parent_name}.{attr}" if parent_name else attr
+                layers.append((name, parent, attr))
+    return layers
+
+
+def get_num_bytes(data):
+    if isinstance(data, torch.Tensor):
+        return data.numel() * data.element_size()
+    if isinstance(data, (tuple, list)):
+        return sum(get_num_bytes(x) for x in data)
+    return 0
+
+
+@torch.inference_mode()
+def evaluate(model, input_ids, reference_log_probs=None):
+    log_probs = F.log_softmax(model(input_ids).logits[0, :-1].float(), dim=-1)
+    nll = -log_probs.gather(1, input_ids[0, 1:, None]).mean().item()
+    result = {"ppl": math.exp(nll), "log_probs": log_probs}
+    if reference_log_probs is not None:
+        result["top1"] = (
+            (log_probs.argmax(-1) == reference_log_probs.argmax(-1)).float().mean()
+        ).item()
+        result["kl"] = (
+            (reference_log_probs.exp() * (reference_log_probs - log_probs))
+            .sum(-1)
+            .mean()
+            .item()
+        )
+    return result
+
+
+def compression_report(model, tokenizer, device, policies, text, max_length):
+    input_ids = tokenizer(text, return_tensors="pt").input_ids[:, :max_length]
+    input_ids = input_ids.to(device)
+    layers = get_linear_layers(model)
+    linears = {name: getattr(parent, attr) for name, parent, attr in layers}
+    linear_bytes = sum(get_num_bytes(m.weight) for m in linears.values())
+    other_bytes = get_num_bytes(list(model.parameters())) - linear_bytes
+
+    reference = evaluate(model, input_ids)
+    print(
+        f"{'policy':<32} {'linear MB':>10} {'model MB':>10} {'ratio':>6} "
+        f"{'ppl':>9} {'top1':>6} {'kl':>7}"
+    )
+    print(
+        f"{'uncompressed':<32} {linear_bytes / 2**20:>10.1f} "
+        f"{(linear_bytes + other_bytes) / 2**20:>10.1f} {1:>6.3f} "
+        f"{reference['ppl']:>9.3f} {1:>6.3f} {0:>7.4f}"
+    )
+
+    for spec in policies:
+        policy = parse_compression_policy(spec)
+        try:
+            for name, parent, attr in layers:
+                linear = linears[name]
+                setattr(
+                    parent,
+                    attr,
+                    CLinear(
+                        linear.weight,
+                        linear.bias,
+                        device,
+                        config=get_compression_config(name, policy),
+                    ),
+                )
+            compressed_bytes = sum(
+                get_num_bytes(getattr(parent, attr).weight)
+                for _, parent, attr in layers
+            )
+            result = evaluate(model, input_ids, reference["log_probs"])
+        finally:
+            for name, parent, attr in layers:
+                setattr(parent, attr, linears[name])
+        print(
+            f"{spec:<32} {compressed_bytes / 2**20:>10.1f} "
+            f"{(compressed_bytes + other_bytes) / 2**20:>10.1f} "
+            f"{compressed_bytes / linear_bytes:>6.3f} {result['ppl']:>9.3f} "
+            f"{result['top1']:>6.3f} {result['kl']:>7.4f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model-path",
+        type=str,
+        required=True,
+        help="The path to the weights. This can be a local folder or a Hugging Face repo ID.",
+    )
+    parser.add_argument(
+        "--device", type=str, choices=["cpu", "cuda", "mps"], default="cuda"
+    )
+    parser.add_argument(
+        "--policies",
+        type=str,
+        nargs="+",
+        default=["*=8", "lm_head=8,*.mlp.*=4", "lm_head=8,*=4", "lm_head=8,*=3a:64"],
+        help='Compression policies like "lm_head=8,*.mlp.*=4a:128"',
+    )
+    parser.add_argument(
+        "--text-file",
+        type=str,
+        help="The evaluation text. A short paragraph by default.",
+    )
+    parser.add_argument("--max-length", type=int, default=1024)
+    args = parser.parse_args()
+
+    text = DEFAULT_TEXT
+    if args.text_file:
+        with open(args.text_file) as f:
+            text = f.read()
+
+    model, tokenizer = load_model(args.model_path, args.device, 1)
+    compression_report(
+        model, tokenizer, args.device, args.policies, text, args.max_length
+    )
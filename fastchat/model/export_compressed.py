@@ -0,0 +1,65 @@
+"""
+Export a model with compressed weights, so --load-8bit maps them at startup
+instead of loading and quantizing the full weights.
+
+Usage:
+python3 -m fastchat.model.export_compressed --model-path ~/model_weights/vicuna-13b --output-path ~/model_weights/vicuna-13b-8bit
+python3 -m fastchat.serve.cli --model-path ~/model_weights/vicuna-13b-8bit
+"""
+import argparse
+
+import torch
+
+from fastchat.model.compression import (
+    compress_module,
+    parse_compression_policy,
+    save_compressed_model,
+)
+from fastchat.model.model_adapter import get_model_adapter
+
+
+def export_compressed(model_path, output_path, device, torch_dtype, policy=None):
+    adapter = get_model_adapter(model_path)
+    model, tokenizer = adapter.load_model(model_path, {"torch_dtype": torch_dtype})
+    compress_module(model, device, policy)
+    save_compressed_model(model, tokenizer, output_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model-path",
+        type=str,
+        required=True,
+        help="The path to the weights. This can be a local folder or a Hugging Face repo ID.",
+    )
+    parser.add_argument("--output-path", type=str, required=True)
+    parser.add_argument(
+        "--device",
+        type=str,
+        choices=["cpu", "cuda", "mps"],
+        default="cpu",
+        help="The device that compresses the weights",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        choices=["float32", "float16", "bfloat16"],
+        default="float16",
+        help="The dtype of the scales and the uncompressed weights",
+    )
+    parser.add_argument(
+        "--compression-policy",
+        type=str,
+        default=None,
+        help='Per-module compression like "lm_head=8,*.mlp.*=4a:128"',
+    )
+    args = parser.parse_args()
+
+    export_compressed(
+        args.model_path,
+        args.output_path,
+        args.device,
+        getattr(torch, args.dtype),
+        args.compression_policy and parse_compression_policy(args.compression_policy),
+    )
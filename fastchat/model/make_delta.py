@@ -1,40 +1,47 @@
 """
 Make the delta weights by subtracting base weights.
 
+The weights are subtracted tensor by tensor with a pool of processes, so
+the memory stays within --max-memory-gb for any model size.
+
 Usage:
 python3 -m fastchat.model.make_delta --base ~/model_weights/llama-13b --target ~/model_weights/vicuna-13b --delta ~/model_weights/vicuna-13b-delta --hub-repo-id lmsys/vicuna-13b-delta-v1.1
 """
 import argparse
 
-import torch
-from tqdm import tqdm
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from huggingface_hub import HfApi
 
+from fastchat.model.apply_delta import save_model_files
+from fastchat.model.checkpoint_merge import GB, merge_checkpoints, resolve_model_path
 
-def make_delta(base_model_path, target_model_path, delta_path):
-    print(f"Loading the base model from {base_model_path}")
-    base = AutoModelForCausalLM.from_pretrained(
-        base_model_path, torch_dtype=torch.float16, low_cpu_mem_usage=True
-    )
 
-    print(f"Loading the target model from {target_model_path}")
-    target = AutoModelForCausalLM.from_pretrained(
-        target_model_path, torch_dtype=torch.float16, low_cpu_mem_usage=True
-    )
-    target_tokenizer = AutoTokenizer.from_pretrained(target_model_path, use_fast=False)
+def make_delta(
+    base_model_path,
+    target_model_path,
+    delta_path,
+    hub_repo_id=None,
+    max_memory=4 * GB,
+    num_workers=None,
+):
+    base_model_path = resolve_model_path(base_model_path)
+    target_model_path = resolve_model_path(target_model_path)
 
-    print("Calculating the delta")
-    for name, param in tqdm(target.state_dict().items(), desc="Calculating delta"):
-        assert name in base.state_dict()
-        param.data -= base.state_dict()[name]
+    print(f"Calculating the delta of {target_model_path} to {base_model_path}")
+    merge_checkpoints(
+        target_model_path,
+        base_model_path,
+        delta_path,
+        "sub",
+        max_memory=max_memory,
+        num_workers=num_workers,
+    )
 
     print(f"Saving the delta to {delta_path}")
-    if args.hub_repo_id:
-        kwargs = {"push_to_hub": True, "repo_id": args.hub_repo_id}
-    else:
-        kwargs = {}
-    target.save_pretrained(delta_path, **kwargs)
-    target_tokenizer.save_pretrained(delta_path, **kwargs)
+    save_model_files(target_model_path, delta_path)
+    if hub_repo_id:
+        api = HfApi()
+        api.create_repo(hub_repo_id, exist_ok=True)
+        api.upload_folder(repo_id=hub_repo_id, folder_path=delta_path)
 
 
 if __name__ == "__main__":
@@ -43,6 +50,27 @@ if __name__ == "__main__":
     parser.add_argument("--target-model-path", type=str, required=True)
     parser.add_argument("--delta-path", type=str, required=True)
     parser.add_argument("--hub-repo-id", type=str)
+    parser.add_argument(
+        "--max-memory-gb",
+        type=float,
+        default=4,
+        help="The memory of the weights being subtracted, on top of about "
+        "0.5GB per process.",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=None,
+        help="The number of processes. All CPUs by default, fewer if the "
+        "memory limit requires it.",
+    )
     args = parser.parse_args()
 
-    make_delta(args.base_model_path, args.target_model_path, args.delta_path)
+    make_delta(
+        args.base_model_path,
+        args.target_model_path,
+        args.delta_path,
+        args.hub_repo_id,
+        int(args.max_memory_gb * GB),
+        args.num_workers,
+    )
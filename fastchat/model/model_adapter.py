@@ -24,7 +24,12 @@ from transformers import (
 )
 
 from fastchat.conversation import Conversation, get_conv_template
-from fastchat.model.compression import load_compress_model
+from fastchat.model.compression import (
+    is_compressed_checkpoint,
+    load_compress_model,
+    load_compressed_checkpoint,
+)
+from fastchat.model.model_loader import load_pretrained
 from fastchat.serve.load_gptq_model import load_quantized
 from fastchat.model.monkey_patch_non_inplace import (
     replace_llama_attn_with_non_inplace_operations,
@@ -40,8 +45,11 @@ class BaseAdapter:
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
         tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
-        model = AutoModelForCausalLM.from_pretrained(
-            model_path, low_cpu_mem_usage=True, **from_pretrained_kwargs
+        model = load_pretrained(
+            AutoModelForCausalLM,
+            model_path,
+            low_cpu_mem_usage=True,
+            **from_pretrained_kwargs,
         )
         return model, tokenizer
 
@@ -104,6 +112,7 @@ def load_model(
     groupsize: int = 0,
     cpu_offloading: bool = False,
     debug: bool = False,
+    compression_policy: Optional[str] = None,
 ):
     """Load a model from Hugging Face."""
 
@@ -135,6 +144,14 @@ def load_model(
     else:
         raise ValueError(f"Invalid device: {device}")
 
+    if device == "cuda" and num_gpus == 1 and not cpu_offloading:
+        # Load the weights straight to the GPU
+        kwargs["device_map"] = {"": device}
+
+    if is_compressed_checkpoint(model_path):
+        # Exported by fastchat.model.export_compressed
+        return load_compressed_checkpoint(model_path, device, kwargs["torch_dtype"])
+
     if cpu_offloading:
         # raises an error on incompatible platforms
         from transformers import BitsAndBytesConfig
@@ -154,7 +171,10 @@ def load_model(
             )
         else:
             return load_compress_model(
-                model_path=model_path, device=device, torch_dtype=kwargs["torch_dtype"]
+                model_path=model_path,
+                device=device,
+                torch_dtype=kwargs["torch_dtype"],
+                compression_policy=compression_policy,
             )
 
     # Load model
@@ -209,6 +229,15 @@ def add_model_args(parser):
         action="store_true",
         help="Only when using 8-bit quantization: Offload excess weights to the CPU that don't fit on the GPU",
     )
+    parser.add_argument(
+        "--compression-policy",
+        type=str,
+        default=None,
+        help="Only when using 8-bit quantization: The bits of each module, like "
+        '"lm_head=8,*.mlp.*=4,*=8". The first matching pattern wins, "none" keeps '
+        "a module uncompressed and 4a or 3a:64 selects an asymmetric quantization "
+        "with an optional group size.",
+    )
 
 
 def remove_parent_directory_name(model_path):
@@ -226,7 +255,8 @@ class VicunaAdapter(BaseAdapter):
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
         tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
-        model = AutoModelForCausalLM.from_pretrained(
+        model = load_pretrained(
+            AutoModelForCausalLM,
             model_path,
             low_cpu_mem_usage=True,
             **from_pretrained_kwargs,
@@ -259,8 +289,11 @@ class T5Adapter(BaseAdapter):
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
         tokenizer = T5Tokenizer.from_pretrained(model_path, use_fast=False)
-        model = AutoModelForSeq2SeqLM.from_pretrained(
-            model_path, low_cpu_mem_usage=True, **from_pretrained_kwargs
+        model = load_pretrained(
+            AutoModelForSeq2SeqLM,
+            model_path,
+            low_cpu_mem_usage=True,
+            **from_pretrained_kwargs,
         )
         return model, tokenizer
 
@@ -307,8 +340,8 @@ class ChatGLMAdapter(BaseAdapter):
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
         tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
-        model = AutoModel.from_pretrained(
-            model_path, trust_remote_code=True, **from_pretrained_kwargs
+        model = load_pretrained(
+            AutoModel, model_path, trust_remote_code=True, **from_pretrained_kwargs
         )
         return model, tokenizer
 
@@ -321,7 +354,8 @@ class DollyV2Adapter(BaseAdapter):
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
         tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
-        model = AutoModelForCausalLM.from_pretrained(
+        model = load_pretrained(
+            AutoModelForCausalLM,
             model_path,
             low_cpu_mem_usage=True,
             **from_pretrained_kwargs,
@@ -342,7 +376,8 @@ class OasstPythiaAdapter(BaseAdapter):
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
         tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
-        model = AutoModelForCausalLM.from_pretrained(
+        model = load_pretrained(
+            AutoModelForCausalLM,
             model_path,
             low_cpu_mem_usage=True,
             **from_pretrained_kwargs,
@@ -361,7 +396,8 @@ class StableLMAdapter(BaseAdapter):
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
         tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
-        model = AutoModelForCausalLM.from_pretrained(
+        model = load_pretrained(
+            AutoModelForCausalLM,
             model_path,
             low_cpu_mem_usage=True,
             **from_pretrained_kwargs,
@@ -379,7 +415,8 @@ class MPTAdapter(BaseAdapter):
         return "mpt" in model_path
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
-        model = AutoModelForCausalLM.from_pretrained(
+        model = load_pretrained(
+            AutoModelForCausalLM,
             model_path,
             low_cpu_mem_usage=True,
             trust_remote_code=True,
@@ -436,8 +473,11 @@ class OpenBuddyAdapter(BaseAdapter):
             warnings.warn(
                 "## This is a bf16(bfloat16) variant of OpenBuddy. Please make sure your GPU supports bf16."
             )
-        model = LlamaForCausalLM.from_pretrained(
-            model_path, low_cpu_mem_usage=True, **from_pretrained_kwargs
+        model = load_pretrained(
+            LlamaForCausalLM,
+            model_path,
+            low_cpu_mem_usage=True,
+            **from_pretrained_kwargs,
         )
         tokenizer = LlamaTokenizer.from_pretrained(model_path)
         return model, tokenizer
@@ -454,7 +494,8 @@ class PhoenixAdapter(BaseAdapter):
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
         tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
-        model = AutoModelForCausalLM.from_pretrained(
+        model = load_pretrained(
+            AutoModelForCausalLM,
             model_path,
             low_cpu_mem_usage=True,
             **from_pretrained_kwargs,
@@ -522,7 +563,8 @@ class RedPajamaINCITEAdapter(BaseAdapter):
 
     def load_model(self, model_path: str, from_pretrained_kwargs: dict):
         tokenizer = AutoTokenizer.from_pretrained(model_path)  # no use_fast=False
-        model = AutoModelForCausalLM.from_pretrained(
+        model = load_pretrained(
+            AutoModelForCausalLM,
             model_path,
             low_cpu_mem_usage=True,
             **from_pretrained_kwargs,
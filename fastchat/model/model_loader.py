@@ -0,0 +1,240 @@
+"""
+Fast loading of Hugging Face checkpoints.
+
+`load_pretrained` is a drop-in for `from_pretrained` on local checkpoints:
+
+- safetensors shards are preferred over .bin pickles, and both are
+  memory-mapped instead of read into memory;
+- the shards are loaded by a thread pool;
+- every tensor is cast and copied to its device straight from the map,
+  so no full copy of the weights is made on CPU, and CPU models keep
+  zero-copy views of the map when the dtype matches.
+
+Anything the fast path does not handle, like a multi-device `device_map`,
+8-bit loading or a checkpoint whose names don't match the model, goes to
+`from_pretrained`.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import dataclasses
+import gc
+import json
+import logging
+import os
+import pickle
+import time
+from typing import Callable, Dict, List, Optional
+import warnings
+
+from accelerate import init_empty_weights
+import torch
+import torch.nn as nn
+from transformers import AutoConfig, GenerationConfig
+from transformers.modeling_utils import no_init_weights
+
+from fastchat.constants import MODEL_LOAD_NUM_THREADS
+from fastchat.model import safetensors_mmap
+
+logger = logging.getLogger(__name__)
+
+# The checkpoint files in the order of preference, as (index, single file)
+CHECKPOINT_FILES = [
+    ("model.safetensors.index.json", "model.safetensors"),
+    ("pytorch_model.bin.index.json", "pytorch_model.bin"),
+]
+# The from_pretrained kwargs handled by the fast path. The other kwargs
+# override the config, except for these that need from_pretrained.
+FROM_PRETRAINED_KWARGS = ("low_cpu_mem_usage", "torch_dtype", "trust_remote_code")
+UNSUPPORTED_KWARGS = (
+    "load_in_8bit",
+    "load_in_4bit",
+    "quantization_config",
+    "max_memory",
+    "offload_folder",
+    "offload_state_dict",
+    "revision",
+    "state_dict",
+)
+
+
+@dataclasses.dataclass
+class LoadTimings:
+    """The seconds spent in each phase of loading a model. `read` and
+    `place` are summed over the shards, which overlap in `shards`."""
+
+    config: float = 0.0
+    init: float = 0.0
+    read: float = 0.0
+    place: float = 0.0
+    shards: float = 0.0
+    finalize: float = 0.0
+    total: float = 0.0
+
+    def __str__(self):
+        return ", ".join(
+            f"{field.name} {getattr(self, field.name):.2f}s"
+            for field in dataclasses.fields(self)
+        )
+
+
+@contextlib.contextmanager
+def skip_init():
+    """Create the modules inside on the meta device without initializing
+    their weights, like from_pretrained does."""
+    with init_empty_weights(), no_init_weights():
+        yield
+
+
+def get_checkpoint_files(model_path: str) -> List[str]:
+    """Get the weight files of a local checkpoint, preferring safetensors.
+    Returns an empty list if there are none."""
+    if not os.path.isdir(model_path):
+        return []
+    for index_name, single_name in CHECKPOINT_FILES:
+        index_file = os.path.join(model_path, index_name)
+        if os.path.isfile(index_file):
+            with open(index_file) as f:
+                weight_map = json.load(f)["weight_map"]
+            return [
+                os.path.join(model_path, name)
+                for name in sorted(set(weight_map.values()))
+            ]
+        if os.path.isfile(os.path.join(model_path, single_name)):
+            return [os.path.join(model_path, single_name)]
+    return []
+
+
+def load_state_dict(filename: str) -> Dict[str, torch.Tensor]:
+    """Load a checkpoint file as CPU tensors that map the file."""
+    if filename.endswith(".safetensors"):
+        return safetensors_mmap.load_file(filename)[0]
+    try:
+        return torch.load(filename, map_location="cpu", mmap=True, weights_only=True)
+    except (RuntimeError, TypeError, ValueError, pickle.UnpicklingError):
+        # Files in the legacy format can't be mapped, and files with other
+        # objects than tensors can't be loaded with `weights_only`. Local
+        # checkpoints are trusted.
+        return torch.load(filename, map_location="cpu", weights_only=False)
+
+
+def load_shards(
+    files: List[str],
+    load_fn: Callable[[str, Dict[str, torch.Tensor]], None],
+    num_threads: int = MODEL_LOAD_NUM_THREADS,
+    timings: Optional[LoadTimings] = None,
+):
+    """Load the checkpoint files with a thread pool and call
+    `load_fn(filename, state_dict)` on each of them."""
+
+    def load(filename):
+        tic = time.perf_counter()
+        state_dict = load_state_dict(filename)
+        read = time.perf_counter() - tic
+        load_fn(filename, state_dict)
+        return read, time.perf_counter() - tic - read
+
+    tic = time.perf_counter()
+    with ThreadPoolExecutor(max(min(num_threads, len(files)), 1)) as executor:
+        for read, place in executor.map(load, files):
+            if timings is not None:
+                timings.read += read
+                timings.place += place
+    if timings is not None:
+        timings.shards += time.perf_counter() - tic
+
+
+def get_target_device(kwargs: dict) -> Optional[torch.device]:
+    """Get the device of a `device_map` that puts the whole model on one
+    device, "cpu" without a `device_map`, or None for other maps."""
+    device_map = kwargs.get("device_map")
+    if device_map is None:
+        return torch.device("cpu")
+    if isinstance(device_map, dict) and list(device_map) == [""]:
+        device = device_map[""]
+        return torch.device(f"cuda:{device}" if isinstance(device, int) else device)
+    return None
+
+
+def load_pretrained(model_cls, model_path: str, **kwargs):
+    """Load a model like `model_cls.from_pretrained(model_path, **kwargs)`."""
+    files = get_checkpoint_files(model_path)
+    device = get_target_device(kwargs)
+    if not files or device is None or any(k in kwargs for k in UNSUPPORTED_KWARGS):
+        return model_cls.from_pretrained(model_path, **kwargs)
+
+    timings = LoadTimings()
+    start = tic = time.perf_counter()
+    torch_dtype = kwargs.get("torch_dtype")
+    trust_remote_code = kwargs.get("trust_remote_code", False)
+    config_kwargs = {
+        k: v
+        for k, v in kwargs.items()
+        if k not in FROM_PRETRAINED_KWARGS and k != "device_map"
+    }
+    config = AutoConfig.from_pretrained(
+        model_path, trust_remote_code=trust_remote_code, **config_kwargs
+    )
+    timings.config = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    with skip_init():
+        if hasattr(model_cls, "from_config"):
+            model = model_cls.from_config(
+                config, torch_dtype=torch_dtype, trust_remote_code=trust_remote_code
+            )
+        else:
+            model = model_cls._from_config(config, torch_dtype=torch_dtype)
+    timings.init = time.perf_counter() - tic
+
+    # Modules that from_pretrained keeps in float32 for float16 models
+    keep_in_fp32 = []
+    if torch_dtype == torch.float16:
+        keep_in_fp32 = getattr(model, "_keep_in_fp32_modules", None) or []
+    tensors = dict(model.named_parameters())
+    tensors.update(model.named_buffers())
+
+    def load_fn(filename, state_dict):
+        for name, value in state_dict.items():
+            if name not in tensors:
+                continue
+            module_name, _, attr = name.rpartition(".")
+            module = model.get_submodule(module_name)
+            old_value = tensors[name]
+            dtype = None
+            if old_value.is_floating_point():
+                dtype = old_value.dtype
+                if any(m in name for m in keep_in_fp32):
+                    dtype = torch.float32
+            value = value.to(device=device, dtype=dtype)
+            if attr in module._parameters:
+                module._parameters[attr] = nn.Parameter(
+                    value, requires_grad=old_value.requires_grad
+                )
+            else:
+                module._buffers[attr] = value
+
+    load_shards(files, load_fn, timings=timings)
+
+    tic = time.perf_counter()
+    model.tie_weights()
+    missing = [name for name, p in model.named_parameters() if p.device.type == "meta"]
+    if missing:
+        warnings.warn(
+            f"{len(missing)} weights like {missing[0]} are not in the checkpoint "
+            f"of {model_path}. Falling back to from_pretrained."
+        )
+        # Free the loaded weights first, so there are never two copies.
+        del model, tensors
+        gc.collect()
+        torch.cuda.empty_cache()
+        return model_cls.from_pretrained(model_path, **kwargs)
+    model.eval()
+    if model.can_generate() and os.path.isfile(
+        os.path.join(model_path, "generation_config.json")
+    ):
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    timings.finalize = time.perf_counter() - tic
+    timings.total = time.perf_counter() - start
+
+    logger.info(f"Loaded {len(files)} checkpoint files of {model_path} ({timings})")
+    return model
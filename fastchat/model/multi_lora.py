@@ -0,0 +1,216 @@
+"""
+Serve many LoRA adapters on one base model without merging them.
+
+The adapters stay low-rank next to the base weights. Every target linear
+layer keeps the stacked adapter matrices of all adapters, and a forward
+hook adds `x @ A @ B` for the adapter of every row of the batch. A batch can
+mix requests for different adapters and for the base model: the layer
+gathers the matrices of each row and runs one batched matmul.
+
+Adapters are read from PEFT checkpoints (`adapter_config.json` plus
+`adapter_model.safetensors` or `adapter_model.bin`). Only LoRA on linear
+layers is supported, without trained biases or `modules_to_save`.
+"""
+import contextlib
+import json
+import os
+import re
+import threading
+from typing import Dict, Iterator, List, Optional
+
+import torch
+import torch.nn as nn
+
+from fastchat.model.compression import CLinear
+from fastchat.model.model_loader import load_state_dict
+
+ADAPTER_CONFIG_NAME = "adapter_config.json"
+ADAPTER_WEIGHTS_NAMES = ("adapter_model.safetensors", "adapter_model.bin")
+# The module name and the matrix of a LoRA weight in a PEFT checkpoint
+LORA_WEIGHT_PATTERN = re.compile(
+    r"^(?:base_model\.model\.)?(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$"
+)
+
+
+def load_lora_adapter(adapter_path: str):
+    """Load the LoRA weights of a PEFT checkpoint.
+
+    Returns Dict[module name -> (A, B)], where A is [in, r] and B is [r, out]
+    with the scaling folded in.
+    """
+    with open(os.path.join(adapter_path, ADAPTER_CONFIG_NAME)) as f:
+        config = json.load(f)
+    if config.get("peft_type", "LORA") != "LORA":
+        raise ValueError(f"{adapter_path} is not a LoRA adapter.")
+    if config.get("bias", "none") != "none" or config.get("modules_to_save"):
+        raise ValueError(
+            f"{adapter_path} trains biases or whole modules. Merge it with "
+            f"fastchat.model.apply_lora instead."
+        )
+    for name in ADAPTER_WEIGHTS_NAMES:
+        filename = os.path.join(adapter_path, name)
+        if os.path.isfile(filename):
+            break
+    else:
+        raise ValueError(f"No adapter weights in {adapter_path}.")
+
+    # Dict[module name -> Dict["A"|"B" -> weight]]
+    weights = {}
+    for key, value in load_state_dict(filename).items():
+        match = LORA_WEIGHT_PATTERN.match(key)
+        if match is None:
+            raise ValueError(
+                f"{key} of {adapter_path} is not a LoRA weight of a linear layer."
+            )
+        weights.setdefault(match.group(1), {})[match.group(2)] = value
+
+    lora_weights = {}
+    for module_name, module_weights in weights.items():
+        if set(module_weights) != {"A", "B"}:
+            raise ValueError(f"{module_name} of {adapter_path} misses a LoRA weight.")
+        # PEFT keeps the weights of nn.Linear: A is [r, in] and B is [out, r].
+        lora_A, lora_B = module_weights["A"], module_weights["B"]
+        r = lora_A.shape[0]
+        alpha = config.get("lora_alpha", r)
+        for pattern, value in config.get("alpha_pattern", {}).items():
+            if re.match(rf".*\.{pattern}$", module_name):
+                alpha = value
+                break
+        if config.get("use_rslora", False):
+            scaling = alpha / r**0.5
+        else:
+            scaling = alpha / r
+        lora_weights[module_name] = (lora_A.t(), lora_B.t() * scaling)
+    return lora_weights
+
+
+def _get_module_device(module: nn.Module, default: torch.device) -> torch.device:
+    for tensor in module.parameters():
+        return tensor.device
+    if isinstance(module, CLinear):
+        weight = module.weight
+        weight = [weight] if isinstance(weight, torch.Tensor) else weight or []
+        for tensor in weight:
+            if isinstance(tensor, torch.Tensor):
+                return tensor.device
+    return default
+
+
+class MultiLoRA:
+    """The LoRA adapters of a model.
+
+    Adapter 0 is the base model and the adapters are numbered from 1 in the
+    order of `adapters`. Forward passes run the base model, unless they run
+    inside `use_adapters`.
+    """
+
+    def __init__(self, model: nn.Module, adapters: Dict[str, str]):
+        """Add the adapters in Dict[name -> PEFT checkpoint path] to a model."""
+        self.adapter_names = list(adapters)
+        self.adapter_ids = {name: i + 1 for i, name in enumerate(adapters)}
+        self.ranks = {}
+        # The adapters of the forward passes of each thread
+        self.local = threading.local()
+
+        # Dict[module name -> List[(adapter id, A, B)]]
+        module_weights = {}
+        for name, path in adapters.items():
+            lora_weights = load_lora_adapter(path)
+            if not lora_weights:
+                raise ValueError(f"{path} has no LoRA weights.")
+            self.ranks[name] = max(A.shape[1] for A, _ in lora_weights.values())
+            for module_name, (A, B) in lora_weights.items():
+                module_weights.setdefault(module_name, []).append(
+                    (self.adapter_ids[name], A, B)
+                )
+
+        dtype = getattr(model, "dtype", torch.float32)
+        default_device = next(model.parameters()).device
+        for module_name, weights in module_weights.items():
+            module = model.get_submodule(module_name)
+            in_features = getattr(module, "in_features", weights[0][1].shape[0])
+            out_features = getattr(module, "out_features", weights[0][2].shape[1])
+            for _, A, B in weights:
+                if A.shape[0] != in_features or B.shape[1] != out_features:
+                    raise ValueError(
+                        f"The LoRA weights of {module_name} do not match its shape."
+                    )
+            # Pad the ranks with zeros. Slot 0 stays zero for the base model.
+            r = max(A.shape[1] for _, A, _ in weights)
+            num_slots = len(adapters) + 1
+            lora_A = torch.zeros(num_slots, in_features, r, dtype=dtype)
+            lora_B = torch.zeros(num_slots, r, out_features, dtype=dtype)
+            for adapter_id, A, B in weights:
+                lora_A[adapter_id, :, : A.shape[1]] = A
+                lora_B[adapter_id, : B.shape[0], :] = B
+            device = _get_module_device(module, default_device)
+            # Not persistent, so that the state dict is the one of the base model
+            module.register_buffer("lora_A", lora_A.to(device), persistent=False)
+            module.register_buffer("lora_B", lora_B.to(device), persistent=False)
+            module.register_forward_hook(self._forward_hook)
+
+    def get_adapter_id(self, model_name: Optional[str]) -> int:
+        """Get the adapter of a model name, 0 for the base model."""
+        return self.adapter_ids.get(model_name, 0)
+
+    @contextlib.contextmanager
+    def use_adapters(self, adapter_ids: List[int]):
+        """Run the forward passes of this thread with the adapter of every
+        row of the batch. A single adapter applies to the whole batch."""
+        old_state = getattr(self.local, "state", None)
+        self.local.state = (list(adapter_ids), {})
+        try:
+            yield
+        finally:
+            self.local.state = old_state
+
+    def generate_with_adapter(self, generator: Iterator, adapter_id: int) -> Iterator:
+        """Run every step of a generator with one adapter. The steps may
+        run on different threads, as in a streaming response."""
+        try:
+            while True:
+                with self.use_adapters([adapter_id]):
+                    try:
+                        output = next(generator)
+                    except StopIteration:
+                        return
+                yield output
+        finally:
+            generator.close()
+
+    def get_status(self):
+        return {name: {"rank": self.ranks[name]} for name in self.adapter_names}
+
+    def _get_indices(self, device, state) -> torch.Tensor:
+        adapter_ids, indices = state
+        if device not in indices:
+            indices[device] = torch.as_tensor(adapter_ids, device=device)
+        return indices[device]
+
+    def _forward_hook(self, module, inputs, output):
+        state = getattr(self.local, "state", None)
+        if state is None:
+            return None
+        adapter_ids = state[0]
+        first_id = adapter_ids[0]
+        uniform = all(adapter_id == first_id for adapter_id in adapter_ids)
+        if uniform and first_id == 0:
+            return None
+
+        x = inputs[0]
+        lora_A, lora_B = module.lora_A, module.lora_B
+        if lora_A.dtype != x.dtype:
+            lora_A, lora_B = lora_A.to(x.dtype), lora_B.to(x.dtype)
+        if uniform:
+            return output + (x @ lora_A[first_id]) @ lora_B[first_id]
+
+        # Gather the matrices of the adapter of every row.
+        batch_size = x.shape[0]
+        if batch_size != len(adapter_ids):
+            raise ValueError(
+                f"{len(adapter_ids)} adapters for a batch of {batch_size} sequences."
+            )
+        indices = self._get_indices(x.device, state)
+        x = x.reshape(batch_size, -1, x.shape[-1])
+        delta = torch.bmm(torch.bmm(x, lora_A[indices]), lora_B[indices])
+        return output + delta.view(output.shape)
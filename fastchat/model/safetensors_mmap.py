@@ -0,0 +1,121 @@
+"""
+Zero-copy loading of safetensors files.
+
+`safe_open` maps a file into memory, so the CPU tensors it returns are views
+of the file that copy nothing and only touch the pages that are read.
+`MappedFile` also drops the pages again, to stream through files larger
+than the memory, and `write_header` lets writers stream tensors out.
+"""
+import ctypes
+import json
+import mmap
+import struct
+from typing import Dict, List, Tuple
+
+from safetensors import safe_open
+import torch
+
+# The dtype names of the safetensors format
+SAFETENSORS_DTYPE_NAMES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+
+
+def read_tensor_infos(filename: str) -> Dict[str, Tuple[torch.dtype, List[int]]]:
+    """Get the dtype and shape of every tensor of a file without reading
+    the tensors."""
+    infos = {}
+    with safe_open(filename, framework="pt") as f:
+        for name in f.keys():
+            tensor = f.get_tensor(name)
+            infos[name] = (tensor.dtype, list(tensor.shape))
+    return infos
+
+
+def load_file(
+    filename: str, device="cpu"
+) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    """Load the tensors and the metadata of a safetensors file.
+
+    CPU tensors are copy-on-write views of the memory map. The tensors of
+    other devices are copied from the map one at a time.
+    """
+    with safe_open(filename, framework="pt", device=str(device)) as f:
+        tensors = {name: f.get_tensor(name) for name in f.keys()}
+        metadata = f.metadata() or {}
+    return tensors, metadata
+
+
+def drop_pages(address: int, num_bytes: int):
+    """Drop the pages of a file mapping from memory. They are read again
+    from the file if they are used again."""
+    if not hasattr(mmap, "MADV_DONTNEED"):
+        return
+    # Only whole pages inside the range, which no other tensor uses
+    begin = -(-address // mmap.PAGESIZE) * mmap.PAGESIZE
+    end = (address + num_bytes) // mmap.PAGESIZE * mmap.PAGESIZE
+    if end > begin:
+        libc = ctypes.CDLL(None)
+        libc.madvise(
+            ctypes.c_void_p(begin), ctypes.c_size_t(end - begin), mmap.MADV_DONTNEED
+        )
+
+
+class MappedFile:
+    """A safetensors file whose tensors are read through a memory map.
+
+    `release` drops the pages of a range of a tensor after it was read, so
+    streaming through a file keeps only the range in flight in memory.
+    """
+
+    def __init__(self, filename: str):
+        self.file = safe_open(filename, framework="pt")
+        # Dict[name -> tensor], the tensors read so far
+        self.tensors = {}
+
+    def keys(self) -> List[str]:
+        return list(self.file.keys())
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        if name not in self.tensors:
+            self.tensors[name] = self.file.get_tensor(name)
+        return self.tensors[name]
+
+    def release(self, name: str, begin: int, end: int):
+        """Drop the pages of the bytes [begin, end) of a tensor from memory."""
+        drop_pages(self.get_tensor(name).data_ptr() + begin, end - begin)
+
+
+def write_header(
+    f,
+    tensors: List[Tuple[str, torch.dtype, List[int]]],
+    metadata: Dict[str, str],
+):
+    """Write the header of a safetensors file whose tensors (name, dtype,
+    shape) follow in order. The caller then writes the bytes of the tensors."""
+    header = {"__metadata__": metadata}
+    offset = 0
+    for name, dtype, shape in tensors:
+        num_bytes = (
+            torch.Size(shape).numel() * torch.empty((), dtype=dtype).element_size()
+        )
+        header[name] = {
+            "dtype": SAFETENSORS_DTYPE_NAMES[dtype],
+            "shape": list(shape),
+            "data_offsets": [offset, offset + num_bytes],
+        }
+        offset += num_bytes
+    header = json.dumps(header, separators=(",", ":")).encode()
+    # Align the data to 8 bytes, like the safetensors library.
+    header += b" " * (-len(header) % 8)
+    f.write(struct.pack("<Q", len(header)))
+    f.write(header)
@@ -115,6 +115,10 @@ class EmbeddingsRequest(BaseModel):
     engine: Optional[str] = None
     input: Union[str, List[Any]]
     user: Optional[str] = None
+    # "float" or "base64" (the little-endian bytes of the embedding)
+    encoding_format: Optional[str] = "float"
+    # Not in the OpenAI API: "float32", "float16" or "int8" (round(x * 127))
+    embedding_dtype: Optional[str] = "float32"
 
 
 class EmbeddingsResponse(BaseModel):
@@ -28,6 +28,7 @@ from cacheflow.sampling_params import SamplingParams
 from cacheflow.sequence import Sequence, SequenceGroup
 from cacheflow.utils import Counter, get_gpu_memory, get_cpu_memory
 from fastchat.constants import WORKER_HEART_BEAT_INTERVAL
+from fastchat.serve.http_client import get_session
 from fastchat.utils import build_logger, pretty_print_semaphore
 
 GB = 1 << 30
@@ -120,7 +121,7 @@ class CacheFlowWorker:
             "check_heart_beat": True,
             "worker_status": self.get_status(),
         }
-        r = requests.post(url, json=data)
+        r = get_session().post(url, json=data)
         assert r.status_code == 200
 
     def send_heart_beat(self):
@@ -134,7 +135,7 @@ class CacheFlowWorker:
 
         while True:
             try:
-                ret = requests.post(
+                ret = get_session().post(
                     url,
                     json={
                         "worker_name": self.worker_addr,
@@ -172,6 +172,7 @@ def main(args):
             args.max_new_tokens,
             chatio,
             args.debug,
+            compression_policy=args.compression_policy,
         )
     except KeyboardInterrupt:
         print("exit...")
@@ -0,0 +1,449 @@
+"""
+Iteration-level (continuous) batching for the Hugging Face inference path.
+
+A background thread owns the model and runs one forward pass per decode step
+for all in-flight requests. New requests are admitted into the running batch
+between steps and finished sequences are retired immediately, instead of
+every request running its own batch-size-1 loop in `generate_stream`.
+With LoRA adapters, the batch mixes the requests for all adapters.
+"""
+import contextlib
+import copy
+import dataclasses
+import inspect
+import queue
+import threading
+from typing import Any, Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+
+from fastchat.serve.detokenizer import IncrementalDetokenizer, StopStringMatcher
+from fastchat.serve.sampling import SamplingBatch, SamplingParams
+
+
+@dataclasses.dataclass
+class SequenceState:
+    """The decoding state of one request inside the running batch."""
+
+    params: Dict[str, Any]
+    sampling_params: SamplingParams
+    max_new_tokens: int
+    detokenizer: IncrementalDetokenizer
+    stop_matcher: StopStringMatcher
+    stop_token_ids: List[int]
+    input_ids: List[int]
+    input_echo_len: int
+    output_ids: List[int]
+    stream_interval: int
+    outputs: queue.Queue = dataclasses.field(default_factory=queue.Queue)
+    # Number of tokens held in the kv cache for this sequence
+    cache_len: int = 0
+    # The kv cache of a newly admitted sequence, until it is merged into the batch
+    past_key_values: Optional[tuple] = None
+    # The id of the blocks reserved in the paged kv cache
+    seq_id: Optional[str] = None
+    # The index of the completion when a request samples n > 1 completions
+    index: Optional[int] = None
+    # The LoRA adapter of the request, 0 for the base model
+    adapter_id: int = 0
+    step: int = 0
+    output: str = ""
+    finished: bool = False
+    cancelled: bool = False
+
+
+def _pad_past_key_values(past_key_values, length):
+    """Left-pad every key/value tensor along the sequence dimension."""
+    pad_len = length - past_key_values[0][0].shape[-2]
+    if pad_len == 0:
+        return past_key_values
+    return tuple(
+        tuple(F.pad(t, (0, 0, pad_len, 0)) for t in layer) for layer in past_key_values
+    )
+
+
+class ContinuousBatchingEngine:
+    """Run all in-flight requests of a decoder-only model as one batch."""
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        device,
+        max_batch_size=8,
+        kv_budget=None,
+        prefix_cache=None,
+        lora=None,
+    ):
+        if model.config.is_encoder_decoder:
+            raise ValueError("Continuous batching only supports decoder-only models.")
+        if "position_ids" not in inspect.signature(model.forward).parameters:
+            raise ValueError(
+                "Continuous batching requires a model that accepts position_ids."
+            )
+
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        # An optional KVCacheBudget used for admission control
+        self.kv_budget = kv_budget
+        # An optional PrefixCache to skip the prefill of cached prompt prefixes
+        self.prefix_cache = prefix_cache
+        # An optional MultiLoRA that picks the adapter of every request
+        self.lora = lora
+
+        # Groups of sequences that sample the same prompt
+        self.waiting = queue.Queue()
+        # A group that does not fit in the kv cache until others finish
+        self.blocked = None
+        self.running: List[SequenceState] = []
+        # The left-padded kv cache and attention mask of the running batch
+        self.past_key_values = None
+        self.attention_mask = None
+        # The sampling state of the running batch, in the same order
+        self.sampler: Optional[SamplingBatch] = None
+
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def generate_stream(
+        self, model, tokenizer, params, device, context_len=2048, stream_interval=2
+    ):
+        """A drop-in replacement for `inference.generate_stream`.
+
+        The model, tokenizer and device are the ones the engine was built with.
+        With `n` > 1 the completions share one prefill and every frame has the
+        `index` of its completion.
+        """
+        seq = self._create_sequence(params, context_len, stream_interval)
+        n = int(params.get("n", 1))
+        if n > 1:
+            seq.index = 0
+        group = [seq] + [self._fork_sequence(seq, i) for i in range(1, n)]
+        self.waiting.put(group)
+        num_finished = 0
+        try:
+            while num_finished < n:
+                item = seq.outputs.get()
+                if item is None:
+                    num_finished += 1
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # The client may go away before the sequences are finished.
+            for seq in group:
+                seq.cancelled = True
+
+    def get_num_running(self):
+        return len(self.running)
+
+    def _create_sequence(self, params, context_len, stream_interval):
+        prompt = params["prompt"]
+        max_new_tokens = int(params.get("max_new_tokens", 256))
+        stop_token_ids = params.get("stop_token_ids", None) or []
+        stop_token_ids.append(self.tokenizer.eos_token_id)
+
+        input_ids = self.tokenizer(prompt).input_ids
+        input_echo_len = len(input_ids)
+        max_src_len = context_len - max_new_tokens - 8
+
+        stop_str = params.get("stop", None)
+        if bool(params.get("echo", True)):
+            detokenizer = IncrementalDetokenizer(self.tokenizer)
+            stop_matcher = StopStringMatcher(stop_str, len(prompt))
+        else:
+            detokenizer = IncrementalDetokenizer(self.tokenizer, input_echo_len)
+            stop_matcher = StopStringMatcher(stop_str)
+
+        adapter_id = 0
+        if self.lora is not None:
+            adapter_id = self.lora.get_adapter_id(params.get("model", None))
+
+        return SequenceState(
+            params=params,
+            sampling_params=SamplingParams.from_params(params),
+            max_new_tokens=max_new_tokens,
+            detokenizer=detokenizer,
+            stop_matcher=stop_matcher,
+            stop_token_ids=stop_token_ids,
+            input_ids=input_ids[-max_src_len:],
+            input_echo_len=input_echo_len,
+            output_ids=list(input_ids),
+            stream_interval=stream_interval,
+            adapter_id=adapter_id,
+        )
+
+    @staticmethod
+    def _fork_sequence(seq, index):
+        """Create another completion of the same prompt with a shared output queue."""
+        return dataclasses.replace(
+            seq,
+            output_ids=list(seq.output_ids),
+            detokenizer=copy.copy(seq.detokenizer),
+            stop_matcher=copy.copy(seq.stop_matcher),
+            index=index,
+        )
+
+    def _loop(self):
+        while True:
+            try:
+                self._admit_sequences()
+                if self.running:
+                    self._decode_step()
+            except Exception as e:
+                # Fail every in-flight request and start over with a clean batch.
+                for seq in self.running:
+                    seq.outputs.put(e)
+                    self._release(seq)
+                self.running = []
+                self.past_key_values = self.attention_mask = self.sampler = None
+
+    @torch.inference_mode()
+    def _admit_sequences(self):
+        new_seqs, new_samplers = [], []
+        # Block only when there is nothing to decode.
+        block = not self.running
+        while len(self.running) + len(new_seqs) < self.max_batch_size:
+            if self.blocked is not None:
+                group, self.blocked = self.blocked, None
+            else:
+                try:
+                    group = self.waiting.get(block=block)
+                except queue.Empty:
+                    break
+            block = False
+            seq = group[0]
+            if seq.cancelled:
+                continue
+            if self.kv_budget is not None:
+                num_tokens = len(seq.input_ids) + seq.max_new_tokens
+                if not self.kv_budget.can_allocate(num_tokens * len(group)) and (
+                    self.running or new_seqs
+                ):
+                    # Wait until the running sequences free their blocks.
+                    self.blocked = group
+                    break
+            try:
+                if self.kv_budget is not None:
+                    seq.seq_id = self.kv_budget.allocate(num_tokens)
+                    # The completions share the blocks of the prompt.
+                    for sibling in group[1:]:
+                        sibling.seq_id = self.kv_budget.fork(
+                            seq.seq_id, num_tokens, len(seq.input_ids)
+                        )
+                logits = self._prefill(seq)
+                sampler = SamplingBatch(logits.shape[-1], logits.device)
+                sampler.add(seq.sampling_params, seq.output_ids, len(group))
+                tokens = sampler.sample(logits.expand(len(group), -1))
+                for sibling, token in zip(group, tokens):
+                    sibling.past_key_values = seq.past_key_values
+                    sibling.cache_len = seq.cache_len
+                    self._process_token(sibling, token)
+            except Exception as e:
+                for sibling in group:
+                    sibling.outputs.put(e)
+                    self._release(sibling)
+                continue
+            keep = []
+            for row, sibling in enumerate(group):
+                if sibling.finished:
+                    self._finish(sibling)
+                    self._cache_prefix(sibling, sibling.past_key_values)
+                    self._release(sibling)
+                else:
+                    new_seqs.append(sibling)
+                    keep.append(row)
+            if keep:
+                new_samplers.append(sampler.select(keep))
+
+        if new_seqs:
+            try:
+                self._merge(new_seqs, new_samplers)
+            except Exception as e:
+                for seq in new_seqs:
+                    seq.outputs.put(e)
+                    self._release(seq)
+                raise
+
+    def _use_adapters(self, seqs):
+        if self.lora is None:
+            return contextlib.nullcontext()
+        return self.lora.use_adapters([seq.adapter_id for seq in seqs])
+
+    def _prefill(self, seq):
+        num_cached, past_key_values = 0, None
+        if self.prefix_cache is not None:
+            num_cached, past_key_values = self.prefix_cache.match(
+                seq.input_ids, seq.adapter_id
+            )
+        with self._use_adapters([seq]):
+            out = self.model(
+                torch.as_tensor([seq.input_ids[num_cached:]], device=self.device),
+                use_cache=True,
+                past_key_values=past_key_values,
+            )
+        seq.past_key_values = out.past_key_values
+        if seq.past_key_values[0][0].dim() != 4:
+            raise ValueError(
+                "Continuous batching does not support the kv cache layout of this model."
+            )
+        seq.cache_len = len(seq.input_ids)
+        return out.logits[:, -1, :]
+
+    def _merge(self, new_seqs, new_samplers):
+        """Add newly prefilled sequences and their sampling state to the
+        running batch."""
+        max_len = max(seq.cache_len for seq in self.running + new_seqs)
+
+        pasts, masks = [], []
+        if self.running:
+            pasts.append(_pad_past_key_values(self.past_key_values, max_len))
+            pad_len = max_len - self.attention_mask.shape[1]
+            masks.append(F.pad(self.attention_mask, (pad_len, 0)))
+        for seq in new_seqs:
+            pasts.append(_pad_past_key_values(seq.past_key_values, max_len))
+            mask = torch.zeros((1, max_len), dtype=torch.long, device=self.device)
+            mask[:, max_len - seq.cache_len :] = 1
+            masks.append(mask)
+            seq.past_key_values = None
+
+        self.past_key_values = tuple(
+            tuple(torch.cat([p[i][j] for p in pasts]) for j in range(len(layer)))
+            for i, layer in enumerate(pasts[0])
+        )
+        self.attention_mask = torch.cat(masks)
+        if self.running:
+            new_samplers = [self.sampler] + new_samplers
+        self.sampler = SamplingBatch.cat(new_samplers)
+        self.running.extend(new_seqs)
+
+    def _retire(self):
+        """Drop finished sequences from the running batch."""
+        keep = [i for i, seq in enumerate(self.running) if not seq.finished]
+        if len(keep) == len(self.running):
+            return
+
+        max_len = self.attention_mask.shape[1]
+        for i, seq in enumerate(self.running):
+            if seq.finished:
+                if not seq.cancelled:
+                    past_key_values = tuple(
+                        tuple(
+                            t[i : i + 1, :, max_len - seq.cache_len :, :] for t in layer
+                        )
+                        for layer in self.past_key_values
+                    )
+                    self._cache_prefix(seq, past_key_values)
+                self._release(seq)
+
+        self.running = [self.running[i] for i in keep]
+        if not self.running:
+            self.past_key_values = self.attention_mask = self.sampler = None
+            return
+
+        # Also drop the leading columns that are padding for every sequence.
+        max_len = max(seq.cache_len for seq in self.running)
+        start = self.attention_mask.shape[1] - max_len
+        index = torch.as_tensor(keep, device=self.attention_mask.device)
+        self.past_key_values = tuple(
+            tuple(t.index_select(0, index)[:, :, start:, :] for t in layer)
+            for layer in self.past_key_values
+        )
+        self.attention_mask = self.attention_mask.index_select(0, index)[:, start:]
+        self.sampler = self.sampler.select(keep)
+
+    @torch.inference_mode()
+    def _decode_step(self):
+        for seq in self.running:
+            if seq.cancelled:
+                seq.finished = True
+        self._retire()
+        if not self.running:
+            return
+
+        input_ids = torch.as_tensor(
+            [[seq.output_ids[-1]] for seq in self.running], device=self.device
+        )
+        position_ids = torch.as_tensor(
+            [[seq.cache_len] for seq in self.running], device=self.device
+        )
+        self.attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        with self._use_adapters(self.running):
+            out = self.model(
+                input_ids=input_ids,
+                attention_mask=self.attention_mask,
+                position_ids=position_ids,
+                past_key_values=self.past_key_values,
+                use_cache=True,
+            )
+        self.past_key_values = out.past_key_values
+
+        tokens = self.sampler.sample(out.logits[:, -1, :])
+        for seq, token in zip(self.running, tokens):
+            seq.cache_len += 1
+            seq.step += 1
+            self._process_token(seq, token)
+            if seq.finished:
+                self._finish(seq)
+        self._retire()
+
+    def _process_token(self, seq, token):
+        """Append the sampled token to a sequence and stream the output."""
+        seq.output_ids.append(token)
+        stopped = token in seq.stop_token_ids
+
+        i = seq.step
+        if i % seq.stream_interval == 0 or i == seq.max_new_tokens - 1 or stopped:
+            output, stop_hit, partially_stopped = seq.stop_matcher.match(
+                seq.detokenizer.decode(seq.output_ids),
+                seq.detokenizer.num_stable_chars,
+            )
+            stopped = stopped or stop_hit
+            seq.output = output
+
+            # prevent yielding partial stop sequence
+            if not partially_stopped:
+                seq.outputs.put(self._get_frame(seq, output, None))
+
+        seq.finished = stopped or i == seq.max_new_tokens - 1
+
+    def _finish(self, seq):
+        # finish stream event, which contains finish reason
+        if seq.step == seq.max_new_tokens - 1:
+            finish_reason = "length"
+        else:
+            finish_reason = "stop"
+        seq.outputs.put(self._get_frame(seq, seq.output, finish_reason))
+        seq.outputs.put(None)
+
+    def _cache_prefix(self, seq, past_key_values):
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(
+                seq.input_ids + seq.output_ids[seq.input_echo_len :],
+                past_key_values,
+                seq.adapter_id,
+            )
+
+    def _release(self, seq):
+        if self.kv_budget is not None and seq.seq_id is not None:
+            self.kv_budget.free(seq.seq_id)
+            seq.seq_id = None
+
+    @staticmethod
+    def _get_frame(seq, text, finish_reason):
+        frame = {
+            "text": text,
+            "usage": {
+                "prompt_tokens": seq.input_echo_len,
+                "completion_tokens": seq.step,
+                "total_tokens": seq.input_echo_len + seq.step,
+            },
+            "finish_reason": finish_reason,
+        }
+        if seq.index is not None:
+            frame["index"] = seq.index
+        return frame
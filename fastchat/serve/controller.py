@@ -9,17 +9,32 @@ from enum import Enum, auto
 import json
 import logging
 import time
-from typing import List, Union
+from typing import List, Optional, Union
 import threading
 
 from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import httpx
 import numpy as np
-import requests
 import uvicorn
 
-from fastchat.constants import (CONTROLLER_HEART_BEAT_EXPIRATION, ErrorCode,
-    SERVER_ERROR_MSG)
+from fastchat.constants import (
+    CONTROLLER_HEART_BEAT_EXPIRATION,
+    ErrorCode,
+    ROUTING_TABLE_POLL_TIMEOUT,
+    SERVER_ERROR_MSG,
+)
+from fastchat.serve.http_client import close_async_client, get_async_client
+from fastchat.serve.stream_protocol import (
+    STREAM_HEADER_LEN,
+    StreamEncoder,
+    encode_json_frame,
+)
+from fastchat.serve.worker_load import (
+    estimate_num_tokens,
+    get_token_budget_index,
+    get_warm_workers,
+)
 from fastchat.utils import build_logger
 
 
@@ -29,6 +44,7 @@ logger = build_logger("controller", "controller.log")
 class DispatchMethod(Enum):
     LOTTERY = auto()
     SHORTEST_QUEUE = auto()
+    TOKEN_BUDGET = auto()
 
     @classmethod
     def from_str(cls, name):
@@ -36,6 +52,8 @@ class DispatchMethod(Enum):
             return cls.LOTTERY
         elif name == "shortest_queue":
             return cls.SHORTEST_QUEUE
+        elif name == "token_budget":
+            return cls.TOKEN_BUDGET
         else:
             raise ValueError(f"Invalid dispatch method")
 
@@ -47,6 +65,13 @@ class WorkerInfo:
     queue_length: int
     check_heart_beat: bool
     last_heart_beat: str
+    context_length: Optional[int] = None
+    # The load signals for token-budget dispatch
+    outstanding_tokens: int = 0
+    tokens_per_second: Optional[float] = None
+    free_kv_tokens: Optional[int] = None
+    # The models on the device of a multi-model worker, None for all
+    warm_models: Optional[List[str]] = None
 
 
 def heart_beat_controller(controller):
@@ -58,8 +83,21 @@ def heart_beat_controller(controller):
 class Controller:
     def __init__(self, dispatch_method: str):
         # Dict[str -> WorkerInfo]
+        # The dict and its WorkerInfo are never modified in place. Writers
+        # replace the dict under the lock, so readers can iterate over
+        # `self.worker_info` as a consistent snapshot without locking.
         self.worker_info = {}
+        self.lock = threading.RLock()
         self.dispatch_method = DispatchMethod.from_str(dispatch_method)
+        # Bumped whenever workers join, leave or change their warm models, so
+        # that clients caching the routing table know when to refresh it.
+        self.routing_version = 0
+        # Bumped whenever a heart beat changes the load of a worker
+        self.load_version = 0
+        # Set and replaced on every change of the versions, to wake up the
+        # long polls of the routing table. Both live on the event loop.
+        self.routing_changed = None
+        self.event_loop = None
 
         self.heart_beat_thread = threading.Thread(
             target=heart_beat_controller, args=(self,)
@@ -68,7 +106,70 @@ class Controller:
 
         logger.info("Init controller")
 
-    def register_worker(
+    def _update_worker_info(
+        self, worker_name: str, *, notify: bool = True, **changes
+    ) -> bool:
+        """Update the info of a worker. With `notify`, a changed load or set
+        of warm models bumps the routing table versions and wakes up the
+        long polls."""
+        with self.lock:
+            if worker_name not in self.worker_info:
+                return False
+            worker_info = dict(self.worker_info)
+            old_info = worker_info[worker_name]
+            new_info = dataclasses.replace(old_info, **changes)
+            worker_info[worker_name] = new_info
+            self.worker_info = worker_info
+            if not notify:
+                return True
+            # Routers prefer the workers that have a model warm.
+            if new_info.warm_models != old_info.warm_models:
+                self.routing_version += 1
+            elif (
+                dataclasses.replace(new_info, last_heart_beat=old_info.last_heart_beat)
+                != old_info
+            ):
+                self.load_version += 1
+            else:
+                return True
+            self._notify_routing_change()
+        return True
+
+    def _notify_routing_change(self):
+        """Wake up the long polls of the routing table. Can be called from
+        any thread."""
+        if self.event_loop is not None:
+            self.event_loop.call_soon_threadsafe(self._set_routing_changed)
+
+    def _set_routing_changed(self):
+        routing_changed, self.routing_changed = self.routing_changed, asyncio.Event()
+        routing_changed.set()
+
+    async def wait_for_routing_change(
+        self, version: Optional[int], load_version: Optional[int], timeout: float
+    ):
+        """Wait up to `timeout` seconds until the routing table is newer than
+        `version`, or than `load_version` if it is given."""
+        if self.routing_changed is None:
+            self.event_loop = asyncio.get_running_loop()
+            self.routing_changed = asyncio.Event()
+
+        def is_current():
+            if load_version is not None and load_version != self.load_version:
+                return False
+            return version == self.routing_version
+
+        deadline = self.event_loop.time() + timeout
+        while is_current():
+            remaining = deadline - self.event_loop.time()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self.routing_changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+    async def register_worker(
         self, worker_name: str, check_heart_beat: bool, worker_status: dict
     ):
         if worker_name not in self.worker_info:
@@ -77,25 +178,42 @@ class Controller:
             logger.info(f"Register an existing worker: {worker_name}")
 
         if not worker_status:
-            worker_status = self.get_worker_status(worker_name)
+            worker_status = await self.get_worker_status(worker_name)
         if not worker_status:
             return False
 
-        self.worker_info[worker_name] = WorkerInfo(
+        w_info = WorkerInfo(
             worker_status["model_names"],
             worker_status["speed"],
             worker_status["queue_length"],
             check_heart_beat,
             time.time(),
+            worker_status.get("context_length", None),
+            **self._get_load(worker_status),
         )
+        with self.lock:
+            self.worker_info = {**self.worker_info, worker_name: w_info}
+            self.routing_version += 1
+            self._notify_routing_change()
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
         return True
 
-    def get_worker_status(self, worker_name: str):
+    @staticmethod
+    def _get_load(load: dict):
+        return {
+            "outstanding_tokens": load.get("outstanding_tokens", 0),
+            "tokens_per_second": load.get("tokens_per_second", None),
+            "free_kv_tokens": load.get("free_kv_tokens", None),
+            "warm_models": load.get("warm_models", None),
+        }
+
+    async def get_worker_status(self, worker_name: str):
         try:
-            r = requests.post(worker_name + "/worker_get_status", timeout=5)
-        except requests.exceptions.RequestException as e:
+            r = await get_async_client().post(
+                worker_name + "/worker_get_status", timeout=5
+            )
+        except httpx.HTTPError as e:
             logger.error(f"Get status fails: {worker_name}, {e}")
             return None
 
@@ -106,14 +224,34 @@ class Controller:
         return r.json()
 
     def remove_worker(self, worker_name: str):
-        del self.worker_info[worker_name]
-
-    def refresh_all_workers(self):
-        old_info = dict(self.worker_info)
-        self.worker_info = {}
-
-        for w_name, w_info in old_info.items():
-            if not self.register_worker(w_name, w_info.check_heart_beat, None):
+        self.remove_workers([worker_name])
+
+    def remove_workers(self, worker_names: List[str]):
+        with self.lock:
+            self.worker_info = {
+                w_name: w_info
+                for w_name, w_info in self.worker_info.items()
+                if w_name not in worker_names
+            }
+            self.routing_version += 1
+            self._notify_routing_change()
+
+    async def refresh_all_workers(self):
+        with self.lock:
+            old_info = self.worker_info
+            self.worker_info = {}
+            self.routing_version += 1
+            self._notify_routing_change()
+
+        # Query all workers at once, so that a slow worker only costs its
+        # own timeout.
+        worker_statuses = await asyncio.gather(
+            *[self.get_worker_status(w_name) for w_name in old_info]
+        )
+        for (w_name, w_info), worker_status in zip(old_info.items(), worker_statuses):
+            if not worker_status or not await self.register_worker(
+                w_name, w_info.check_heart_beat, worker_status
+            ):
                 logger.info(f"Remove stale worker: {w_name}")
 
     def list_models(self):
@@ -124,14 +262,42 @@ class Controller:
 
         return list(model_names)
 
-    def get_worker_address(self, model_name: str):
+    def get_routing_table(self):
+        with self.lock:
+            worker_info, version = self.worker_info, self.routing_version
+            load_version = self.load_version
+        return {
+            "version": version,
+            "load_version": load_version,
+            "dispatch_method": self.dispatch_method.name.lower(),
+            "workers": {
+                w_name: dataclasses.asdict(w_info)
+                for w_name, w_info in worker_info.items()
+            },
+        }
+
+    @staticmethod
+    def _get_model_workers(worker_info, model_name: str) -> List[str]:
+        """Get the workers of a model, preferring the ones that have it on
+        the device."""
+        worker_names = [
+            w_name
+            for w_name, w_info in worker_info.items()
+            if model_name in w_info.model_names
+        ]
+        return get_warm_workers(
+            worker_names,
+            [worker_info[w_name].warm_models for w_name in worker_names],
+            model_name,
+        )
+
+    async def get_worker_address(self, model_name: str, num_tokens: int = 0):
+        """Pick a worker for a model. Token-budget dispatch also takes the
+        (estimated) prompt and generation tokens of the request."""
+        worker_info = self.worker_info
         if self.dispatch_method == DispatchMethod.LOTTERY:
-            worker_names = []
-            worker_speeds = []
-            for w_name, w_info in self.worker_info.items():
-                if model_name in w_info.model_names:
-                    worker_names.append(w_name)
-                    worker_speeds.append(w_info.speed)
+            worker_names = self._get_model_workers(worker_info, model_name)
+            worker_speeds = [worker_info[w_name].speed for w_name in worker_names]
             worker_speeds = np.array(worker_speeds, dtype=np.float32)
             norm = np.sum(worker_speeds)
             if norm < 1e-4:
@@ -147,7 +313,7 @@ class Controller:
                 pt = np.random.choice(np.arange(len(worker_names)), p=worker_speeds)
                 worker_name = worker_names[pt]
 
-                if self.get_worker_status(worker_name):
+                if await self.get_worker_status(worker_name):
                     break
                 else:
                     self.remove_worker(worker_name)
@@ -159,31 +325,74 @@ class Controller:
                     continue
             return worker_name
         elif self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
-            worker_names = []
-            worker_qlen = []
-            for w_name, w_info in self.worker_info.items():
-                if model_name in w_info.model_names:
-                    worker_names.append(w_name)
-                    worker_qlen.append(w_info.queue_length / w_info.speed)
+            worker_names = self._get_model_workers(worker_info, model_name)
+            worker_qlen = [
+                worker_info[w_name].queue_length / worker_info[w_name].speed
+                for w_name in worker_names
+            ]
             if len(worker_names) == 0:
                 return ""
             min_index = np.argmin(worker_qlen)
             w_name = worker_names[min_index]
-            self.worker_info[w_name].queue_length += 1
+            with self.lock:
+                if w_name in self.worker_info:
+                    self._update_worker_info(
+                        w_name,
+                        notify=False,
+                        queue_length=self.worker_info[w_name].queue_length + 1,
+                    )
             logger.info(
                 f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}"
             )
             return w_name
+        elif self.dispatch_method == DispatchMethod.TOKEN_BUDGET:
+            worker_names = self._get_model_workers(worker_info, model_name)
+            if len(worker_names) == 0:
+                return ""
+            w_infos = [worker_info[w_name] for w_name in worker_names]
+            index = get_token_budget_index(
+                [w_info.outstanding_tokens for w_info in w_infos],
+                [w_info.tokens_per_second for w_info in w_infos],
+                [w_info.free_kv_tokens for w_info in w_infos],
+                num_tokens,
+            )
+            w_name = worker_names[index]
+            # Count the request until the next heart beat brings the real
+            # load. Only heart beats wake up the routers, not every request.
+            with self.lock:
+                if w_name in self.worker_info:
+                    w_info = self.worker_info[w_name]
+                    self._update_worker_info(
+                        w_name,
+                        notify=False,
+                        outstanding_tokens=w_info.outstanding_tokens + num_tokens,
+                        free_kv_tokens=None
+                        if w_info.free_kv_tokens is None
+                        else w_info.free_kv_tokens - num_tokens,
+                    )
+            logger.info(
+                f"names: {worker_names}, "
+                f"outstanding_tokens: {[w.outstanding_tokens for w in w_infos]}, "
+                f"tokens_per_second: {[w.tokens_per_second for w in w_infos]}, "
+                f"ret: {w_name}"
+            )
+            return w_name
         else:
             raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
 
-    def receive_heart_beat(self, worker_name: str, queue_length: int):
-        if worker_name not in self.worker_info:
+    def receive_heart_beat(
+        self, worker_name: str, queue_length: int, load: Optional[dict] = None
+    ):
+        changes = self._get_load(load) if load is not None else {}
+        if not self._update_worker_info(
+            worker_name,
+            queue_length=queue_length,
+            last_heart_beat=time.time(),
+            **changes,
+        ):
             logger.info(f"Receive unknown heart beat. {worker_name}")
             return False
 
-        self.worker_info[worker_name].queue_length = queue_length
-        self.worker_info[worker_name].last_heart_beat = time.time()
         logger.info(f"Receive heart beat. {worker_name}")
         return True
 
@@ -194,82 +403,103 @@ class Controller:
             if w_info.check_heart_beat and w_info.last_heart_beat < expire:
                 to_delete.append(worker_name)
 
-        for worker_name in to_delete:
-            self.remove_worker(worker_name)
+        if to_delete:
+            self.remove_workers(to_delete)
 
+    @staticmethod
     def handle_no_worker(params):
         logger.info(f"no worker: {params['model']}")
         ret = {
             "text": SERVER_ERROR_MSG,
             "error_code": ErrorCode.CONTROLLER_NO_WORKER,
         }
-        return json.dumps(ret).encode() + b"\0"
+        return ret
 
+    @staticmethod
     def handle_worker_timeout(worker_address):
         logger.info(f"worker timeout: {worker_address}")
         ret = {
             "text": SERVER_ERROR_MSG,
             "error_code": ErrorCode.CONTROLLER_WORKER_TIMEOUT,
         }
-        return json.dumps(ret).encode() + b"\0"
+        return ret
 
-    def worker_api_generate_stream(self, params):
-        worker_addr = self.get_worker_address(params["model"])
+    async def worker_api_generate_stream(self, params):
+        worker_addr = await self.get_worker_address(
+            params["model"], estimate_num_tokens(params)
+        )
         if not worker_addr:
-            yield self.handle_no_worker(params)
+            yield encode_json_frame(self.handle_no_worker(params))
+            return
 
+        # The first bytes tell the format of the stream, so that an error can
+        # be appended in the same format.
+        head = b""
         try:
-            response = requests.post(
+            async with get_async_client().stream(
+                "POST",
                 worker_addr + "/worker_generate_stream",
                 json=params,
-                stream=True,
                 timeout=15,
-            )
-            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-                if chunk:
-                    yield chunk + b"\0"
-        except requests.exceptions.RequestException as e:
-            yield self.handle_worker_timeout(worker_addr)
-
-    def worker_api_generate_completion(self, params):
-        worker_addr = self.get_worker_address(params["model"])
+            ) as response:
+                async for chunk in response.aiter_bytes():
+                    if len(head) < STREAM_HEADER_LEN:
+                        head += chunk[: STREAM_HEADER_LEN - len(head)]
+                    yield chunk
+        except httpx.HTTPError as e:
+            ret = self.handle_worker_timeout(worker_addr)
+            encoder = StreamEncoder.from_header(head)
+            yield encoder.encode(ret) if encoder is not None else encode_json_frame(ret)
+
+    async def worker_api_generate_completion(self, params):
+        return await self._forward_to_worker(
+            params, "/worker_generate_completion", estimate_num_tokens(params)
+        )
+
+    async def worker_api_embeddings(self, params):
+        """Forward the response as it is, which may be in the binary format."""
+        worker_addr = await self.get_worker_address(params["model"])
         if not worker_addr:
-            return self.handle_no_worker(params)
+            return JSONResponse(self.handle_no_worker(params))
 
         try:
-            response = requests.post(
-                worker_addr + "/worker_generate_completion",
+            response = await get_async_client().post(
+                worker_addr + "/worker_get_embeddings",
                 json=params,
                 timeout=15,
             )
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            return self.handle_worker_timeout(worker_addr)
+        except httpx.HTTPError as e:
+            return JSONResponse(self.handle_worker_timeout(worker_addr))
+        return Response(
+            response.content, media_type=response.headers.get("content-type")
+        )
 
-    def worker_api_embeddings(self, params):
-        worker_addr = self.get_worker_address(params["model"])
+    async def _forward_to_worker(self, params, path, num_tokens=0):
+        worker_addr = await self.get_worker_address(params["model"], num_tokens)
         if not worker_addr:
             return self.handle_no_worker(params)
 
         try:
-            response = requests.post(
-                worker_addr + "/worker_get_embeddings",
+            response = await get_async_client().post(
+                worker_addr + path,
                 json=params,
                 timeout=15,
             )
             return response.json()
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             return self.handle_worker_timeout(worker_addr)
 
     # Let the controller act as a worker to achieve hierarchical
     # management. This can be used to connect isolated sub networks.
-    def worker_api_get_status(self):
+    async def worker_api_get_status(self):
         model_names = set()
         speed = 0
         queue_length = 0
 
-        for w_name in self.worker_info:
-            worker_status = self.get_worker_status(w_name)
+        worker_statuses = await asyncio.gather(
+            *[self.get_worker_status(w_name) for w_name in self.worker_info]
+        )
+        for worker_status in worker_statuses:
             if worker_status is not None:
                 model_names.update(worker_status["model_names"])
                 speed += worker_status["speed"]
@@ -285,17 +515,22 @@ class Controller:
 app = FastAPI()
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_async_client()
+
+
 @app.post("/register_worker")
 async def register_worker(request: Request):
     data = await request.json()
-    controller.register_worker(
+    await controller.register_worker(
         data["worker_name"], data["check_heart_beat"], data.get("worker_status", None)
     )
 
 
 @app.post("/refresh_all_workers")
 async def refresh_all_workers():
-    models = controller.refresh_all_workers()
+    await controller.refresh_all_workers()
 
 
 @app.post("/list_models")
@@ -307,14 +542,32 @@ async def list_models():
 @app.post("/get_worker_address")
 async def get_worker_address(request: Request):
     data = await request.json()
-    addr = controller.get_worker_address(data["model"])
+    addr = await controller.get_worker_address(data["model"], data.get("num_tokens", 0))
     return {"address": addr}
 
 
+@app.post("/get_routing_table")
+async def get_routing_table(request: Request):
+    """Long poll the routing table.
+
+    If the client already has the current `version` (and `load_version`),
+    wait up to `timeout` seconds for a worker to join, leave or report a new
+    load before answering.
+    """
+    data = await request.json()
+    timeout = min(float(data.get("timeout", 0)), ROUTING_TABLE_POLL_TIMEOUT)
+    await controller.wait_for_routing_change(
+        data.get("version", None), data.get("load_version", None), timeout
+    )
+    return controller.get_routing_table()
+
+
 @app.post("/receive_heart_beat")
 async def receive_heart_beat(request: Request):
     data = await request.json()
-    exist = controller.receive_heart_beat(data["worker_name"], data["queue_length"])
+    exist = controller.receive_heart_beat(
+        data["worker_name"], data["queue_length"], data.get("load", None)
+    )
     return {"exist": exist}
 
 
@@ -328,20 +581,20 @@ async def worker_api_generate_stream(request: Request):
 @app.post("/worker_generate_completion")
 async def worker_api_generate_completion(request: Request):
     params = await request.json()
-    output = controller.worker_api_generate_completion(params)
+    output = await controller.worker_api_generate_completion(params)
     return output
 
 
 @app.post("/worker_get_embeddings")
 async def worker_api_embeddings(request: Request):
     params = await request.json()
-    output = controller.worker_api_embeddings(params)
+    output = await controller.worker_api_embeddings(params)
     return output
 
 
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
-    return controller.worker_api_get_status()
+    return await controller.worker_api_get_status()
 
 
 if __name__ == "__main__":
@@ -351,7 +604,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--dispatch-method",
         type=str,
-        choices=["lottery", "shortest_queue"],
+        choices=["lottery", "shortest_queue", "token_budget"],
         default="shortest_queue",
     )
     args = parser.parse_args()
@@ -0,0 +1,158 @@
+"""
+Incremental detokenization and stop string matching for streaming generation.
+
+Decoding all output ids and searching the whole text for every stop string at
+each streaming step costs O(n^2) over a response. The helpers here only decode
+a window around the new tokens and only scan the new suffix of the text, while
+producing exactly the same text as a full `tokenizer.decode`.
+"""
+from typing import Iterable, List
+
+# `clean_up_tokenization` only removes the space before a few punctuation
+# marks and contractions. Every rule starts with a space and spans at most
+# this many characters, so it never spans a position that follows this many
+# minus one non-space characters.
+CLEAN_UP_RULE_LEN = 4
+
+
+def partial_stop(output, stop_str):
+    """Check whether the output ends with a non-empty prefix of the stop string."""
+    num_chars = min(len(output), len(stop_str))
+    if num_chars == 0:
+        return False
+    # The whole output is a prefix of the stop string.
+    if len(output) <= len(stop_str) and stop_str.startswith(output):
+        return True
+    for i in range(1, num_chars):
+        if stop_str.startswith(output[-i:]):
+            return True
+    return False
+
+
+class IncrementalDetokenizer:
+    """Decode a growing list of token ids by only decoding the new tokens.
+
+    Every call decodes the tokens after the last committed position together
+    with the previous chunk of tokens as context, so that the whitespace and
+    byte handling at the start of the window matches a full decode. A window
+    ending with an incomplete character is not committed until more tokens
+    arrive. Tokenization spaces are only cleaned up after the cleaned prefix
+    of the committed text.
+    """
+
+    def __init__(self, tokenizer, start=0):
+        self.tokenizer = tokenizer
+        # Only token_ids[start:] are decoded
+        self.start = start
+        self.clean_up_tokenization_spaces = getattr(
+            tokenizer, "clean_up_tokenization_spaces", True
+        )
+        # The raw text of token_ids[start:read_offset]
+        self.text = ""
+        self.prefix_offset = start
+        self.read_offset = start
+        # The length of the returned text that no later token can change
+        self.num_stable_chars = 0
+        # The cleaned up text of self.text[:clean_offset]
+        self.clean_text = ""
+        self.clean_offset = 0
+
+    def _decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(
+            token_ids,
+            skip_special_tokens=True,
+            spaces_between_special_tokens=False,
+            clean_up_tokenization_spaces=False,
+        )
+
+    def decode(self, token_ids: List[int]) -> str:
+        """Return the same text as decoding `token_ids[start:]` at once."""
+        if self.read_offset == self.start:
+            text, tail = "", self._decode(token_ids[self.start :])
+        else:
+            prefix_text = self._decode(token_ids[self.prefix_offset : self.read_offset])
+            new_text = self._decode(token_ids[self.prefix_offset :])
+            if new_text.startswith(prefix_text):
+                text, tail = self.text, new_text[len(prefix_text) :]
+            else:
+                # The new tokens changed the decoding of the context window.
+                text, tail = "", self._decode(token_ids[self.start :])
+                self.clean_text, self.clean_offset = "", 0
+
+        if len(token_ids) > self.read_offset and not tail.endswith("\ufffd"):
+            self.text = text = text + tail
+            # Sentencepiece drops all leading spaces of a decode, so a context
+            # window of whitespace only would not anchor the next tokens.
+            if tail.strip():
+                self.prefix_offset = self.read_offset
+            self.read_offset = len(token_ids)
+            tail = ""
+
+        output = text + tail
+        if self.clean_up_tokenization_spaces:
+            output = self._clean_up(output, len(text))
+        self.num_stable_chars = max(len(output) - len(tail), 0)
+        return output
+
+    def _clean_up(self, output: str, num_committed_chars: int) -> str:
+        """Clean up the tokenization spaces of `output`, whose first
+        `num_committed_chars` characters are committed text."""
+        clean_up = self.tokenizer.clean_up_tokenization
+        # Extend the cleaned prefix to the last position of the committed text
+        # that no clean-up rule can span.
+        min_cut = max(self.clean_offset, CLEAN_UP_RULE_LEN - 2)
+        for cut in range(num_committed_chars, min_cut, -1):
+            if " " not in output[cut - CLEAN_UP_RULE_LEN + 1 : cut]:
+                self.clean_text += clean_up(output[self.clean_offset : cut])
+                self.clean_offset = cut
+                break
+        return self.clean_text + clean_up(output[self.clean_offset :])
+
+
+class StopStringMatcher:
+    """Find the stop strings in a growing output by only scanning its new suffix.
+
+    It mirrors `output.rfind(stop, start)` over the stop strings in order.
+    The text that was already scanned and is stable cannot contain a stop
+    string, otherwise the generation would have stopped earlier.
+    """
+
+    # Cleaning up tokenization spaces may rewrite a few characters before
+    # the end of the previous text.
+    CLEAN_UP_MARGIN = 8
+
+    def __init__(self, stop_str, start=0):
+        if not stop_str:
+            self.stop_strs = []
+        elif isinstance(stop_str, str):
+            self.stop_strs = [stop_str]
+        elif isinstance(stop_str, Iterable):
+            self.stop_strs = list(stop_str)
+        else:
+            raise ValueError("Invalid stop field type.")
+        self.start = start
+        self.max_stop_len = max((len(s) for s in self.stop_strs), default=0)
+        self.num_checked_chars = 0
+
+    def match(self, output: str, num_stable_chars: int):
+        """Apply the stop strings to an output.
+
+        Returns the output cut before the stop string, whether a stop string
+        was found and whether the output ends with a partial stop string.
+        """
+        if not self.stop_strs:
+            return output, False, False
+
+        search_start = max(
+            self.start,
+            self.num_checked_chars - self.max_stop_len - self.CLEAN_UP_MARGIN,
+        )
+        for each_stop in self.stop_strs:
+            pos = output.rfind(each_stop, search_start)
+            if pos != -1:
+                return output[:pos], True, False
+            if partial_stop(output, each_stop):
+                # The remaining stop strings were not searched.
+                return output, False, True
+        self.num_checked_chars = num_stable_chars
+        return output, False, False
@@ -0,0 +1,124 @@
+"""
+Compute text embeddings in batches.
+
+The texts are sorted by length and cut into batches of similar lengths, so
+that short texts do not pay for the padding of long ones. Every batch has
+at most `max_batch_tokens` tokens including the padding. The embedding of a
+text is the normalized mean of the last hidden states of its tokens, which
+only the transformer computes: the LM head (or the decoder of T5) is
+skipped.
+"""
+from typing import List, Tuple
+
+import torch
+import torch.nn.functional as F
+
+DEFAULT_MAX_BATCH_TOKENS = 8192
+
+
+def get_embedding_family(model) -> str:
+    """Get how a model is run and pooled: "chatglm", "encoder" for
+    encoder-decoder models like T5, or "decoder"."""
+    if "chatglm" in str(type(model)).lower():
+        return "chatglm"
+    if getattr(model.config, "is_encoder_decoder", False):
+        return "encoder"
+    return "decoder"
+
+
+def make_length_buckets(lengths: List[int], max_tokens: int) -> List[List[int]]:
+    """Group the indices of `lengths` into batches of similar lengths whose
+    padded size is at most `max_tokens`. Longer texts come first, so
+    that a batch that does not fit into memory fails early."""
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    buckets = []
+    for i in order:
+        # The first text of a bucket is its longest one.
+        if buckets and (len(buckets[-1]) + 1) * lengths[buckets[-1][0]] <= max_tokens:
+            buckets[-1].append(i)
+        else:
+            buckets.append([i])
+    return buckets
+
+
+def _pad_right(input_ids: List[List[int]], pad_token_id: int, device):
+    max_len = max(len(ids) for ids in input_ids)
+    padded = torch.full((len(input_ids), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids), max_len), dtype=torch.long)
+    for i, ids in enumerate(input_ids):
+        padded[i, : len(ids)] = torch.as_tensor(ids)
+        attention_mask[i, : len(ids)] = 1
+    return padded.to(device), attention_mask.to(device)
+
+
+def _get_hidden_states(model, tokenizer, family, input_ids, device):
+    """Run one batch through the model without its LM head. Returns the last
+    hidden states [batch, seq, hidden] and the mask of the tokens to pool
+    [batch, seq]."""
+    if family == "chatglm":
+        # The tokenizer of ChatGLM builds its own masks and position ids, and
+        # pads on the left.
+        encoding = tokenizer.pad({"input_ids": input_ids}, return_tensors="pt")
+        model_output = model.base_model(
+            **{k: v.to(device) for k, v in encoding.items()}, use_cache=False
+        )
+        data = model_output.last_hidden_state.transpose(0, 1)
+        lengths = torch.as_tensor([len(ids) for ids in input_ids], device=device)
+        positions = torch.arange(data.shape[1], device=device)
+        if tokenizer.padding_side == "left":
+            mask = positions >= data.shape[1] - lengths[:, None]
+        else:
+            mask = positions < lengths[:, None]
+        return data, mask
+
+    # Pad on the right, so that the tokens of a causal model see the same
+    # context and positions as without padding.
+    pad_token_id = tokenizer.pad_token_id or 0
+    padded, attention_mask = _pad_right(input_ids, pad_token_id, device)
+    if family == "encoder":
+        data = model.get_encoder()(padded, attention_mask=attention_mask)[0]
+    elif model.base_model is not model:
+        # The transformer without the LM head, so that neither the logits nor
+        # the hidden states and kv cache of every layer are kept.
+        model_output = model.base_model(
+            padded, attention_mask=attention_mask, use_cache=False
+        )
+        data = model_output.last_hidden_state
+    else:
+        model_output = model(
+            padded, attention_mask=attention_mask, output_hidden_states=True
+        )
+        data = model_output.hidden_states[-1]
+    return data, attention_mask.bool()
+
+
+@torch.inference_mode()
+def compute_embeddings(
+    model,
+    tokenizer,
+    texts: List[str],
+    device,
+    max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+) -> Tuple[torch.Tensor, List[int]]:
+    """Embed texts in length-bucketed batches. Returns the normalized
+    embeddings [len(texts), hidden] in the order of `texts` and the number
+    of tokens of every text."""
+    if not texts:
+        return torch.empty(0, model.config.hidden_size), []
+    family = get_embedding_family(model)
+    input_ids = tokenizer(texts).input_ids
+    lengths = [len(ids) for ids in input_ids]
+
+    embeddings = [None] * len(texts)
+    for bucket in make_length_buckets(lengths, max_batch_tokens):
+        data, mask = _get_hidden_states(
+            model, tokenizer, family, [input_ids[i] for i in bucket], device
+        )
+        # Pool in place instead of allocating masked copies of the states.
+        mask = mask.unsqueeze(-1)
+        data.masked_fill_(~mask, 0)
+        embedding = data.sum(dim=1, dtype=torch.float32) / mask.sum(dim=1)
+        embedding = F.normalize(embedding, p=2, dim=1).cpu()
+        for i, row in zip(bucket, embedding):
+            embeddings[i] = row
+    return torch.stack(embeddings), lengths
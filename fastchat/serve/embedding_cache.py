@@ -0,0 +1,130 @@
+"""
+Cache the embeddings of texts that are embedded again and again.
+
+An embedding is keyed by the model name and the hash of its text in Unicode
+NFC form. The most recently used embeddings stay in memory. With a database
+path, all embeddings are also kept in a sqlite file, so that they outlive
+the process and the memory tier.
+"""
+import collections
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+# sqlite limits the number of parameters of a query.
+MAX_QUERY_KEYS = 500
+
+
+def get_embedding_key(model_name: str, text: str) -> str:
+    text = unicodedata.normalize("NFC", text)
+    return hashlib.sha256(f"{model_name}\0{text}".encode()).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, max_entries: int, db_path: Optional[str] = None):
+        self.max_entries = max_entries
+        # Dict[key -> float32 embedding] in the order of use
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, embedding BLOB)"
+            )
+            self.db.commit()
+        self.num_hits = 0
+        self.num_db_hits = 0
+        self.num_misses = 0
+
+    def get(self, model_name: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Get the cached float32 embedding of every text, or None if it is
+        missing."""
+        keys = [get_embedding_key(model_name, text) for text in texts]
+        with self.lock:
+            found = {}
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[key] = self.entries[key]
+            if self.db is not None:
+                db_keys = list({key for key in keys if key not in found})
+                for i in range(0, len(db_keys), MAX_QUERY_KEYS):
+                    query_keys = db_keys[i : i + MAX_QUERY_KEYS]
+                    rows = self.db.execute(
+                        "SELECT key, embedding FROM embeddings WHERE key IN "
+                        f"({','.join('?' * len(query_keys))})",
+                        query_keys,
+                    )
+                    for key, blob in rows:
+                        found[key] = np.frombuffer(blob, dtype="<f4")
+                        self.num_db_hits += 1
+                        self._add(key, found[key])
+
+            embeddings = []
+            for key in keys:
+                if key in found:
+                    self.num_hits += 1
+                    embeddings.append(found[key])
+                else:
+                    self.num_misses += 1
+                    embeddings.append(None)
+        return embeddings
+
+    def put(
+        self, model_name: str, texts: List[str], embeddings: Sequence[Sequence[float]]
+    ):
+        keys = [get_embedding_key(model_name, text) for text in texts]
+        values = [np.asarray(embedding, dtype="<f4") for embedding in embeddings]
+        with self.lock:
+            for key, value in zip(keys, values):
+                self._add(key, value)
+            if self.db is not None:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                    [(key, value.tobytes()) for key, value in zip(keys, values)],
+                )
+                self.db.commit()
+
+    def get_status(self):
+        num_lookups = self.num_hits + self.num_misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.num_hits,
+            "db_hits": self.num_db_hits,
+            "misses": self.num_misses,
+            "hit_rate": self.num_hits / num_lookups if num_lookups else 0.0,
+        }
+
+    def _add(self, key: str, value: np.ndarray):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+def add_embedding_cache_args(parser):
+    parser.add_argument(
+        "--embedding-cache-size",
+        type=int,
+        default=0,
+        help="The number of embeddings cached in memory. 0 disables the cache "
+        "unless --embedding-cache-path is set.",
+    )
+    parser.add_argument(
+        "--embedding-cache-path",
+        type=str,
+        default=None,
+        help="A sqlite file that keeps all cached embeddings across restarts",
+    )
+
+
+def create_embedding_cache(args) -> Optional[EmbeddingCache]:
+    if args.embedding_cache_size <= 0 and not args.embedding_cache_path:
+        return None
+    return EmbeddingCache(args.embedding_cache_size, args.embedding_cache_path)
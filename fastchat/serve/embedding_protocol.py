@@ -0,0 +1,92 @@
+"""
+The encoding of embeddings between workers, the controller and the API server.
+
+Workers answer /worker_get_embeddings with JSON lists of floats by default.
+Clients that pass `embedding_protocol` in the request get the binary format:
+
+    header: b"FCEM" + version (1 byte) + dtype (1 byte)
+            + token_num, rows, dim (4 bytes each, little-endian)
+    body:   the embeddings as a little-endian array of rows x dim
+
+The dtype is float32, float16 or int8. Embeddings are normalized, so int8
+stores round(x * 127). Errors are still answered in JSON, and so are
+clients of workers that do not know the protocol; `decode_embeddings`
+detects the format from the first bytes.
+"""
+import json
+import struct
+from typing import Optional
+
+import numpy as np
+
+EMBEDDING_PROTOCOL_VERSION = 1
+EMBEDDING_MAGIC = b"FCEM"
+EMBEDDING_DTYPES = {"float32": "<f4", "float16": "<f2", "int8": "i1"}
+DTYPE_NAMES = list(EMBEDDING_DTYPES)
+INT8_SCALE = 127
+
+_header = struct.Struct("<4sBBIII")
+
+
+def get_embedding_protocol_params(dtype: str = "float32"):
+    """The request params that ask a worker for the binary format."""
+    return {"embedding_protocol": EMBEDDING_PROTOCOL_VERSION, "embedding_dtype": dtype}
+
+
+def get_embedding_dtype(params: dict) -> Optional[str]:
+    """Get the dtype a client asked for, or None for the JSON format."""
+    version = params.get("embedding_protocol", None)
+    if version is None or int(version) < EMBEDDING_PROTOCOL_VERSION:
+        return None
+    dtype = params.get("embedding_dtype", "float32")
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"Invalid embedding dtype: {dtype}")
+    return dtype
+
+
+def quantize_embeddings(embeddings: np.ndarray, dtype: str) -> np.ndarray:
+    """Convert float32 embeddings to a dtype of EMBEDDING_DTYPES."""
+    if dtype == "int8":
+        embeddings = np.rint(embeddings * INT8_SCALE)
+        embeddings = np.clip(embeddings, -INT8_SCALE, INT8_SCALE)
+    return embeddings.astype(EMBEDDING_DTYPES[dtype])
+
+
+def dequantize_embeddings(embeddings: np.ndarray, dtype: str) -> np.ndarray:
+    embeddings = embeddings.astype(np.float32)
+    if dtype == "int8":
+        embeddings /= INT8_SCALE
+    return embeddings
+
+
+def encode_embeddings(embeddings: np.ndarray, token_num: int, dtype: str) -> bytes:
+    """Encode float32 embeddings [rows, dim] in the binary format."""
+    rows, dim = embeddings.shape
+    header = _header.pack(
+        EMBEDDING_MAGIC,
+        EMBEDDING_PROTOCOL_VERSION,
+        DTYPE_NAMES.index(dtype),
+        token_num,
+        rows,
+        dim,
+    )
+    return header + quantize_embeddings(embeddings, dtype).tobytes()
+
+
+def decode_embeddings(content: bytes) -> dict:
+    """Decode a response in either format. The "embedding" of a successful
+    response is a float32 array [rows, dim]."""
+    if not content.startswith(EMBEDDING_MAGIC):
+        ret = json.loads(content)
+        if "embedding" in ret:
+            ret["embedding"] = np.asarray(ret["embedding"], dtype=np.float32)
+        return ret
+    _, _, dtype_id, token_num, rows, dim = _header.unpack_from(content)
+    dtype = DTYPE_NAMES[dtype_id]
+    embeddings = np.frombuffer(
+        content, dtype=EMBEDDING_DTYPES[dtype], count=rows * dim, offset=_header.size
+    )
+    return {
+        "embedding": dequantize_embeddings(embeddings.reshape(rows, dim), dtype),
+        "token_num": token_num,
+    }
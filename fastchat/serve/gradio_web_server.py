@@ -36,6 +36,7 @@ from fastchat.serve.api_provider import (
 )
 from fastchat.serve.gradio_patch import Chatbot as grChatbot
 from fastchat.serve.gradio_css import code_highlight_css
+from fastchat.serve.http_client import get_session
 from fastchat.utils import (
     build_logger,
     violates_moderation,
@@ -189,9 +190,9 @@ def get_conv_log_filename():
 
 
 def get_model_list(controller_url):
-    ret = requests.post(controller_url + "/refresh_all_workers")
+    ret = get_session().post(controller_url + "/refresh_all_workers")
     assert ret.status_code == 200
-    ret = requests.post(controller_url + "/list_models")
+    ret = get_session().post(controller_url + "/list_models")
     models = ret.json()["models"]
     priority = {k: f"___{i:02d}" for i, k in enumerate(model_info)}
     models.sort(key=lambda x: priority.get(x, x))
@@ -367,17 +368,17 @@ def model_worker_stream_iter(
     logger.info(f"==== request ====\n{gen_params}")
 
     # Stream output
-    response = requests.post(
+    with get_session().post(
         worker_addr + "/worker_generate_stream",
         headers=headers,
         json=gen_params,
         stream=True,
         timeout=WORKER_API_TIMEOUT,
-    )
-    for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-        if chunk:
-            data = json.loads(chunk.decode())
-            yield data
+    ) as response:
+        for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+            if chunk:
+                data = json.loads(chunk.decode())
+                yield data
 
 
 def http_bot(state, temperature, top_p, max_new_tokens, request: gr.Request):
@@ -411,7 +412,7 @@ def http_bot(state, temperature, top_p, max_new_tokens, request: gr.Request):
         )
     else:
         # Query worker address
-        ret = requests.post(
+        ret = get_session().post(
             controller_url + "/get_worker_address", json={"model": model_name}
         )
         worker_addr = ret.json()["address"]
@@ -0,0 +1,81 @@
+"""
+Pooled HTTP clients shared by the controller, workers and web servers.
+
+Creating a client per request costs a TCP (and TLS) handshake every time.
+Every process instead keeps one `httpx.AsyncClient` for its async handlers
+and one `requests.Session` for its sync code paths, so connections to the
+controller and the workers are kept alive and reused.
+"""
+import threading
+from typing import Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from fastchat.constants import (
+    HTTP_POOL_MAX_CONNECTIONS,
+    HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_POOL_KEEPALIVE_EXPIRY,
+)
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+_async_client: Optional[httpx.AsyncClient] = None
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Get the AsyncClient of this process.
+
+    Use it from a single event loop, e.g. the one of a FastAPI app, and close
+    it with `close_async_client` on shutdown.
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_POOL_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def get_session() -> requests.Session:
+    """Get the requests.Session of this process, shared by all threads."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS,
+                pool_maxsize=HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS,
+            )
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def close_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -24,6 +24,7 @@ def main(args):
         args.load_8bit,
         args.cpu_offloading,
         debug=args.debug,
+        compression_policy=args.compression_policy,
     )
 
     msg = args.message
@@ -29,6 +29,8 @@ from transformers.generation.logits_process import (
 from fastchat.conversation import get_conv_template, SeparatorStyle
 from fastchat.model.model_adapter import load_model, get_conversation_template
 from fastchat.model.chatglm_model import chatglm_generate_stream
+from fastchat.serve.detokenizer import IncrementalDetokenizer, StopStringMatcher
+from fastchat.serve.sampling import SamplingBatch, SamplingParams
 
 
 def prepare_logits_processor(
@@ -47,33 +49,39 @@ def prepare_logits_processor(
     return processor_list
 
 
-def partial_stop(output, stop_str):
-    for i in range(0, min(len(output), len(stop_str))):
-        if stop_str.startswith(output[-i:]):
-            return True
-    return False
-
-
 @torch.inference_mode()
 def generate_stream(
-    model, tokenizer, params, device, context_len=2048, stream_interval=2
+    model,
+    tokenizer,
+    params,
+    device,
+    context_len=2048,
+    stream_interval=2,
+    kv_budget=None,
+    prefix_cache=None,
 ):
+    if int(params.get("n", 1)) > 1:
+        yield from generate_stream_n(
+            model,
+            tokenizer,
+            params,
+            device,
+            context_len,
+            stream_interval,
+            kv_budget,
+            prefix_cache,
+        )
+        return
+
     prompt = params["prompt"]
     len_prompt = len(prompt)
-    temperature = float(params.get("temperature", 1.0))
-    repetition_penalty = float(params.get("repetition_penalty", 1.0))
-    top_p = float(params.get("top_p", 1.0))
-    top_k = int(params.get("top_k", -1))  # -1 means disable
+    sampling_params = SamplingParams.from_params(params)
     max_new_tokens = int(params.get("max_new_tokens", 256))
     stop_str = params.get("stop", None)
     echo = bool(params.get("echo", True))
     stop_token_ids = params.get("stop_token_ids", None) or []
     stop_token_ids.append(tokenizer.eos_token_id)
 
-    logits_processor = prepare_logits_processor(
-        temperature, repetition_penalty, top_p, top_k
-    )
-
     input_ids = tokenizer(prompt).input_ids
     input_echo_len = len(input_ids)
     output_ids = list(input_ids)
@@ -85,6 +93,13 @@ def generate_stream(
 
     input_ids = input_ids[-max_src_len:]
 
+    if echo:
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        stop_matcher = StopStringMatcher(stop_str, len_prompt)
+    else:
+        detokenizer = IncrementalDetokenizer(tokenizer, input_echo_len)
+        stop_matcher = StopStringMatcher(stop_str)
+
     if model.config.is_encoder_decoder:
         encoder_output = model.encoder(
             input_ids=torch.as_tensor([input_ids], device=device)
@@ -95,139 +110,313 @@ def generate_stream(
             device=device,
         )
 
+    if kv_budget is not None:
+        # Reserve the whole request up front, so the free blocks of the budget
+        # are the real remaining capacity of this worker.
+        seq_id = kv_budget.allocate(len(input_ids) + max_new_tokens)
+
     past_key_values = out = None
-    for i in range(max_new_tokens):
-        if i == 0:
-            if model.config.is_encoder_decoder:
-                out = model.decoder(
-                    input_ids=start_ids,
-                    encoder_hidden_states=encoder_output,
-                    use_cache=True,
-                )
-                logits = model.lm_head(out[0])
+    try:
+        for i in range(max_new_tokens):
+            if i == 0:
+                if model.config.is_encoder_decoder:
+                    out = model.decoder(
+                        input_ids=start_ids,
+                        encoder_hidden_states=encoder_output,
+                        use_cache=True,
+                    )
+                    logits = model.lm_head(out[0])
+                else:
+                    num_cached = 0
+                    if prefix_cache is not None:
+                        num_cached, past_key_values = prefix_cache.match(input_ids)
+                    out = model(
+                        torch.as_tensor([input_ids[num_cached:]], device=device),
+                        use_cache=True,
+                        past_key_values=past_key_values,
+                    )
+                    logits = out.logits
+                past_key_values = out.past_key_values
             else:
-                out = model(torch.as_tensor([input_ids], device=device), use_cache=True)
-                logits = out.logits
-            past_key_values = out.past_key_values
-        else:
-            if model.config.is_encoder_decoder:
-                out = model.decoder(
-                    input_ids=torch.as_tensor([[token]], device=device),
-                    encoder_hidden_states=encoder_output,
-                    use_cache=True,
-                    past_key_values=past_key_values,
-                )
-
-                logits = model.lm_head(out[0])
+                if model.config.is_encoder_decoder:
+                    out = model.decoder(
+                        input_ids=torch.as_tensor([[token]], device=device),
+                        encoder_hidden_states=encoder_output,
+                        use_cache=True,
+                        past_key_values=past_key_values,
+                    )
+
+                    logits = model.lm_head(out[0])
+                else:
+                    out = model(
+                        input_ids=torch.as_tensor([[token]], device=device),
+                        use_cache=True,
+                        past_key_values=past_key_values,
+                    )
+                    logits = out.logits
+                past_key_values = out.past_key_values
+
+            if i == 0:
+                sampler = SamplingBatch(logits.shape[-1], logits.device)
+                sampler.add(sampling_params, output_ids)
+            token = sampler.sample(logits[:, -1, :])[0]
+
+            output_ids.append(token)
+
+            if token in stop_token_ids:
+                stopped = True
             else:
-                out = model(
-                    input_ids=torch.as_tensor([[token]], device=device),
-                    use_cache=True,
-                    past_key_values=past_key_values,
-                )
-                logits = out.logits
-            past_key_values = out.past_key_values
+                stopped = False
 
-        if logits_processor:
-            if repetition_penalty > 1.0:
-                tmp_output_ids = torch.as_tensor([output_ids], device=logits.device)
-            else:
-                tmp_output_ids = None
-            last_token_logits = logits_processor(tmp_output_ids, logits[:, -1, :])[0]
+            if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
+                output, stop_hit, partially_stopped = stop_matcher.match(
+                    detokenizer.decode(output_ids), detokenizer.num_stable_chars
+                )
+                stopped = stopped or stop_hit
+
+                # prevent yielding partial stop sequence
+                if not partially_stopped:
+                    yield {
+                        "text": output,
+                        "usage": {
+                            "prompt_tokens": input_echo_len,
+                            "completion_tokens": i,
+                            "total_tokens": input_echo_len + i,
+                        },
+                        "finish_reason": None,
+                    }
+
+            if stopped:
+                break
+
+        # finish stream event, which contains finish reason
+        if i == max_new_tokens - 1:
+            finish_reason = "length"
+        elif stopped:
+            finish_reason = "stop"
         else:
-            last_token_logits = logits[0, -1, :]
-
-        if device == "mps":
-            # Switch to CPU by avoiding some bugs in mps backend.
-            last_token_logits = last_token_logits.float().to("cpu")
+            finish_reason = None
+
+        yield {
+            "text": output,
+            "usage": {
+                "prompt_tokens": input_echo_len,
+                "completion_tokens": i,
+                "total_tokens": input_echo_len + i,
+            },
+            "finish_reason": finish_reason,
+        }
 
-        if temperature < 1e-5 or top_p < 1e-8:  # greedy
-            token = int(torch.argmax(last_token_logits))
+        if prefix_cache is not None and not model.config.is_encoder_decoder:
+            # The kv cache covers the prompt and all but the last sampled token.
+            prefix_cache.insert(
+                input_ids + output_ids[input_echo_len:], past_key_values
+            )
+    finally:
+        # clean
+        del past_key_values, out
+        if kv_budget is not None:
+            kv_budget.free(seq_id)
         else:
-            probs = torch.softmax(last_token_logits, dim=-1)
-            token = int(torch.multinomial(probs, num_samples=1))
+            gc.collect()
+            torch.cuda.empty_cache()
 
-        output_ids.append(token)
-
-        if token in stop_token_ids:
-            stopped = True
-        else:
-            stopped = False
 
-        if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
-            if echo:
-                tmp_output_ids = output_ids
-                rfind_start = len_prompt
-            else:
-                tmp_output_ids = output_ids[input_echo_len:]
-                rfind_start = 0
+@torch.inference_mode()
+def generate_stream_n(
+    model,
+    tokenizer,
+    params,
+    device,
+    context_len=2048,
+    stream_interval=2,
+    kv_budget=None,
+    prefix_cache=None,
+):
+    """Sample `n` completions of one prompt as a batch.
 
-            output = tokenizer.decode(
-                tmp_output_ids,
-                skip_special_tokens=True,
-                spaces_between_special_tokens=False,
-            )
+    The prompt is prefilled once and its kv cache is forked `n` ways. Every
+    frame has the `index` of its completion and each completion ends with its
+    own frame that has a finish reason.
+    """
+    prompt = params["prompt"]
+    len_prompt = len(prompt)
+    n = int(params.get("n", 1))
+    sampling_params = SamplingParams.from_params(params)
+    max_new_tokens = int(params.get("max_new_tokens", 256))
+    stop_str = params.get("stop", None)
+    echo = bool(params.get("echo", True))
+    stop_token_ids = params.get("stop_token_ids", None) or []
+    stop_token_ids.append(tokenizer.eos_token_id)
+    is_encoder_decoder = model.config.is_encoder_decoder
 
-            partially_stopped = False
-            if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                        stopped = True
-                    else:
-                        partially_stopped = partial_stop(output, stop_str)
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            stopped = True
-                            break
-                        else:
-                            partially_stopped = partial_stop(output, each_stop)
-                            if partially_stopped:
-                                break
-                else:
-                    raise ValueError("Invalid stop field type.")
+    input_ids = tokenizer(prompt).input_ids
+    input_echo_len = len(input_ids)
+    output_ids = [list(input_ids) for _ in range(n)]
 
-            # prevent yielding partial stop sequence
-            if not partially_stopped:
-                yield {
-                    "text": output,
-                    "usage": {
-                        "prompt_tokens": input_echo_len,
-                        "completion_tokens": i,
-                        "total_tokens": input_echo_len + i,
-                    },
-                    "finish_reason": None,
-                }
+    if is_encoder_decoder:
+        max_src_len = context_len
+    else:
+        max_src_len = context_len - max_new_tokens - 8
 
-        if stopped:
-            break
+    input_ids = input_ids[-max_src_len:]
 
-    # finish stream event, which contains finish reason
-    if i == max_new_tokens - 1:
-        finish_reason = "length"
-    elif stopped:
-        finish_reason = "stop"
+    if echo:
+        detokenizers = [IncrementalDetokenizer(tokenizer) for _ in range(n)]
+        stop_matchers = [StopStringMatcher(stop_str, len_prompt) for _ in range(n)]
     else:
-        finish_reason = None
+        detokenizers = [
+            IncrementalDetokenizer(tokenizer, input_echo_len) for _ in range(n)
+        ]
+        stop_matchers = [StopStringMatcher(stop_str) for _ in range(n)]
+    outputs = [""] * n
 
-    yield {
-        "text": output,
-        "usage": {
-            "prompt_tokens": input_echo_len,
-            "completion_tokens": i,
-            "total_tokens": input_echo_len + i,
-        },
-        "finish_reason": finish_reason,
-    }
+    if is_encoder_decoder:
+        encoder_output = model.encoder(
+            input_ids=torch.as_tensor([input_ids], device=device)
+        )[0]
+
+    seq_ids = []
+    if kv_budget is not None:
+        # The completions share the blocks of the prompt.
+        num_tokens = len(input_ids) + max_new_tokens
+        try:
+            seq_ids.append(kv_budget.allocate(num_tokens))
+            for _ in range(n - 1):
+                seq_ids.append(kv_budget.fork(seq_ids[0], num_tokens, len(input_ids)))
+        except ValueError:
+            for seq_id in seq_ids:
+                kv_budget.free(seq_id)
+            raise
+
+    # The indices of the unfinished completions, in the order of the batch
+    running = list(range(n))
+    past_key_values = out = None
+    try:
+        for i in range(max_new_tokens):
+            if i == 0:
+                if is_encoder_decoder:
+                    start_ids = torch.as_tensor(
+                        [[model.generation_config.decoder_start_token_id]],
+                        dtype=torch.int64,
+                        device=device,
+                    )
+                    out = model.decoder(
+                        input_ids=start_ids,
+                        encoder_hidden_states=encoder_output,
+                        use_cache=True,
+                    )
+                    logits = model.lm_head(out[0])
+                else:
+                    num_cached = 0
+                    if prefix_cache is not None:
+                        num_cached, past_key_values = prefix_cache.match(input_ids)
+                    out = model(
+                        torch.as_tensor([input_ids[num_cached:]], device=device),
+                        use_cache=True,
+                        past_key_values=past_key_values,
+                    )
+                    logits = out.logits
+                # Fork the kv cache of the prompt
+                past_key_values = tuple(
+                    tuple(t.expand(n, *t.shape[1:]) for t in layer)
+                    for layer in out.past_key_values
+                )
+                last_token_logits = logits[:, -1, :].repeat(n, 1)
+            else:
+                last_ids = torch.as_tensor(
+                    [[output_ids[j][-1]] for j in running], device=device
+                )
+                if is_encoder_decoder:
+                    out = model.decoder(
+                        input_ids=last_ids,
+                        encoder_hidden_states=encoder_output.expand(
+                            len(running), -1, -1
+                        ),
+                        use_cache=True,
+                        past_key_values=past_key_values,
+                    )
+                    logits = model.lm_head(out[0])
+                else:
+                    out = model(
+                        input_ids=last_ids,
+                        use_cache=True,
+                        past_key_values=past_key_values,
+                    )
+                    logits = out.logits
+                past_key_values = out.past_key_values
+                last_token_logits = logits[:, -1, :]
+
+            if i == 0:
+                sampler = SamplingBatch(logits.shape[-1], logits.device)
+                sampler.add(sampling_params, output_ids[0], n)
+            tokens = sampler.sample(last_token_logits)
+
+            keep = []
+            for row, (j, token) in enumerate(zip(running, tokens)):
+                output_ids[j].append(token)
+                stopped = token in stop_token_ids
+                usage = {
+                    "prompt_tokens": input_echo_len,
+                    "completion_tokens": i,
+                    "total_tokens": input_echo_len + i,
+                }
 
-    # clean
-    del past_key_values, out
-    gc.collect()
-    torch.cuda.empty_cache()
+                if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
+                    output, stop_hit, partially_stopped = stop_matchers[j].match(
+                        detokenizers[j].decode(output_ids[j]),
+                        detokenizers[j].num_stable_chars,
+                    )
+                    stopped = stopped or stop_hit
+                    outputs[j] = output
+
+                    # prevent yielding partial stop sequence
+                    if not partially_stopped:
+                        yield {
+                            "index": j,
+                            "text": output,
+                            "usage": usage,
+                            "finish_reason": None,
+                        }
+
+                if not stopped and i < max_new_tokens - 1:
+                    keep.append(row)
+                    continue
+
+                # finish stream event, which contains finish reason
+                yield {
+                    "index": j,
+                    "text": outputs[j],
+                    "usage": usage,
+                    "finish_reason": "length" if i == max_new_tokens - 1 else "stop",
+                }
+                if prefix_cache is not None and not is_encoder_decoder:
+                    prefix_cache.insert(
+                        input_ids + output_ids[j][input_echo_len:],
+                        tuple(
+                            tuple(t[row : row + 1] for t in layer)
+                            for layer in past_key_values
+                        ),
+                    )
+
+            if not keep:
+                break
+            if len(keep) < len(running):
+                running = [running[row] for row in keep]
+                sampler = sampler.select(keep)
+                index = torch.as_tensor(keep, device=past_key_values[0][0].device)
+                past_key_values = tuple(
+                    tuple(t.index_select(0, index) for t in layer)
+                    for layer in past_key_values
+                )
+    finally:
+        # clean
+        del past_key_values, out
+        for seq_id in seq_ids:
+            kv_budget.free(seq_id)
+        if kv_budget is None:
+            gc.collect()
+            torch.cuda.empty_cache()
 
 
 class ChatIO(abc.ABC):
@@ -259,10 +448,12 @@ def chat_loop(
     max_new_tokens: int,
     chatio: ChatIO,
     debug: bool,
+    compression_policy: Optional[str] = None,
 ):
     # Model
     model, tokenizer = load_model(
-        model_path, device, num_gpus, max_gpu_memory, load_8bit, wbits, groupsize, cpu_offloading, debug
+        model_path, device, num_gpus, max_gpu_memory, load_8bit, wbits, groupsize, cpu_offloading, debug,
+        compression_policy=compression_policy,
     )
     is_chatglm = "chatglm" in str(type(model)).lower()
     is_fastchat_t5 = "t5" in str(type(model)).lower()
@@ -0,0 +1,238 @@
+"""
+Paged kv cache blocks and the kv cache budget of a worker.
+
+Memory is split into fixed-size blocks of `block_size` tokens that are handed
+out from a reference-counted free list.
+
+- `KVCacheBudget` is admission control only. The Hugging Face inference path
+  keeps its kv cache in `past_key_values`, and a request reserves the blocks
+  for its prompt and `max_new_tokens` up front, so the number of free blocks
+  is the remaining capacity of a worker and a request that is admitted never
+  runs out of memory halfway.
+- `PagedKVCache` stores key/value tensors in a block pool, which the prefix
+  cache uses to keep the kv cache of common prompt prefixes.
+"""
+from collections import deque
+import threading
+from typing import Dict, List, Optional
+import uuid
+
+import torch
+
+
+class BlockAllocator:
+    """A free list of reference-counted block numbers."""
+
+    def __init__(self, num_blocks: int):
+        self.num_blocks = num_blocks
+        self.free_blocks = deque(range(num_blocks))
+        self.ref_counts = [0] * num_blocks
+
+    def allocate(self) -> int:
+        if not self.free_blocks:
+            raise ValueError("Out of kv cache blocks.")
+        block = self.free_blocks.popleft()
+        self.ref_counts[block] = 1
+        return block
+
+    def fork(self, block: int) -> int:
+        """Share a block with one more owner."""
+        self.ref_counts[block] += 1
+        return block
+
+    def free(self, block: int):
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+    def get_num_free_blocks(self) -> int:
+        return len(self.free_blocks)
+
+
+def get_block_bytes(config, block_size: int, dtype: torch.dtype) -> int:
+    """The memory of the keys and values of `block_size` tokens of a model."""
+    return (
+        2
+        * config.num_hidden_layers
+        * config.hidden_size
+        * block_size
+        * torch.finfo(dtype).bits
+        // 8
+    )
+
+
+class KVCacheBudget:
+    """Reserves kv cache blocks per sequence without storing any tensors."""
+
+    def __init__(self, num_blocks: int, block_size: int = 16):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.allocator = BlockAllocator(num_blocks)
+        # Requests running in different threads share one budget
+        self.lock = threading.RLock()
+        # Dict[seq_id -> List[block]]
+        self.block_tables: Dict[str, List[int]] = {}
+
+    def get_num_blocks(self, num_tokens: int) -> int:
+        return (num_tokens + self.block_size - 1) // self.block_size
+
+    def get_num_free_tokens(self) -> int:
+        return self.allocator.get_num_free_blocks() * self.block_size
+
+    def can_allocate(self, num_tokens: int, seq_id: Optional[str] = None) -> bool:
+        num_owned = len(self.block_tables.get(seq_id, []))
+        num_needed = self.get_num_blocks(num_tokens) - num_owned
+        return num_needed <= self.allocator.get_num_free_blocks()
+
+    def allocate(self, num_tokens: int, seq_id: Optional[str] = None) -> str:
+        """Make sure a sequence owns enough blocks for `num_tokens` tokens.
+
+        Returns the sequence id, which is generated for a new sequence.
+        """
+        if seq_id is None:
+            seq_id = uuid.uuid4().hex
+        with self.lock:
+            if not self.can_allocate(num_tokens, seq_id):
+                raise ValueError(
+                    f"Not enough kv cache for {num_tokens} tokens. "
+                    f"Only {self.get_num_free_tokens()} tokens are free."
+                )
+            block_table = self.block_tables.setdefault(seq_id, [])
+            while len(block_table) < self.get_num_blocks(num_tokens):
+                block_table.append(self.allocator.allocate())
+        return seq_id
+
+    def fork(self, seq_id: str, num_tokens: int, num_shared_tokens: int) -> str:
+        """Create a sequence of `num_tokens` tokens that shares the full blocks
+        of the first `num_shared_tokens` tokens of `seq_id`, e.g. a prompt
+        sampled several times.
+
+        Returns the id of the new sequence.
+        """
+        with self.lock:
+            block_table = self.block_tables[seq_id]
+            num_shared = min(num_shared_tokens // self.block_size, len(block_table))
+            num_needed = self.get_num_blocks(num_tokens) - num_shared
+            if num_needed > self.allocator.get_num_free_blocks():
+                raise ValueError(
+                    f"Not enough kv cache for {num_tokens} tokens. "
+                    f"Only {self.get_num_free_tokens()} tokens are free."
+                )
+            new_seq_id = uuid.uuid4().hex
+            self.block_tables[new_seq_id] = [
+                self.allocator.fork(block) for block in block_table[:num_shared]
+            ] + [self.allocator.allocate() for _ in range(num_needed)]
+        return new_seq_id
+
+    def free(self, seq_id: str):
+        with self.lock:
+            for block in self.block_tables.pop(seq_id, []):
+                self.allocator.free(block)
+
+    def get_status(self):
+        return {
+            "block_size": self.block_size,
+            "num_blocks": self.num_blocks,
+            "num_free_blocks": self.allocator.get_num_free_blocks(),
+            "num_free_tokens": self.get_num_free_tokens(),
+        }
+
+
+class PagedKVCache:
+    """A pool of fixed-size blocks that hold key/value tensors."""
+
+    def __init__(
+        self,
+        num_layers: int,
+        num_heads: int,
+        head_dim: int,
+        num_blocks: int,
+        block_size: int = 16,
+        dtype: torch.dtype = torch.float16,
+        device: str = "cuda",
+    ):
+        self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.dtype = dtype
+        self.device = device
+
+        self.allocator = BlockAllocator(num_blocks)
+        # The block pool is only allocated once key/value tensors are written.
+        self.blocks = None
+
+    @classmethod
+    def from_model_config(
+        cls, config, num_blocks, block_size=16, dtype=torch.float16, device="cuda"
+    ):
+        num_heads = config.num_attention_heads
+        return cls(
+            num_layers=config.num_hidden_layers,
+            num_heads=num_heads,
+            head_dim=config.hidden_size // num_heads,
+            num_blocks=num_blocks,
+            block_size=block_size,
+            dtype=dtype,
+            device=device,
+        )
+
+    def get_block_bytes(self) -> int:
+        return (
+            2
+            * self.num_layers
+            * self.num_heads
+            * self.block_size
+            * self.head_dim
+            * torch.finfo(self.dtype).bits
+            // 8
+        )
+
+    def _get_blocks(self):
+        if self.blocks is None:
+            self.blocks = torch.zeros(
+                (
+                    self.num_layers,
+                    2,
+                    self.num_blocks,
+                    self.num_heads,
+                    self.block_size,
+                    self.head_dim,
+                ),
+                dtype=self.dtype,
+                device=self.device,
+            )
+        return self.blocks
+
+    def _get_slots(self, block_table, start, end):
+        block_table = torch.as_tensor(block_table, device=self.device)
+        positions = torch.arange(start, end, device=self.device)
+        return block_table[positions // self.block_size], positions % self.block_size
+
+    def write_blocks(self, block_table, past_key_values, start, end, batch_index=0):
+        """Copy the positions [start, end) of a Hugging Face kv cache into blocks.
+
+        `past_key_values` holds one (key, value) pair per layer, each of shape
+        [batch, num_heads, seq_len, head_dim]. The i-th block of `block_table`
+        holds the positions [i * block_size, (i + 1) * block_size).
+        """
+        blocks = self._get_blocks()
+        block_index, offsets = self._get_slots(block_table, start, end)
+        for i in range(2):
+            # [num_layers, num_heads, n, head_dim] -> [n, num_layers, num_heads, head_dim]
+            data = torch.stack(
+                [layer[i][batch_index, :, start:end, :] for layer in past_key_values]
+            ).permute(2, 0, 1, 3)
+            blocks[:, i][:, block_index, :, offsets, :] = data.to(self.dtype)
+
+    def gather_blocks(self, block_table, length):
+        """Read the first `length` positions of blocks as a Hugging Face kv cache."""
+        blocks = self._get_blocks()
+        block_index, offsets = self._get_slots(block_table, 0, length)
+        # [n, num_layers, num_heads, head_dim] -> [num_layers, 1, num_heads, n, head_dim]
+        keys, values = (
+            blocks[:, i][:, block_index, :, offsets, :].permute(1, 2, 0, 3).unsqueeze(1)
+            for i in range(2)
+        )
+        return tuple((keys[i], values[i]) for i in range(self.num_layers))
@@ -0,0 +1,223 @@
+"""
+Keep the models of a multi-model worker within a device memory budget.
+
+Every model is in one of three tiers:
+
+- "device": on the device and ready to serve;
+- "cpu": in CPU memory, and copied back to the device on demand;
+- "disk": unloaded, and loaded again from its checkpoint on demand, which
+  the memory-mapped loader makes fast.
+
+Before a model moves to the device, idle models are evicted until it fits
+into the budget, the least recently used (or least frequently used) ones
+first. Evicted models go to CPU memory while it has room, and to disk
+otherwise. Models with running requests are never evicted.
+"""
+import dataclasses
+import gc
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import torch
+
+from fastchat.model.compression import CLinear
+
+logger = logging.getLogger(__name__)
+
+EVICTION_POLICIES = ("lru", "lfu")
+
+
+def get_model_bytes(model) -> int:
+    """Get the bytes of the parameters, buffers and compressed weights."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    for module in model.modules():
+        if isinstance(module, CLinear):
+            weight = module.weight
+            weight = [weight] if isinstance(weight, torch.Tensor) else weight or []
+            tensors.extend(x for x in weight if isinstance(x, torch.Tensor))
+    return sum(x.numel() * x.element_size() for x in tensors)
+
+
+@dataclasses.dataclass
+class ResidentModel:
+    name: str
+    # The object that holds the model in its `model` attribute
+    worker: object
+    # Load the model again after it was unloaded
+    load_fn: Callable
+    tier: str = "device"
+    num_bytes: int = 0
+    num_active_requests: int = 0
+    num_uses: int = 0
+    last_used: float = 0.0
+    # Being moved off the device
+    moving: bool = False
+
+
+class ModelResidency:
+    def __init__(
+        self,
+        device: str,
+        max_device_bytes: Optional[int] = None,
+        max_cpu_bytes: int = 0,
+        eviction_policy: str = "lru",
+    ):
+        if eviction_policy not in EVICTION_POLICIES:
+            raise ValueError(f"Invalid eviction policy: {eviction_policy}")
+        self.device = device
+        self.max_device_bytes = max_device_bytes
+        # The device is the CPU memory itself for CPU workers.
+        self.max_cpu_bytes = max_cpu_bytes if device != "cpu" else 0
+        self.eviction_policy = eviction_policy
+        # The lock guards the bookkeeping and is never held while a model
+        # moves, so models on the device are acquired during a slow load.
+        self.lock = threading.Lock()
+        # Only one move (a load with its evictions) runs at a time.
+        self.move_lock = threading.Lock()
+        # Dict[model name -> ResidentModel]
+        self.models: Dict[str, ResidentModel] = {}
+
+    def add(self, name: str, worker, load_fn: Callable):
+        """Add a model that was just loaded on the device."""
+        model = ResidentModel(
+            name,
+            worker,
+            load_fn,
+            num_bytes=get_model_bytes(worker.model),
+            last_used=time.time(),
+        )
+        with self.move_lock:
+            with self.lock:
+                self.models[name] = model
+            self._make_room(model)
+
+    def acquire(self, name: str):
+        """Make sure a model is on the device, and keep it there until
+        `release`. Returns its worker."""
+        with self.lock:
+            model = self.models[name]
+            model.num_active_requests += 1
+            model.num_uses += 1
+            model.last_used = time.time()
+            if model.tier == "device" and not model.moving:
+                return model.worker
+        try:
+            with self.move_lock:
+                if model.tier != "device":
+                    self._make_room(model)
+                    self._move(model, "device")
+        except Exception:
+            with self.lock:
+                model.num_active_requests -= 1
+            raise
+        return model.worker
+
+    def release(self, name: str):
+        with self.lock:
+            self.models[name].num_active_requests -= 1
+
+    def get_warm_models(self) -> List[str]:
+        return [m.name for m in self.models.values() if m.tier == "device"]
+
+    def get_status(self):
+        return {
+            m.name: {
+                "tier": m.tier,
+                "gb": m.num_bytes / (1 << 30),
+                "active_requests": m.num_active_requests,
+                "uses": m.num_uses,
+            }
+            for m in self.models.values()
+        }
+
+    def _get_tier_bytes(self, tier: str, exclude: ResidentModel) -> int:
+        return sum(
+            m.num_bytes
+            for m in self.models.values()
+            if m.tier == tier and m is not exclude
+        )
+
+    def _get_victims(self, tier: str, exclude: ResidentModel) -> List[ResidentModel]:
+        """Get the idle models of a tier in eviction order."""
+        victims = [
+            m
+            for m in self.models.values()
+            if m.tier == tier and m is not exclude and m.num_active_requests == 0
+        ]
+        if self.eviction_policy == "lfu":
+            return sorted(victims, key=lambda m: (m.num_uses, m.last_used))
+        return sorted(victims, key=lambda m: m.last_used)
+
+    def _make_room(self, model: ResidentModel):
+        """Evict idle models until `model` fits on the device."""
+        if self.max_device_bytes is None:
+            return
+        used = self._get_tier_bytes("device", model)
+        for victim in self._get_victims("device", model):
+            if used + model.num_bytes <= self.max_device_bytes:
+                break
+            if self._evict(victim, model):
+                used -= victim.num_bytes
+        if used + model.num_bytes > self.max_device_bytes:
+            logger.warning(
+                f"{model.name} exceeds the device memory budget, because the "
+                f"other models on the device are busy."
+            )
+
+    def _start_move(self, model: ResidentModel) -> bool:
+        """Mark an idle model as moving, so no request acquires it until it
+        has moved. Returns False if a request started using it meanwhile."""
+        with self.lock:
+            if model.num_active_requests > 0:
+                return False
+            model.moving = True
+            return True
+
+    def _evict(self, model: ResidentModel, incoming: ResidentModel) -> bool:
+        """Move `model` off the device to make room for `incoming`. Returns
+        False if it is no longer idle."""
+        if not self._start_move(model):
+            return False
+        if model.num_bytes <= self.max_cpu_bytes:
+            used = self._get_tier_bytes("cpu", model)
+            if incoming.tier == "cpu":
+                # It is about to leave for the device.
+                used -= incoming.num_bytes
+            for victim in self._get_victims("cpu", model):
+                if used + model.num_bytes <= self.max_cpu_bytes:
+                    break
+                if self._start_move(victim):
+                    self._move(victim, "disk")
+                    used -= victim.num_bytes
+            if used + model.num_bytes <= self.max_cpu_bytes:
+                self._move(model, "cpu")
+                return True
+        self._move(model, "disk")
+        return True
+
+    def _move(self, model: ResidentModel, tier: str):
+        """Move a model to a tier. Called with the move lock, but without the
+        lock."""
+        tic = time.time()
+        worker = model.worker
+        if tier == "disk":
+            worker.model = None
+            gc.collect()
+        elif model.tier == "disk":
+            worker.model = model.load_fn()
+            model.num_bytes = get_model_bytes(worker.model)
+            if tier == "cpu":
+                worker.model.to("cpu")
+        else:
+            worker.model.to(self.device if tier == "device" else "cpu")
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+        logger.info(
+            f"Moved {model.name} from {model.tier} to {tier} "
+            f"in {time.time() - tic:.2f}s"
+        )
+        with self.lock:
+            model.tier = tier
+            model.moving = False
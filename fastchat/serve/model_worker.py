@@ -3,7 +3,9 @@ A model worker executes the model.
 """
 import argparse
 import asyncio
+import contextlib
 import dataclasses
+import functools
 import logging
 import json
 import os
@@ -13,7 +15,8 @@ import threading
 import uuid
 
 from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse, JSONResponse
 import requests
 
 try:
@@ -30,14 +33,28 @@ except ImportError:
         LLaMATokenizer,
         AutoModel,
     )
+import numpy as np
 import torch
-import torch.nn.functional as F
 import uvicorn
 
 from fastchat.constants import WORKER_HEART_BEAT_INTERVAL, ErrorCode, SERVER_ERROR_MSG
 from fastchat.model.model_adapter import load_model, add_model_args
 from fastchat.model.chatglm_model import chatglm_generate_stream
+from fastchat.model.multi_lora import MultiLoRA
+from fastchat.serve.continuous_batching import ContinuousBatchingEngine
+from fastchat.serve.embedding import DEFAULT_MAX_BATCH_TOKENS, compute_embeddings
+from fastchat.serve.embedding_cache import (
+    add_embedding_cache_args,
+    create_embedding_cache,
+)
+from fastchat.serve.embedding_protocol import encode_embeddings, get_embedding_dtype
+from fastchat.serve.http_client import get_session
 from fastchat.serve.inference import generate_stream
+from fastchat.serve.kv_cache import KVCacheBudget, PagedKVCache, get_block_bytes
+from fastchat.serve.prefix_cache import PrefixCache, PrefixCacheView
+from fastchat.serve.speculative_decoding import speculative_generate_stream
+from fastchat.serve.stream_protocol import encode_json_frame, get_stream_encoder
+from fastchat.serve.worker_load import CHARS_PER_TOKEN, WorkerLoad
 from fastchat.utils import build_logger, pretty_print_semaphore
 
 GB = 1 << 30
@@ -47,6 +64,7 @@ logger = build_logger("model_worker", f"model_worker_{worker_id}.log")
 global_counter = 0
 
 model_semaphore = None
+embedding_batcher = None
 
 
 def heart_beat_worker(controller):
@@ -71,6 +89,18 @@ class ModelWorker:
         max_gpu_memory,
         load_8bit=False,
         cpu_offloading=False,
+        continuous_batching=False,
+        max_batch_size=8,
+        kv_cache_blocks=0,
+        kv_block_size=16,
+        prefix_cache_blocks=0,
+        draft_model_path=None,
+        num_speculative_tokens=4,
+        compression_policy=None,
+        stream_interval=2,
+        lora_adapters=None,
+        embedding_max_batch_tokens=DEFAULT_MAX_BATCH_TOKENS,
+        embedding_cache=None,
     ):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
@@ -79,11 +109,25 @@ class ModelWorker:
             model_path = model_path[:-1]
         self.model_name = model_name or model_path.split("/")[-1]
         self.device = device
+        self.stream_interval = stream_interval
+        self.embedding_max_batch_tokens = embedding_max_batch_tokens
+        self.embedding_cache = embedding_cache
 
         logger.info(f"Loading the model {self.model_name} on worker {worker_id} ...")
-        self.model, self.tokenizer = load_model(
-            model_path, device, num_gpus, max_gpu_memory, load_8bit, wbits, groupsize, cpu_offloading
+        # Also used to load the model again after it was unloaded
+        self.load_model_fn = functools.partial(
+            load_model,
+            model_path,
+            device,
+            num_gpus,
+            max_gpu_memory,
+            load_8bit,
+            wbits,
+            groupsize,
+            cpu_offloading,
+            compression_policy=compression_policy,
         )
+        self.model, self.tokenizer = self.load_model_fn()
         if self.tokenizer.pad_token == None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
 
@@ -94,12 +138,97 @@ class ModelWorker:
         else:
             self.context_len = 2048
 
+        # Requests pick an adapter by its name as their model.
+        self.lora = None
+        if lora_adapters:
+            logger.info(f"Loading the LoRA adapters {list(lora_adapters)} ...")
+            self.lora = MultiLoRA(self.model, lora_adapters)
+
         # generate_stream
         is_chatglm = "chatglm" in str(type(self.model)).lower()
+        is_decoder_only = not (is_chatglm or self.model.config.is_encoder_decoder)
+        self.kv_budget = None
+        if kv_cache_blocks > 0 and is_decoder_only:
+            self.kv_budget = KVCacheBudget(kv_cache_blocks, kv_block_size)
+            block_bytes = get_block_bytes(
+                self.model.config, kv_block_size, self.model.dtype
+            )
+            logger.info(
+                f"KV cache budget: {kv_cache_blocks} blocks of {kv_block_size} "
+                f"tokens, {kv_cache_blocks * block_bytes / GB:.2f} GB"
+            )
+        self.prefix_cache = None
+        if prefix_cache_blocks > 0 and is_decoder_only:
+            prefix_kv_cache = PagedKVCache.from_model_config(
+                self.model.config,
+                prefix_cache_blocks,
+                kv_block_size,
+                dtype=self.model.dtype,
+                device=device,
+            )
+            self.prefix_cache = PrefixCache(prefix_kv_cache)
+            cache_size = prefix_cache_blocks * prefix_kv_cache.get_block_bytes() / GB
+            logger.info(
+                f"Prefix cache: {prefix_cache_blocks} blocks of {kv_block_size} "
+                f"tokens, {cache_size:.2f} GB"
+            )
+        self.draft_model = None
+        if draft_model_path:
+            if not is_decoder_only:
+                logger.warning(
+                    f"Speculative decoding is not supported for {self.model_name}."
+                )
+            elif continuous_batching:
+                logger.warning(
+                    "Speculative decoding is ignored with continuous batching."
+                )
+            else:
+                logger.info(f"Loading the draft model {draft_model_path} ...")
+                self.draft_model, _ = load_model(
+                    draft_model_path,
+                    device,
+                    num_gpus,
+                    max_gpu_memory,
+                    load_8bit,
+                    cpu_offloading=cpu_offloading,
+                    compression_policy=compression_policy,
+                )
         if is_chatglm:
             self.generate_stream_func = chatglm_generate_stream
+        elif self.draft_model is not None:
+            self.generate_stream_func = functools.partial(
+                speculative_generate_stream,
+                draft_model=self.draft_model,
+                num_speculative_tokens=num_speculative_tokens,
+                kv_budget=self.kv_budget,
+                prefix_cache=self.prefix_cache,
+            )
         else:
-            self.generate_stream_func = generate_stream
+            self.generate_stream_func = functools.partial(
+                generate_stream,
+                kv_budget=self.kv_budget,
+                prefix_cache=self.prefix_cache,
+            )
+
+        self.batching_engine = None
+        if continuous_batching:
+            if not is_decoder_only:
+                logger.warning(
+                    f"Continuous batching is not supported for {self.model_name}."
+                )
+            else:
+                self.batching_engine = ContinuousBatchingEngine(
+                    self.model,
+                    self.tokenizer,
+                    device,
+                    max_batch_size,
+                    self.kv_budget,
+                    self.prefix_cache,
+                    self.lora,
+                )
+                self.generate_stream_func = self.batching_engine.generate_stream
+
+        self.load = WorkerLoad()
 
         if not no_register:
             self.register_to_controller()
@@ -117,12 +246,12 @@ class ModelWorker:
             "check_heart_beat": True,
             "worker_status": self.get_status(),
         }
-        r = requests.post(url, json=data)
+        r = get_session().post(url, json=data)
         assert r.status_code == 200
 
     def send_heart_beat(self):
         logger.info(
-            f"Send heart beat. Models: {[self.model_name]}. "
+            f"Send heart beat. Models: {self.get_model_names()}. "
             f"Semaphore: {pretty_print_semaphore(model_semaphore)}. "
             f"global_counter: {global_counter}"
         )
@@ -131,11 +260,12 @@ class ModelWorker:
 
         while True:
             try:
-                ret = requests.post(
+                ret = get_session().post(
                     url,
                     json={
                         "worker_name": self.worker_addr,
                         "queue_length": self.get_queue_length(),
+                        "load": self.get_load(),
                     },
                     timeout=5,
                 )
@@ -157,17 +287,40 @@ class ModelWorker:
             return 0
         else:
             return (
-                args.limit_model_concurrency
+                get_model_concurrency()
                 - model_semaphore._value
                 + len(model_semaphore._waiters)
             )
 
+    def get_load(self):
+        load = self.load.get_status()
+        load["free_kv_tokens"] = (
+            self.kv_budget.get_num_free_tokens() if self.kv_budget is not None else None
+        )
+        return load
+
+    def get_model_names(self):
+        if self.lora is None:
+            return [self.model_name]
+        return [self.model_name] + self.lora.adapter_names
+
     def get_status(self):
-        return {
-            "model_names": [self.model_name],
+        status = {
+            "model_names": self.get_model_names(),
             "speed": 1,
             "queue_length": self.get_queue_length(),
+            "context_length": self.context_len,
+            **self.get_load(),
         }
+        if self.kv_budget is not None:
+            status["kv_budget"] = self.kv_budget.get_status()
+        if self.prefix_cache is not None:
+            status["prefix_cache"] = self.prefix_cache.get_status()
+        if self.lora is not None:
+            status["lora_adapters"] = self.lora.get_status()
+        if self.embedding_cache is not None:
+            status["embedding_cache"] = self.embedding_cache.get_status()
+        return status
 
     def count_token(self, params):
         prompt = params["prompt"]
@@ -180,58 +333,140 @@ class ModelWorker:
         }
         return ret
 
-    def generate_stream_gate(self, params):
+    def check_length(self, params):
+        """Return an error if the prompt and `max_new_tokens` do not fit into the
+        context, so that clients can validate and generate in one call."""
+        max_new_tokens = int(params.get("max_new_tokens", 256))
+        token_num = self.count_token(params)["count"]
+        if token_num + max_new_tokens <= self.context_len:
+            return None
+        return {
+            "text": f"This model's maximum context length is {self.context_len} tokens. "
+            f"However, you requested {max_new_tokens + token_num} tokens "
+            f"({token_num} in the messages, "
+            f"{max_new_tokens} in the completion). "
+            f"Please reduce the length of the messages or completion.",
+            "error_code": ErrorCode.CONTEXT_OVERFLOW,
+        }
+
+    def start_request(self, params):
+        """Count a generation request as load from the moment it is queued.
+
+        This runs on the event loop, so the prompt tokens are estimated from
+        the characters like the dispatchers do instead of tokenizing it.
+        """
+        max_new_tokens = int(params.get("max_new_tokens", 256))
+        return self.load.start_request(
+            len(str(params.get("prompt", ""))) // CHARS_PER_TOKEN,
+            max_new_tokens * int(params.get("n", 1)),
+        )
+
+    def generate_stream(self, params):
+        if self.lora is None or self.batching_engine is not None:
+            # The continuous batching engine picks the adapters itself.
+            yield from self._generate_stream(params)
+            return
+
+        adapter_id = self.lora.get_adapter_id(params.get("model", None))
+        kwargs = {}
+        if self.prefix_cache is not None:
+            kwargs["prefix_cache"] = PrefixCacheView(self.prefix_cache, adapter_id)
+        yield from self.lora.generate_with_adapter(
+            self._generate_stream(params, **kwargs), adapter_id
+        )
+
+    def _generate_stream(self, params, **kwargs):
+        n = int(params.get("n", 1))
+        if n > 1 and self.generate_stream_func is chatglm_generate_stream:
+            # chatglm decodes one sequence at a time
+            for i in range(n):
+                for output in chatglm_generate_stream(
+                    self.model,
+                    self.tokenizer,
+                    params,
+                    self.device,
+                    self.context_len,
+                    self.stream_interval,
+                ):
+                    yield {**output, "index": i}
+            return
+
+        yield from self.generate_stream_func(
+            self.model,
+            self.tokenizer,
+            params,
+            self.device,
+            self.context_len,
+            self.stream_interval,
+            **kwargs,
+        )
+
+    def generate_stream_gate(self, params, request_load=None):
+        encoder = get_stream_encoder(params)
+        encode = encoder.encode if encoder is not None else encode_json_frame
+        if params.get("check_length", False):
+            ret = self.check_length(params)
+            if ret is not None:
+                yield encode(ret)
+                return
         try:
-            for output in self.generate_stream_func(
-                self.model,
-                self.tokenizer,
-                params,
-                self.device,
-                self.context_len,
-                args.stream_interval,
-            ):
+            for output in self.generate_stream(params):
+                if request_load is not None:
+                    self.load.update_request(request_load, output)
                 ret = {
                     "text": output["text"],
                     "error_code": 0,
                 }
+                if "index" in output:
+                    ret["index"] = output["index"]
                 if "usage" in output:
                     ret["usage"] = output["usage"]
                 if "finish_reason" in output:
                     ret["finish_reason"] = output["finish_reason"]
                 if "logprobs" in output:
                     ret["logprobs"] = output["logprobs"]
-                yield json.dumps(ret).encode() + b"\0"
+                yield encode(ret)
         except torch.cuda.OutOfMemoryError as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
             }
-            yield json.dumps(ret).encode() + b"\0"
+            yield encode(ret)
         except (ValueError, RuntimeError) as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.INTERNAL_ERROR,
             }
-            yield json.dumps(ret).encode() + b"\0"
-
-    def generate_gate(self, params):
+            yield encode(ret)
+
+    def generate_gate(self, params, request_load=None):
+        """Generate the whole output. With `n` > 1 the completions are in "choices"."""
+        if params.get("check_length", False):
+            ret = self.check_length(params)
+            if ret is not None:
+                return ret
         try:
-            ret = {"text": "", "error_code": 0}
-            for output in self.generate_stream_func(
-                self.model,
-                self.tokenizer,
-                params,
-                self.device,
-                self.context_len,
-                args.stream_interval,
-            ):
-                ret["text"] = output["text"]
-            if "usage" in output:
-                ret["usage"] = output["usage"]
-            if "finish_reason" in output:
-                ret["finish_reason"] = output["finish_reason"]
-            if "logprobs" in output:
-                ret["logprobs"] = output["logprobs"]
+            # Dict[index -> last output]
+            outputs = {}
+            for output in self.generate_stream(params):
+                if request_load is not None:
+                    self.load.update_request(request_load, output)
+                outputs[output.get("index", 0)] = output
+            choices = []
+            for i in sorted(outputs):
+                output = outputs[i]
+                choice = {"text": output["text"], "error_code": 0}
+                if "usage" in output:
+                    choice["usage"] = output["usage"]
+                if "finish_reason" in output:
+                    choice["finish_reason"] = output["finish_reason"]
+                if "logprobs" in output:
+                    choice["logprobs"] = output["logprobs"]
+                choices.append(choice)
+            if int(params.get("n", 1)) > 1:
+                ret = {"choices": choices, "error_code": 0}
+            else:
+                ret = choices[0] if choices else {"text": "", "error_code": 0}
         except torch.cuda.OutOfMemoryError as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
@@ -244,68 +479,195 @@ class ModelWorker:
             }
         return ret
 
-    @torch.inference_mode()
     def get_embeddings(self, params):
+        """Returns the float32 embeddings [len(input), dim] in "embedding"."""
+        return self.get_embeddings_batch([params])[0]
+
+    def get_embeddings_batch(self, params_list):
+        """Embed the inputs of several requests for the same model or adapter
+        in one batch. Returns the response of every request."""
+        texts = [text for params in params_list for text in params["input"]]
         try:
-            tokenizer = self.tokenizer
-            is_llama = "llama" in str(type(self.model)) # vicuna support batch inference
-            is_chatglm = "chatglm" in str(type(self.model))
-            is_t5 = "t5" in str(type(self.model))
-            if is_llama:
-                encoding = tokenizer.batch_encode_plus(
-                    params["input"], padding=True, return_tensors="pt"
-                )
-                input_ids = encoding["input_ids"].to(self.device)
-                attention_mask = encoding["attention_mask"].to(self.device)
-                model_output = self.model(
-                    input_ids, attention_mask, output_hidden_states=True
-                )
-                data = model_output.hidden_states[-1]
-                mask = attention_mask.unsqueeze(-1).expand(data.size()).float()
-                masked_embeddings = data * mask
-                sum_embeddings = torch.sum(masked_embeddings, dim=1)
-                seq_length = torch.sum(mask, dim=1)
-                embedding = sum_embeddings / seq_length
-                normalized_embeddings = F.normalize(embedding, p=2, dim=1)
-                ret = {
-                    "embedding": normalized_embeddings.tolist(),
-                    "token_num": torch.sum(attention_mask).item(),
-                }
-            else:
-                embedding = []
-                token_num = 0
-                for text in params["input"]:
-                    input_ids = tokenizer.encode(text, return_tensors="pt").to(
-                        self.device
-                    )
-                    if is_t5:
-                        model_output = self.model(input_ids, decoder_input_ids=input_ids)
-                    else:
-                        model_output = self.model(input_ids, output_hidden_states=True)
-                    if is_chatglm:
-                        data = (model_output.hidden_states[-1].transpose(0, 1))[0]
-                    elif is_t5:
-                        data = model_output.encoder_last_hidden_state[0]
-                    else:
-                        data = model_output.hidden_states[-1][0]
-                    data = F.normalize(torch.mean(data, dim=0), p=2, dim=0)
-                    embedding.append(data.tolist())
-                    token_num += len(input_ids[0])
-                ret = {
-                    "embedding": embedding,
-                    "token_num": token_num,
-                }
+            embeddings, token_nums = self._embed_texts(params_list[0], texts)
         except torch.cuda.OutOfMemoryError as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
             }
+            return [ret] * len(params_list)
         except (ValueError, RuntimeError) as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.INTERNAL_ERROR,
             }
-        return ret
+            return [ret] * len(params_list)
+
+        rets = []
+        start = 0
+        for params in params_list:
+            end = start + len(params["input"])
+            rets.append(
+                {
+                    "embedding": embeddings[start:end],
+                    "token_num": sum(token_nums[start:end]),
+                }
+            )
+            start = end
+        return rets
+
+    def get_embedding_model_name(self, params):
+        """Get the name of the adapter or model that embeds a request."""
+        if self.lora is not None:
+            adapter_id = self.lora.get_adapter_id(params.get("model", None))
+            if adapter_id > 0:
+                return self.lora.adapter_names[adapter_id - 1]
+        return self.model_name
+
+    def _embed_texts(self, params, texts):
+        """Returns the embeddings and the tokens of every text, 0 for the
+        texts found in the cache."""
+        if not texts:
+            return np.empty((0, self.model.config.hidden_size), np.float32), []
+        if self.embedding_cache is None:
+            return self._compute_embeddings(params, texts)
+        # Only the texts missing from the cache are embedded and counted.
+        model_name = self.get_embedding_model_name(params)
+        embeddings = self.embedding_cache.get(model_name, texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        token_nums = [0] * len(texts)
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            missing_embeddings, missing_token_nums = self._compute_embeddings(
+                params, missing_texts
+            )
+            self.embedding_cache.put(model_name, missing_texts, missing_embeddings)
+            for i, embedding, token_num in zip(
+                missing, missing_embeddings, missing_token_nums
+            ):
+                embeddings[i] = embedding
+                token_nums[i] = token_num
+        return np.stack(embeddings), token_nums
+
+    def _compute_embeddings(self, params, texts):
+        adapters = contextlib.nullcontext()
+        if self.lora is not None:
+            adapter_id = self.lora.get_adapter_id(params.get("model", None))
+            adapters = self.lora.use_adapters([adapter_id])
+        with adapters:
+            embeddings, token_nums = compute_embeddings(
+                self.model,
+                self.tokenizer,
+                texts,
+                self.device,
+                self.embedding_max_batch_tokens,
+            )
+        return embeddings.numpy(), token_nums
+
+
+class EmbeddingBatcher:
+    """Coalesce the embedding requests of concurrent callers into batches.
+
+    The first request of a batch waits up to `max_wait` seconds for others,
+    and the requests that arrive while a batch runs join the next one. A
+    batch takes requests until it has about `max_tokens` tokens, and runs
+    one forward pass for every model or LoRA adapter in it.
+    """
+
+    def __init__(self, worker: ModelWorker, max_wait: float, max_tokens: int):
+        self.worker = worker
+        self.max_wait = max_wait
+        self.max_tokens = max_tokens
+        # Created in the event loop by the first request
+        self.queue = None
+        self.task = None
+
+    async def get_embeddings(self, params):
+        error = self._validate(params)
+        if error is not None:
+            return error
+        if self.task is None or self.task.done():
+            if self.task is not None and not self.task.cancelled():
+                logger.error(f"Embedding batcher stopped: {self.task.exception()}")
+            self.queue = asyncio.Queue()
+            self.task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((params, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            try:
+                num_tokens = self._estimate_tokens(items[0][0])
+                deadline = loop.time() + self.max_wait
+                while num_tokens < self.max_tokens:
+                    timeout = deadline - loop.time()
+                    try:
+                        if timeout > 0:
+                            item = await asyncio.wait_for(self.queue.get(), timeout)
+                        else:
+                            item = self.queue.get_nowait()
+                    except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                        break
+                    items.append(item)
+                    num_tokens += self._estimate_tokens(item[0])
+
+                # Dict[model name -> List[(params, future)]]
+                groups = {}
+                for params, future in items:
+                    model_name = self.worker.get_embedding_model_name(params)
+                    groups.setdefault(model_name, []).append((params, future))
+            except Exception as e:
+                # Fail the requests of this batch, but keep serving the next.
+                self._set_results([future for _, future in items], [e] * len(items))
+                continue
+            for group in groups.values():
+                await self._run_batch(group)
+
+    async def _run_batch(self, group):
+        await acquire_model_semaphore()
+        try:
+            rets = await run_in_threadpool(
+                self.worker.get_embeddings_batch, [params for params, _ in group]
+            )
+        except Exception as e:
+            rets = [e] * len(group)
+        finally:
+            release_model_semaphore()
+        self._set_results([future for _, future in group], rets)
+
+    @staticmethod
+    def _set_results(futures, rets):
+        for future, ret in zip(futures, rets):
+            if future.done():
+                # The client went away.
+                continue
+            if isinstance(ret, Exception):
+                future.set_exception(ret)
+            else:
+                future.set_result(ret)
+
+    @staticmethod
+    def _validate(params):
+        """Return an error for a request that could not join a batch."""
+        texts = params.get("input", None)
+        model_name = params.get("model", None)
+        if (
+            not isinstance(texts, list)
+            or not all(isinstance(text, str) for text in texts)
+            or not (model_name is None or isinstance(model_name, str))
+        ):
+            return {
+                "text": "The input of an embedding request must be a list of "
+                "strings, and its model a string.",
+                "error_code": ErrorCode.VALIDATION_TYPE_ERROR,
+            }
+        return None
+
+    @staticmethod
+    def _estimate_tokens(params):
+        return sum(len(text) for text in params["input"]) // CHARS_PER_TOKEN + 1
 
 
 app = FastAPI()
@@ -315,63 +677,95 @@ def release_model_semaphore():
     model_semaphore.release()
 
 
+def get_model_concurrency():
+    """With continuous batching, admit at least a full batch at a time."""
+    if args.continuous_batching:
+        return max(args.limit_model_concurrency, args.max_batch_size)
+    return args.limit_model_concurrency
+
+
 def acquire_model_semaphore():
     global model_semaphore, global_counter
     global_counter += 1
     if model_semaphore is None:
-        model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
+        model_semaphore = asyncio.Semaphore(get_model_concurrency())
     return model_semaphore.acquire()
 
 
-def create_background_tasks():
+def create_background_tasks(request_load=None):
     background_tasks = BackgroundTasks()
     background_tasks.add_task(release_model_semaphore)
+    if request_load is not None:
+        background_tasks.add_task(worker.load.finish_request, request_load)
     return background_tasks
 
 
+def create_embedding_response(params, embedding, background=None):
+    """Answer in the binary format if the client asked for it, and in JSON
+    otherwise."""
+    if "embedding" not in embedding:
+        return JSONResponse(embedding, background=background)
+    dtype = get_embedding_dtype(params)
+    if dtype is None:
+        embedding = {**embedding, "embedding": embedding["embedding"].tolist()}
+        return JSONResponse(embedding, background=background)
+    content = encode_embeddings(embedding["embedding"], embedding["token_num"], dtype)
+    return Response(
+        content, media_type="application/octet-stream", background=background
+    )
+
+
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
     params = await request.json()
+    request_load = worker.start_request(params)
     await acquire_model_semaphore()
-    generator = worker.generate_stream_gate(params)
-    background_tasks = create_background_tasks()
+    generator = worker.generate_stream_gate(params, request_load)
+    background_tasks = create_background_tasks(request_load)
     return StreamingResponse(generator, background=background_tasks)
 
 
 @app.post("/worker_generate")
 async def api_generate(request: Request):
     params = await request.json()
+    request_load = worker.start_request(params)
     await acquire_model_semaphore()
-    output = worker.generate_gate(params)
+    output = await run_in_threadpool(worker.generate_gate, params, request_load)
     release_model_semaphore()
+    worker.load.finish_request(request_load)
     return JSONResponse(output)
 
 
 @app.post("/worker_generate_completion_stream")
 async def api_generate_completion_stream(request: Request):
     params = await request.json()
+    request_load = worker.start_request(params)
     await acquire_model_semaphore()
-    generator = worker.generate_stream_gate(params)
-    background_tasks = create_background_tasks()
+    generator = worker.generate_stream_gate(params, request_load)
+    background_tasks = create_background_tasks(request_load)
     return StreamingResponse(generator, background=background_tasks)
 
 
 @app.post("/worker_generate_completion")
 async def api_generate_completion(request: Request):
     params = await request.json()
+    request_load = worker.start_request(params)
     await acquire_model_semaphore()
-    completion = worker.generate_gate(params)
-    background_tasks = create_background_tasks()
+    completion = await run_in_threadpool(worker.generate_gate, params, request_load)
+    background_tasks = create_background_tasks(request_load)
     return JSONResponse(content=completion, background=background_tasks)
 
 
 @app.post("/worker_get_embeddings")
 async def api_get_embeddings(request: Request):
     params = await request.json()
+    if embedding_batcher is not None:
+        embedding = await embedding_batcher.get_embeddings(params)
+        return create_embedding_response(params, embedding)
     await acquire_model_semaphore()
-    embedding = worker.get_embeddings(params)
+    embedding = await run_in_threadpool(worker.get_embeddings, params)
     background_tasks = create_background_tasks()
-    return JSONResponse(content=embedding, background=background_tasks)
+    return create_embedding_response(params, embedding, background_tasks)
 
 
 @app.post("/worker_get_status")
@@ -405,6 +799,77 @@ if __name__ == "__main__":
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument("--wbits", type=int, default = 0)
     parser.add_argument("--groupsize", type=int, default = 0)
+    parser.add_argument(
+        "--continuous-batching",
+        action="store_true",
+        help="Admit new requests into the running batch at every decode step. "
+        "The concurrency limit is raised to at least --max-batch-size.",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=8,
+        help="The maximum number of sequences decoded together with --continuous-batching",
+    )
+    parser.add_argument(
+        "--kv-cache-blocks",
+        type=int,
+        default=0,
+        help="The kv cache budget in blocks. Every request reserves the blocks of "
+        "its prompt and max_new_tokens up front, and requests that do not fit "
+        "are rejected or queued. 0 disables the budget.",
+    )
+    parser.add_argument(
+        "--kv-block-size", type=int, default=16, help="The number of tokens per block"
+    )
+    parser.add_argument(
+        "--prefix-cache-blocks",
+        type=int,
+        default=0,
+        help="The number of kv cache blocks that keep shared prompt prefixes "
+        "(system prompts, chat history) across requests. 0 disables the prefix cache.",
+    )
+    parser.add_argument(
+        "--draft-model-path",
+        type=str,
+        default=None,
+        help="A small model with the same tokenizer that proposes tokens for "
+        "speculative decoding. It lowers the latency at batch size 1.",
+    )
+    parser.add_argument(
+        "--num-speculative-tokens",
+        type=int,
+        default=4,
+        help="The number of tokens proposed by the draft model at every step",
+    )
+    parser.add_argument(
+        "--lora-path",
+        type=str,
+        action="append",
+        help="A PEFT LoRA adapter of the model, served under its own model name "
+        "without merging it. Repeat it for every adapter.",
+    )
+    parser.add_argument(
+        "--lora-name",
+        type=str,
+        action="append",
+        help="Optional model names, one per --lora-path",
+    )
+    parser.add_argument(
+        "--embedding-max-batch-tokens",
+        type=int,
+        default=DEFAULT_MAX_BATCH_TOKENS,
+        help="The maximum number of tokens, padding included, of an embedding batch",
+    )
+    parser.add_argument(
+        "--embedding-batch-wait-ms",
+        type=float,
+        default=None,
+        help="Coalesce the embedding requests that arrive within this many "
+        "milliseconds, or while the model is busy, into one forward pass of up "
+        "to --embedding-max-batch-tokens tokens. Disabled by default.",
+    )
+    add_embedding_cache_args(parser)
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
@@ -414,6 +879,14 @@ if __name__ == "__main__":
                 f"Larger --num-gpus ({args.num_gpus}) than --gpus {args.gpus}!"
             )
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
+    lora_paths = args.lora_path or []
+    if args.lora_name and len(args.lora_name) != len(lora_paths):
+        raise ValueError("Give one --lora-name for every --lora-path.")
+    lora_names = args.lora_name or [
+        path.rstrip("/").split("/")[-1] for path in lora_paths
+    ]
+    if len(set(lora_names)) != len(lora_names):
+        raise ValueError(f"The LoRA adapters need distinct names: {lora_names}")
 
     worker = ModelWorker(
         args.controller_address,
@@ -429,6 +902,22 @@ if __name__ == "__main__":
         args.max_gpu_memory,
         args.load_8bit,
         args.cpu_offloading,
+        args.continuous_batching,
+        args.max_batch_size,
+        args.kv_cache_blocks,
+        args.kv_block_size,
+        args.prefix_cache_blocks,
+        args.draft_model_path,
+        args.num_speculative_tokens,
+        args.compression_policy,
+        args.stream_interval,
+        dict(zip(lora_names, lora_paths)),
+        args.embedding_max_batch_tokens,
+        create_embedding_cache(args),
     )
+    if args.embedding_batch_wait_ms is not None:
+        embedding_batcher = EmbeddingBatcher(
+            worker, args.embedding_batch_wait_ms / 1000, args.embedding_max_batch_tokens
+        )
 
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
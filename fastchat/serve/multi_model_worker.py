@@ -0,0 +1,402 @@
+"""
+A multi-model worker serves several models from one process.
+
+The most used models stay on the device within --device-memory-gb. The
+others are moved to CPU memory (up to --cpu-memory-gb) or unloaded, and
+brought back when a request needs them. The worker reports which models
+are warm, so the controller prefers the workers that have a model on the
+device.
+
+Usage:
+python3 -m fastchat.serve.multi_model_worker --model-path lmsys/vicuna-7b-v1.3 --model-path lmsys/fastchat-t5-3b-v1.0 --device-memory-gb 20 --cpu-memory-gb 60
+"""
+import argparse
+import asyncio
+import os
+import threading
+import time
+
+from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, JSONResponse
+import requests
+import uvicorn
+
+from fastchat.constants import WORKER_HEART_BEAT_INTERVAL, ErrorCode, SERVER_ERROR_MSG
+from fastchat.model.model_adapter import add_model_args
+from fastchat.serve.embedding import DEFAULT_MAX_BATCH_TOKENS
+from fastchat.serve.embedding_cache import (
+    add_embedding_cache_args,
+    create_embedding_cache,
+)
+from fastchat.serve.http_client import get_session
+from fastchat.serve.model_residency import EVICTION_POLICIES, ModelResidency
+from fastchat.serve.model_worker import (
+    ModelWorker,
+    create_embedding_response,
+    logger,
+    worker_id,
+)
+from fastchat.utils import pretty_print_semaphore
+
+GB = 1 << 30
+
+global_counter = 0
+
+model_semaphore = None
+
+
+def heart_beat_worker(controller):
+    while True:
+        time.sleep(WORKER_HEART_BEAT_INTERVAL)
+        controller.send_heart_beat()
+
+
+class MultiModelWorker:
+    """Register the models of several `ModelWorker`s as one worker, and
+    page their models in and out of the device."""
+
+    def __init__(
+        self,
+        controller_addr,
+        worker_addr,
+        no_register,
+        residency: ModelResidency,
+        embedding_cache=None,
+    ):
+        self.controller_addr = controller_addr
+        self.worker_addr = worker_addr
+        self.residency = residency
+        self.embedding_cache = embedding_cache
+        # Dict[model name -> ModelWorker]
+        self.workers = {}
+        self.no_register = no_register
+
+    def add_worker(self, worker: ModelWorker):
+        self.workers[worker.model_name] = worker
+        self.residency.add(worker.model_name, worker, lambda: worker.load_model_fn()[0])
+
+    def start(self):
+        if not self.no_register:
+            self.register_to_controller()
+            self.heart_beat_thread = threading.Thread(
+                target=heart_beat_worker, args=(self,)
+            )
+            self.heart_beat_thread.start()
+
+    def register_to_controller(self):
+        logger.info("Register to controller")
+
+        url = self.controller_addr + "/register_worker"
+        data = {
+            "worker_name": self.worker_addr,
+            "check_heart_beat": True,
+            "worker_status": self.get_status(),
+        }
+        r = get_session().post(url, json=data)
+        assert r.status_code == 200
+
+    def send_heart_beat(self):
+        logger.info(
+            f"Send heart beat. Models: {list(self.workers)}. "
+            f"Warm models: {self.residency.get_warm_models()}. "
+            f"Semaphore: {pretty_print_semaphore(model_semaphore)}. "
+            f"global_counter: {global_counter}"
+        )
+
+        url = self.controller_addr + "/receive_heart_beat"
+
+        while True:
+            try:
+                ret = get_session().post(
+                    url,
+                    json={
+                        "worker_name": self.worker_addr,
+                        "queue_length": self.get_queue_length(),
+                        "load": self.get_load(),
+                    },
+                    timeout=5,
+                )
+                exist = ret.json()["exist"]
+                break
+            except requests.exceptions.RequestException as e:
+                logger.error(f"heart beat error: {e}")
+            time.sleep(5)
+
+        if not exist:
+            self.register_to_controller()
+
+    def get_queue_length(self):
+        if (
+            model_semaphore is None
+            or model_semaphore._value is None
+            or model_semaphore._waiters is None
+        ):
+            return 0
+        else:
+            return (
+                args.limit_model_concurrency
+                - model_semaphore._value
+                + len(model_semaphore._waiters)
+            )
+
+    def get_load(self):
+        loads = [worker.get_load() for worker in self.workers.values()]
+        speeds = [load["tokens_per_second"] for load in loads]
+        speeds = [speed for speed in speeds if speed]
+        return {
+            "outstanding_tokens": sum(load["outstanding_tokens"] for load in loads),
+            "tokens_per_second": sum(speeds) / len(speeds) if speeds else None,
+            "free_kv_tokens": None,
+            "warm_models": self.residency.get_warm_models(),
+        }
+
+    def get_status(self):
+        status = {
+            "model_names": list(self.workers),
+            "speed": 1,
+            "queue_length": self.get_queue_length(),
+            # The shortest one, so that clients never overflow a model
+            "context_length": min(w.context_len for w in self.workers.values()),
+            **self.get_load(),
+            "models": self.residency.get_status(),
+        }
+        if self.embedding_cache is not None:
+            status["embedding_cache"] = self.embedding_cache.get_status()
+        return status
+
+
+app = FastAPI()
+
+
+def get_worker(params):
+    """Get the worker of the requested model. The model may be omitted if
+    there is only one."""
+    model_name = params.get("model", None)
+    if model_name is None and len(multi_worker.workers) == 1:
+        return next(iter(multi_worker.workers.values()))
+    return multi_worker.workers.get(model_name, None)
+
+
+def create_invalid_model_response(params):
+    return JSONResponse(
+        {
+            "text": f"Invalid model: {params.get('model', None)}. "
+            f"This worker serves {list(multi_worker.workers)}.",
+            "error_code": ErrorCode.INVALID_MODEL,
+        },
+        status_code=400,
+    )
+
+
+def release_worker(worker, request_load=None):
+    model_semaphore.release()
+    multi_worker.residency.release(worker.model_name)
+    if request_load is not None:
+        worker.load.finish_request(request_load)
+
+
+async def acquire_worker(worker, request_load=None):
+    """Wait for a slot and for the model to be on the device. Returns an
+    error response if the model could not be moved to the device."""
+    global model_semaphore, global_counter
+    global_counter += 1
+    if model_semaphore is None:
+        model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
+    await model_semaphore.acquire()
+    try:
+        await run_in_threadpool(multi_worker.residency.acquire, worker.model_name)
+    except Exception as e:
+        logger.error(f"Loading {worker.model_name} fails: {e}")
+        model_semaphore.release()
+        if request_load is not None:
+            worker.load.finish_request(request_load)
+        return JSONResponse(
+            {
+                "text": f"{SERVER_ERROR_MSG}\n\n({e})",
+                "error_code": ErrorCode.INTERNAL_ERROR,
+            }
+        )
+    return None
+
+
+def create_background_tasks(worker, request_load=None):
+    background_tasks = BackgroundTasks()
+    background_tasks.add_task(release_worker, worker, request_load)
+    return background_tasks
+
+
+@app.post("/worker_generate_stream")
+@app.post("/worker_generate_completion_stream")
+async def api_generate_stream(request: Request):
+    params = await request.json()
+    worker = get_worker(params)
+    if worker is None:
+        return create_invalid_model_response(params)
+    request_load = worker.start_request(params)
+    error = await acquire_worker(worker, request_load)
+    if error is not None:
+        return error
+    generator = worker.generate_stream_gate(params, request_load)
+    background_tasks = create_background_tasks(worker, request_load)
+    return StreamingResponse(generator, background=background_tasks)
+
+
+@app.post("/worker_generate")
+@app.post("/worker_generate_completion")
+async def api_generate(request: Request):
+    params = await request.json()
+    worker = get_worker(params)
+    if worker is None:
+        return create_invalid_model_response(params)
+    request_load = worker.start_request(params)
+    error = await acquire_worker(worker, request_load)
+    if error is not None:
+        return error
+    output = await run_in_threadpool(worker.generate_gate, params, request_load)
+    background_tasks = create_background_tasks(worker, request_load)
+    return JSONResponse(output, background=background_tasks)
+
+
+@app.post("/worker_get_embeddings")
+async def api_get_embeddings(request: Request):
+    params = await request.json()
+    worker = get_worker(params)
+    if worker is None:
+        return create_invalid_model_response(params)
+    error = await acquire_worker(worker)
+    if error is not None:
+        return error
+    embedding = await run_in_threadpool(worker.get_embeddings, params)
+    background_tasks = create_background_tasks(worker)
+    return create_embedding_response(params, embedding, background_tasks)
+
+
+@app.post("/worker_get_status")
+async def api_get_status(request: Request):
+    return multi_worker.get_status()
+
+
+@app.post("/count_token")
+async def count_token(request: Request):
+    params = await request.json()
+    worker = get_worker(params)
+    if worker is None:
+        return create_invalid_model_response(params)
+    return worker.count_token(params)
+
+
+@app.post("/model_details")
+async def model_details(request: Request):
+    params = await request.json()
+    worker = get_worker(params)
+    if worker is None:
+        return {"context_length": multi_worker.get_status()["context_length"]}
+    return {"context_length": worker.context_len}
+
+
+if __name__ == "__main__":
+    # --model-path is redefined to take several models.
+    parser = argparse.ArgumentParser(conflict_handler="resolve")
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=21002)
+    parser.add_argument("--worker-address", type=str, default="http://localhost:21002")
+    parser.add_argument(
+        "--controller-address", type=str, default="http://localhost:21001"
+    )
+    add_model_args(parser)
+    parser.add_argument(
+        "--model-path",
+        type=str,
+        action="append",
+        required=True,
+        help="The path to the weights. Repeat it for every model.",
+    )
+    parser.add_argument(
+        "--model-name",
+        type=str,
+        action="append",
+        help="Optional display names, one per --model-path",
+    )
+    parser.add_argument("--limit-model-concurrency", type=int, default=5)
+    parser.add_argument("--stream-interval", type=int, default=2)
+    parser.add_argument("--no-register", action="store_true")
+    parser.add_argument(
+        "--device-memory-gb",
+        type=float,
+        default=None,
+        help="The memory of the models kept on the device. Unlimited by default.",
+    )
+    parser.add_argument(
+        "--cpu-memory-gb",
+        type=float,
+        default=0,
+        help="The CPU memory of the models evicted from the device. The models "
+        "that do not fit are unloaded and loaded again from disk.",
+    )
+    parser.add_argument(
+        "--eviction-policy",
+        type=str,
+        choices=EVICTION_POLICIES,
+        default="lru",
+        help="Evict the least recently (lru) or least frequently (lfu) used models",
+    )
+    parser.add_argument(
+        "--embedding-max-batch-tokens",
+        type=int,
+        default=DEFAULT_MAX_BATCH_TOKENS,
+        help="The maximum number of tokens, padding included, of an embedding batch",
+    )
+    add_embedding_cache_args(parser)
+    args = parser.parse_args()
+    logger.info(f"args: {args}")
+
+    if args.num_gpus != 1:
+        raise ValueError("The multi-model worker runs every model on one device.")
+    if args.model_name and len(args.model_name) != len(args.model_path):
+        raise ValueError("Give one --model-name for every --model-path.")
+    if args.gpus:
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
+
+    residency = ModelResidency(
+        args.device,
+        None if args.device_memory_gb is None else int(args.device_memory_gb * GB),
+        int(args.cpu_memory_gb * GB),
+        args.eviction_policy,
+    )
+    # Shared by all models, since the cache keys include the model names
+    embedding_cache = create_embedding_cache(args)
+    multi_worker = MultiModelWorker(
+        args.controller_address,
+        args.worker_address,
+        args.no_register,
+        residency,
+        embedding_cache,
+    )
+    for model_path, model_name in zip(
+        args.model_path, args.model_name or [None] * len(args.model_path)
+    ):
+        multi_worker.add_worker(
+            ModelWorker(
+                args.controller_address,
+                args.worker_address,
+                worker_id,
+                True,
+                model_path,
+                model_name,
+                args.device,
+                args.num_gpus,
+                0,
+                0,
+                args.max_gpu_memory,
+                args.load_8bit,
+                args.cpu_offloading,
+                compression_policy=args.compression_policy,
+                stream_interval=args.stream_interval,
+                embedding_max_batch_tokens=args.embedding_max_batch_tokens,
+                embedding_cache=embedding_cache,
+            )
+        )
+    multi_worker.start()
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -11,23 +11,52 @@ import asyncio
 
 import argparse
 import asyncio
+import base64
 import json
 import logging
 
 import os
-from typing import Generator, Optional, Union, Dict, List, Any
+import random
+from typing import AsyncIterator, Generator, Optional, Tuple, Union, Dict, List, Any
 
 import fastapi
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, JSONResponse
 import httpx
+import numpy as np
 from pydantic import BaseSettings
 import shortuuid
 import tiktoken
 import uvicorn
 
-from fastchat.constants import WORKER_API_TIMEOUT, WORKER_API_EMBEDDING_BATCH_SIZE, ErrorCode
+from fastchat.constants import (
+    ROUTING_TABLE_POLL_TIMEOUT,
+    WORKER_API_TIMEOUT,
+    WORKER_API_EMBEDDING_BATCH_SIZE,
+    WORKER_API_EMBEDDING_BATCH_TOKENS,
+    WORKER_API_EMBEDDING_MAX_INFLIGHT,
+    ErrorCode,
+)
 from fastchat.model.model_adapter import get_conversation_template
+from fastchat.serve.embedding_cache import (
+    add_embedding_cache_args,
+    create_embedding_cache,
+)
+from fastchat.serve.embedding_protocol import (
+    EMBEDDING_DTYPES,
+    decode_embeddings,
+    get_embedding_protocol_params,
+    quantize_embeddings,
+)
+from fastchat.serve.http_client import close_async_client, get_async_client
+from fastchat.serve.stream_protocol import StreamDecoder, get_stream_protocol_params
+from fastchat.serve.worker_load import (
+    CHARS_PER_TOKEN,
+    estimate_num_tokens,
+    get_token_budget_index,
+    get_warm_workers,
+)
 from fastapi.exceptions import RequestValidationError
 from fastchat.protocol.openai_api_protocol import (
     ChatCompletionRequest,
@@ -63,68 +92,158 @@ class AppSettings(BaseSettings):
 
 app_settings = AppSettings()
 
+EMBEDDING_ENCODING_FORMATS = ("float", "base64")
+
 app = fastapi.FastAPI()
 headers = {"User-Agent": "FastChat API Server"}
 
 
+class WorkerRouter:
+    """A local copy of the routing table of the controller.
+
+    It is kept up to date by long polling the controller, so that picking a
+    worker and looking up its context length do not cost a round trip. Until
+    the first table arrives, or for a model missing from it, the controller
+    is asked directly. The poll also returns whenever a heart beat brings a
+    new load, which replaces the load counted locally since the last table.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.load_version = None
+        self.dispatch_method = "shortest_queue"
+        # Dict[worker_addr -> worker info]
+        self.workers = {}
+        # Dict[worker_addr -> context length]
+        self.context_lengths = {}
+
+    def update(self, routing_table: Dict[str, Any]):
+        self.version = routing_table["version"]
+        self.load_version = routing_table.get("load_version", None)
+        self.dispatch_method = routing_table["dispatch_method"]
+        self.workers = routing_table["workers"]
+        for w_name, w_info in self.workers.items():
+            if w_info.get("context_length", None) is not None:
+                self.context_lengths[w_name] = w_info["context_length"]
+
+    def reset(self):
+        self.version = None
+        self.load_version = None
+        self.workers = {}
+
+    def has_model(self, model_name: str) -> bool:
+        return any(
+            model_name in w_info["model_names"] for w_info in self.workers.values()
+        )
+
+    def get_worker_address(self, model_name: str, num_tokens: int = 0) -> str:
+        """Pick a worker like the controller does, or return "" if none serves
+        the model."""
+        worker_names = [
+            w_name
+            for w_name, w_info in self.workers.items()
+            if model_name in w_info["model_names"] and w_info["speed"] > 0
+        ]
+        worker_names = get_warm_workers(
+            worker_names,
+            [self.workers[w_name].get("warm_models") for w_name in worker_names],
+            model_name,
+        )
+        if not worker_names:
+            return ""
+        if self.dispatch_method == "lottery":
+            speeds = [self.workers[w_name]["speed"] for w_name in worker_names]
+            return random.choices(worker_names, weights=speeds)[0]
+        if self.dispatch_method == "token_budget":
+            w_infos = [self.workers[w_name] for w_name in worker_names]
+            w_name = worker_names[
+                get_token_budget_index(
+                    [w_info["outstanding_tokens"] for w_info in w_infos],
+                    [w_info["tokens_per_second"] for w_info in w_infos],
+                    [w_info["free_kv_tokens"] for w_info in w_infos],
+                    num_tokens,
+                )
+            ]
+            # Count the request until the next table brings the real load
+            w_info = self.workers[w_name]
+            w_info["outstanding_tokens"] += num_tokens
+            if w_info["free_kv_tokens"] is not None:
+                w_info["free_kv_tokens"] -= num_tokens
+            return w_name
+        w_name = min(
+            worker_names,
+            key=lambda w: self.workers[w]["queue_length"] / self.workers[w]["speed"],
+        )
+        # Count the request until the next table brings the real queue length
+        self.workers[w_name]["queue_length"] += 1
+        return w_name
+
+
+worker_router = WorkerRouter()
+embedding_cache = None
+
+
+async def sync_routing_table():
+    controller_address = app_settings.controller_address
+    client = get_async_client()
+    while True:
+        try:
+            ret = await client.post(
+                controller_address + "/get_routing_table",
+                json={
+                    "version": worker_router.version,
+                    "load_version": worker_router.load_version,
+                    "timeout": ROUTING_TABLE_POLL_TIMEOUT,
+                },
+                timeout=ROUTING_TABLE_POLL_TIMEOUT + WORKER_API_TIMEOUT,
+            )
+            ret.raise_for_status()
+            worker_router.update(ret.json())
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            logger.warning(f"Sync routing table fails: {e}")
+            worker_router.reset()
+            await asyncio.sleep(ROUTING_TABLE_POLL_TIMEOUT)
+
+
+@app.on_event("startup")
+async def startup_event():
+    app.state.sync_routing_table_task = asyncio.create_task(sync_routing_table())
+
+
 def create_error_response(code: int, message: str) -> JSONResponse:
     return JSONResponse(
         ErrorResponse(message=message, code=code).dict(), status_code=400
     )
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.sync_routing_table_task.cancel()
+    await close_async_client()
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
     return create_error_response(ErrorCode.VALIDATION_TYPE_ERROR, str(exc))
 
 
 async def check_model(request) -> Optional[JSONResponse]:
+    if worker_router.has_model(request.model):
+        return None
+
     controller_address = app_settings.controller_address
     ret = None
-    async with httpx.AsyncClient() as client:
-        try:
-            _worker_addr = await _get_worker_address(request.model, client)
-        except:
-            models_ret = await client.post(controller_address + "/list_models")
-            models = models_ret.json()["models"]
-            ret = create_error_response(
-                ErrorCode.INVALID_MODEL,
-                f"Only {'&&'.join(models)} allowed now, your model {request.model}",
-            )
-    return ret
-
-
-async def check_length(request, prompt, max_tokens):
-    async with httpx.AsyncClient() as client:
-        worker_addr = await _get_worker_address(request.model, client)
-
-        response = await client.post(
-            worker_addr + "/model_details",
-            headers=headers,
-            json={},
-            timeout=WORKER_API_TIMEOUT,
-        )
-        context_len = response.json()["context_length"]
-
-        response = await client.post(
-            worker_addr + "/count_token",
-            headers=headers,
-            json={"prompt": prompt},
-            timeout=WORKER_API_TIMEOUT,
-        )
-        token_num = response.json()["count"]
-
-    if token_num + max_tokens > context_len:
-        return create_error_response(
-            ErrorCode.CONTEXT_OVERFLOW,
-            f"This model's maximum context length is {context_len} tokens. "
-            f"However, you requested {max_tokens + token_num} tokens "
-            f"({token_num} in the messages, "
-            f"{max_tokens} in the completion). "
-            f"Please reduce the length of the messages or completion.",
+    client = get_async_client()
+    try:
+        _worker_addr = await _get_worker_address(request.model, client)
+    except:
+        models_ret = await client.post(controller_address + "/list_models")
+        models = models_ret.json()["models"]
+        ret = create_error_response(
+            ErrorCode.INVALID_MODEL,
+            f"Only {'&&'.join(models)} allowed now, your model {request.model}",
         )
-    else:
-        return None
+    return ret
 
 
 def check_requests(request) -> Optional[JSONResponse]:
@@ -194,6 +313,9 @@ def get_gen_params(
     echo: Optional[bool],
     stream: Optional[bool],
     stop: Optional[Union[str, List[str]]],
+    n: Optional[int] = 1,
+    presence_penalty: Optional[float] = 0.0,
+    frequency_penalty: Optional[float] = 0.0,
 ) -> Dict[str, Any]:
     conv = get_conversation_template(model_name)
 
@@ -228,9 +350,14 @@ def get_gen_params(
         "prompt": prompt,
         "temperature": temperature,
         "top_p": top_p,
+        "presence_penalty": presence_penalty,
+        "frequency_penalty": frequency_penalty,
         "max_new_tokens": max_tokens,
         "echo": echo,
         "stream": stream,
+        "n": n,
+        # The worker validates the length before generating
+        "check_length": True,
     }
 
     if stop is None:
@@ -244,21 +371,26 @@ def get_gen_params(
     return gen_params
 
 
-async def _get_worker_address(model_name: str, client: httpx.AsyncClient) -> str:
+async def _get_worker_address(
+    model_name: str, client: httpx.AsyncClient, num_tokens: int = 0
+) -> str:
     """
     Get worker address based on the requested model
 
     :param model_name: The worker's model name
     :param client: The httpx client to use
+    :param num_tokens: The estimated tokens of the request
     :return: Worker address from the controller
     :raises: :class:`ValueError`: No available worker for requested model
     """
-    controller_address = app_settings.controller_address
-
-    ret = await client.post(
-        controller_address + "/get_worker_address", json={"model": model_name}
-    )
-    worker_addr = ret.json()["address"]
+    worker_addr = worker_router.get_worker_address(model_name, num_tokens)
+    if worker_addr == "":
+        controller_address = app_settings.controller_address
+        ret = await client.post(
+            controller_address + "/get_worker_address",
+            json={"model": model_name, "num_tokens": num_tokens},
+        )
+        worker_addr = ret.json()["address"]
     # No available worker
     if worker_addr == "":
         raise ValueError(f"No available worker for {model_name}")
@@ -267,12 +399,40 @@ async def _get_worker_address(model_name: str, client: httpx.AsyncClient) -> str
     return worker_addr
 
 
+async def _get_context_length(worker_addr: str, client: httpx.AsyncClient) -> int:
+    if worker_addr not in worker_router.context_lengths:
+        response = await client.post(
+            worker_addr + "/model_details",
+            headers=headers,
+            json={},
+            timeout=WORKER_API_TIMEOUT,
+        )
+        worker_router.context_lengths[worker_addr] = response.json()["context_length"]
+    return worker_router.context_lengths[worker_addr]
+
+
+async def peek_stream(
+    frames: AsyncIterator[Dict[str, Any]]
+) -> Tuple[Dict[str, Any], AsyncIterator[Dict[str, Any]]]:
+    """Wait for the first frame of a stream, e.g. to answer a request error
+    before the response starts. Returns the first frame and the whole stream.
+    Raises StopAsyncIteration if the stream is empty."""
+    first_frame = await frames.__anext__()
+
+    async def stream():
+        yield first_frame
+        async for frame in frames:
+            yield frame
+
+    return first_frame, stream()
+
+
 @app.get("/v1/models")
 async def show_available_models():
     controller_address = app_settings.controller_address
-    async with httpx.AsyncClient() as client:
-        ret = await client.post(controller_address + "/refresh_all_workers")
-        ret = await client.post(controller_address + "/list_models")
+    client = get_async_client()
+    ret = await client.post(controller_address + "/refresh_all_workers")
+    ret = await client.post(controller_address + "/list_models")
     models = ret.json()["models"]
     models.sort()
     # TODO: return real model permission details
@@ -289,24 +449,17 @@ async def count_tokens(request: TokenCheckRequest):
     Checks the token count against your message
     This is not part of the OpenAI API spec.
     """
-    async with httpx.AsyncClient() as client:
-        worker_addr = await _get_worker_address(request.model, client)
-
-        response = await client.post(
-            worker_addr + "/model_details",
-            headers=headers,
-            json={},
-            timeout=WORKER_API_TIMEOUT,
-        )
-        context_len = response.json()["context_length"]
-
-        response = await client.post(
-            worker_addr + "/count_token",
-            headers=headers,
-            json={"prompt": request.prompt},
-            timeout=WORKER_API_TIMEOUT,
-        )
-        token_num = response.json()["count"]
+    client = get_async_client()
+    worker_addr = await _get_worker_address(request.model, client)
+    context_len = await _get_context_length(worker_addr, client)
+
+    response = await client.post(
+        worker_addr + "/count_token",
+        headers=headers,
+        json={"model": request.model, "prompt": request.prompt},
+        timeout=WORKER_API_TIMEOUT,
+    )
+    token_num = response.json()["count"]
 
     can_fit = True
     if token_num + request.max_tokens > context_len:
@@ -334,27 +487,30 @@ async def create_chat_completion(request: ChatCompletionRequest):
         echo=False,
         stream=request.stream,
         stop=request.stop,
+        n=request.n,
+        presence_penalty=request.presence_penalty,
+        frequency_penalty=request.frequency_penalty,
     )
-    error_check_ret = await check_length(
-        request, gen_params["prompt"], gen_params["max_new_tokens"]
-    )
-    if error_check_ret is not None:
-        return error_check_ret
 
     if request.stream:
-        generator = chat_completion_stream_generator(
-            request.model, gen_params, request.n
-        )
+        stream = chat_completion_stream(request.model, gen_params)
+        try:
+            content, frames = await peek_stream(stream)
+        except StopAsyncIteration:
+            return create_error_response(
+                ErrorCode.INTERNAL_ERROR, "The worker returned an empty stream."
+            )
+        if content["error_code"] == ErrorCode.CONTEXT_OVERFLOW:
+            # Close the worker stream, which `frames` only closes once started.
+            await stream.aclose()
+            return create_error_response(content["error_code"], content["text"])
+        generator = chat_completion_stream_generator(request.model, frames, request.n)
         return StreamingResponse(generator, media_type="text/event-stream")
 
     choices = []
-    # TODO: batch the requests. maybe not necessary if using CacheFlow worker
-    chat_completions = []
-    for i in range(request.n):
-        content = asyncio.create_task(chat_completion(request.model, gen_params))
-        chat_completions.append(content)
+    # The worker samples the n completions as one batch.
     try:
-        all_tasks = await asyncio.gather(*chat_completions)
+        all_tasks = await chat_completion(request.model, gen_params)
     except Exception as e:
         return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
     usage = UsageInfo()
@@ -376,7 +532,7 @@ async def create_chat_completion(request: ChatCompletionRequest):
 
 
 async def chat_completion_stream_generator(
-    model_name: str, gen_params: Dict[str, Any], n: int
+    model_name: str, frames: AsyncIterator[Dict[str, Any]], n: int
 ) -> Generator[str, Any, None]:
     """
     Event stream format:
@@ -396,31 +552,30 @@ async def chat_completion_stream_generator(
         )
         yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
 
-        previous_text = ""
-        async for content in chat_completion_stream(model_name, gen_params):
-            if content["error_code"] != 0:
-                yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
-                yield "data: [DONE]\n\n"
-                return
-            decoded_unicode = content["text"].replace("\ufffd", "")
-            delta_text = decoded_unicode[len(previous_text) :]
-            previous_text = decoded_unicode
-
-            if len(delta_text) == 0:
-                delta_text = None
-            choice_data = ChatCompletionResponseStreamChoice(
-                index=i,
-                delta=DeltaMessage(content=delta_text),
-                finish_reason=content.get("finish_reason", None),
-            )
-            chunk = ChatCompletionStreamResponse(
-                id=id, choices=[choice_data], model=model_name
-            )
-            if delta_text is None:
-                if content.get("finish_reason", None) is not None:
-                    finish_stream_events.append(chunk)
-                continue
-            yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
+    # The frames of the n completions are interleaved in one stream.
+    async for content in frames:
+        if content["error_code"] != 0:
+            yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+            return
+        i = content.get("index", 0)
+        delta_text = content["delta"].replace("\ufffd", "")
+
+        if len(delta_text) == 0:
+            delta_text = None
+        choice_data = ChatCompletionResponseStreamChoice(
+            index=i,
+            delta=DeltaMessage(content=delta_text),
+            finish_reason=content.get("finish_reason", None),
+        )
+        chunk = ChatCompletionStreamResponse(
+            id=id, choices=[choice_data], model=model_name
+        )
+        if delta_text is None:
+            if content.get("finish_reason", None) is not None:
+                finish_stream_events.append(chunk)
+            continue
+        yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
     # There is not "content" field in the last delta message, so exclude_none to exclude field "content".
     for finish_chunk in finish_stream_events:
         yield f"data: {finish_chunk.json(exclude_none=True, ensure_ascii=False)}\n\n"
@@ -428,51 +583,51 @@ async def chat_completion_stream_generator(
 
 
 async def chat_completion_stream(model_name: str, gen_params: Dict[str, Any]):
-    controller_url = app_settings.controller_address
-    async with httpx.AsyncClient() as client:
-        worker_addr = await _get_worker_address(model_name, client)
-        delimiter = b"\0"
-        async with client.stream(
-            "POST",
-            worker_addr + "/worker_generate_stream",
-            headers=headers,
-            json=gen_params,
-            timeout=WORKER_API_TIMEOUT,
-        ) as response:
-            # content = await response.aread()
-            async for raw_chunk in response.aiter_raw():
-                for chunk in raw_chunk.split(delimiter):
-                    if not chunk:
-                        continue
-                    data = json.loads(chunk.decode())
-                    yield data
+    client = get_async_client()
+    worker_addr = await _get_worker_address(
+        model_name, client, estimate_num_tokens(gen_params)
+    )
+    decoder = StreamDecoder()
+    async with client.stream(
+        "POST",
+        worker_addr + "/worker_generate_stream",
+        headers=headers,
+        json={**gen_params, **get_stream_protocol_params()},
+        timeout=WORKER_API_TIMEOUT,
+    ) as response:
+        async for raw_chunk in response.aiter_raw():
+            for data in decoder.feed(raw_chunk):
+                yield data
 
 
 async def chat_completion(
     model_name: str, gen_params: Dict[str, Any]
-) -> Optional[Dict[str, Any]]:
-    async with httpx.AsyncClient() as client:
-        worker_addr = await _get_worker_address(model_name, client)
+) -> List[Dict[str, Any]]:
+    """Return the last frame of every completion, or the error frame."""
+    client = get_async_client()
+    worker_addr = await _get_worker_address(
+        model_name, client, estimate_num_tokens(gen_params)
+    )
 
-        output = None
-        delimiter = b"\0"
+    # Dict[index -> last frame]
+    outputs = {}
+    decoder = StreamDecoder()
 
-        async with client.stream(
-            "POST",
-            worker_addr + "/worker_generate_stream",
-            headers=headers,
-            json=gen_params,
-            timeout=WORKER_API_TIMEOUT,
-        ) as response:
-            content = await response.aread()
+    async with client.stream(
+        "POST",
+        worker_addr + "/worker_generate_stream",
+        headers=headers,
+        json={**gen_params, **get_stream_protocol_params()},
+        timeout=WORKER_API_TIMEOUT,
+    ) as response:
+        content = await response.aread()
 
-        for chunk in content.split(delimiter):
-            if not chunk:
-                continue
-            data = json.loads(chunk.decode())
-            output = data
+    for data in decoder.feed(content):
+        if data["error_code"] != 0:
+            return [data]
+        outputs[data.get("index", 0)] = data
 
-        return output
+    return [{**outputs[i], "text": decoder.get_text(i)} for i in sorted(outputs)]
 
 
 @app.post("/v1/completions")
@@ -486,35 +641,59 @@ async def create_completion(request: CompletionRequest):
 
     request.prompt = process_input(request.model, request.prompt)
 
-    for text in request.prompt:
-        error_check_ret = await check_length(request, text, request.max_tokens)
-        if error_check_ret is not None:
-            return error_check_ret
+    payloads = [
+        get_gen_params(
+            request.model,
+            text,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            max_tokens=request.max_tokens,
+            echo=request.echo,
+            stream=request.stream,
+            stop=request.stop,
+            n=request.n,
+            presence_penalty=request.presence_penalty,
+            frequency_penalty=request.frequency_penalty,
+        )
+        for text in request.prompt
+    ]
 
     if request.stream:
-        generator = generate_completion_stream_generator(request, request.n)
+        # The streams of the later prompts only start once they are read.
+        streams = [generate_completion_stream(payload) for payload in payloads]
+        try:
+            content, first_stream = await peek_stream(streams[0])
+        except StopAsyncIteration:
+            for stream in streams:
+                await stream.aclose()
+            return create_error_response(
+                ErrorCode.INTERNAL_ERROR, "The worker returned an empty stream."
+            )
+        if content["error_code"] == ErrorCode.CONTEXT_OVERFLOW:
+            for stream in streams:
+                await stream.aclose()
+            return create_error_response(content["error_code"], content["text"])
+        streams[0] = first_stream
+        generator = generate_completion_stream_generator(
+            request.model, streams, request.n
+        )
         return StreamingResponse(generator, media_type="text/event-stream")
     else:
         text_completions = []
-        for text in request.prompt:
-            payload = get_gen_params(
-                request.model,
-                text,
-                temperature=request.temperature,
-                top_p=request.top_p,
-                max_tokens=request.max_tokens,
-                echo=request.echo,
-                stream=request.stream,
-                stop=request.stop,
-            )
-            for i in range(request.n):
-                content = asyncio.create_task(generate_completion(payload))
-                text_completions.append(content)
+        for payload in payloads:
+            # The worker samples the n completions as one batch.
+            content = asyncio.create_task(generate_completion(payload))
+            text_completions.append(content)
 
         try:
             all_tasks = await asyncio.gather(*text_completions)
         except Exception as e:
             return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
+        all_tasks = [
+            content
+            for completion in all_tasks
+            for content in completion.get("choices", [completion])
+        ]
 
         choices = []
         usage = UsageInfo()
@@ -538,49 +717,37 @@ async def create_completion(request: CompletionRequest):
         )
 
 
-async def generate_completion_stream_generator(request: CompletionRequest, n: int):
-    model_name = request.model
+async def generate_completion_stream_generator(
+    model_name: str, streams: List[AsyncIterator[Dict[str, Any]]], n: int
+):
     id = f"cmpl-{shortuuid.random()}"
     finish_stream_events = []
-    for text in request.prompt:
-        for i in range(n):
-            previous_text = ""
-            payload = get_gen_params(
-                request.model,
-                text,
-                temperature=request.temperature,
-                top_p=request.top_p,
-                max_tokens=request.max_tokens,
-                echo=request.echo,
-                stream=request.stream,
-                stop=request.stop,
+    for frames in streams:
+        async for content in frames:
+            if content["error_code"] != 0:
+                yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
+                yield "data: [DONE]\n\n"
+                return
+            i = content.get("index", 0)
+            delta_text = content["delta"].replace("\ufffd", "")
+            # todo: index is not apparent
+            choice_data = CompletionResponseStreamChoice(
+                index=i,
+                text=delta_text,
+                logprobs=content.get("logprobs", None),
+                finish_reason=content.get("finish_reason", None),
             )
-            async for content in generate_completion_stream(payload):
-                if content["error_code"] != 0:
-                    yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
-                    yield "data: [DONE]\n\n"
-                    return
-                decoded_unicode = content["text"].replace("\ufffd", "")
-                delta_text = decoded_unicode[len(previous_text) :]
-                previous_text = decoded_unicode
-                # todo: index is not apparent
-                choice_data = CompletionResponseStreamChoice(
-                    index=i,
-                    text=delta_text,
-                    logprobs=content.get("logprobs", None),
-                    finish_reason=content.get("finish_reason", None),
-                )
-                chunk = CompletionStreamResponse(
-                    id=id,
-                    object="text_completion",
-                    choices=[choice_data],
-                    model=model_name,
-                )
-                if len(delta_text) == 0:
-                    if content.get("finish_reason", None) is not None:
-                        finish_stream_events.append(chunk)
-                    continue
-                yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
+            chunk = CompletionStreamResponse(
+                id=id,
+                object="text_completion",
+                choices=[choice_data],
+                model=model_name,
+            )
+            if len(delta_text) == 0:
+                if content.get("finish_reason", None) is not None:
+                    finish_stream_events.append(chunk)
+                continue
+            yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
     # There is not "content" field in the last delta message, so exclude_none to exclude field "content".
     for finish_chunk in finish_stream_events:
         yield f"data: {finish_chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
@@ -588,40 +755,38 @@ async def generate_completion_stream_generator(request: CompletionRequest, n: in
 
 
 async def generate_completion_stream(payload: Dict[str, Any]):
-    controller_address = app_settings.controller_address
-    async with httpx.AsyncClient() as client:
-        worker_addr = await _get_worker_address(payload["model"], client)
+    client = get_async_client()
+    worker_addr = await _get_worker_address(
+        payload["model"], client, estimate_num_tokens(payload)
+    )
 
-        delimiter = b"\0"
-        async with client.stream(
-            "POST",
-            worker_addr + "/worker_generate_completion_stream",
-            headers=headers,
-            json=payload,
-            timeout=WORKER_API_TIMEOUT,
-        ) as response:
-            # content = await response.aread()
-            async for raw_chunk in response.aiter_raw():
-                for chunk in raw_chunk.split(delimiter):
-                    if not chunk:
-                        continue
-                    data = json.loads(chunk.decode())
-                    yield data
+    decoder = StreamDecoder()
+    async with client.stream(
+        "POST",
+        worker_addr + "/worker_generate_completion_stream",
+        headers=headers,
+        json={**payload, **get_stream_protocol_params()},
+        timeout=WORKER_API_TIMEOUT,
+    ) as response:
+        async for raw_chunk in response.aiter_raw():
+            for data in decoder.feed(raw_chunk):
+                yield data
 
 
 async def generate_completion(payload: Dict[str, Any]):
-    controller_address = app_settings.controller_address
-    async with httpx.AsyncClient() as client:
-        worker_addr = await _get_worker_address(payload["model"], client)
+    client = get_async_client()
+    worker_addr = await _get_worker_address(
+        payload["model"], client, estimate_num_tokens(payload)
+    )
 
-        response = await client.post(
-            worker_addr + "/worker_generate_completion",
-            headers=headers,
-            json=payload,
-            timeout=WORKER_API_TIMEOUT,
-        )
-        completion = response.json()
-        return completion
+    response = await client.post(
+        worker_addr + "/worker_generate_completion",
+        headers=headers,
+        json=payload,
+        timeout=WORKER_API_TIMEOUT,
+    )
+    completion = response.json()
+    return completion
 
 
 @app.post("/v1/embeddings")
@@ -634,55 +799,148 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
     if error_check_ret is not None:
         return error_check_ret
 
+    if request.encoding_format not in EMBEDDING_ENCODING_FORMATS:
+        return create_error_response(
+            ErrorCode.PARAM_OUT_OF_RANGE,
+            f"{request.encoding_format} is not one of "
+            f"{list(EMBEDDING_ENCODING_FORMATS)} - 'encoding_format'",
+        )
+    if request.embedding_dtype not in EMBEDDING_DTYPES:
+        return create_error_response(
+            ErrorCode.PARAM_OUT_OF_RANGE,
+            f"{request.embedding_dtype} is not one of "
+            f"{list(EMBEDDING_DTYPES)} - 'embedding_dtype'",
+        )
+
     request.input = process_input(request.model, request.input)
 
-    data = []
-    token_num = 0
-    batch_size = WORKER_API_EMBEDDING_BATCH_SIZE
-    batches = [
-        request.input[i : min(i + batch_size, len(request.input))]
-        for i in range(0, len(request.input), batch_size)
-    ]
-    for num_batch, batch in enumerate(batches):
-        payload = {
-            "model": request.model,
-            "input": batch,
-        }
-        embedding = await get_embedding(payload)
-        data += [
-            {
-                "object": "embedding",
-                "embedding": emb,
-                "index": num_batch * batch_size + i,
+    # Only the texts missing from the cache go to the workers and count as
+    # usage. The cache may query sqlite, so it runs off the event loop.
+    if embedding_cache is not None:
+        embeddings = await run_in_threadpool(
+            embedding_cache.get, request.model, request.input
+        )
+    else:
+        embeddings = [None] * len(request.input)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    # The cache keeps float32 embeddings. Without it, the workers can send
+    # the requested dtype right away.
+    if embedding_cache is not None:
+        worker_dtype = "float32"
+    else:
+        worker_dtype = request.embedding_dtype
+    batches = get_embedding_batches(request.input, missing)
+    semaphore = asyncio.Semaphore(WORKER_API_EMBEDDING_MAX_INFLIGHT)
+
+    async def embed_batch(batch, num_tokens):
+        async with semaphore:
+            texts = [request.input[i] for i in batch]
+            payload = {
+                "model": request.model,
+                "input": texts,
+                **get_embedding_protocol_params(worker_dtype),
             }
-            for i, emb in enumerate(embedding["embedding"])
-        ]
+            embedding = await get_embedding(payload, num_tokens)
+            if embedding_cache is not None and "embedding" in embedding:
+                await run_in_threadpool(
+                    embedding_cache.put, request.model, texts, embedding["embedding"]
+                )
+            return embedding
+
+    # Every batch picks its own worker, so the batches in flight spread over
+    # all workers of the model.
+    tasks = [asyncio.create_task(embed_batch(*batch)) for batch in batches]
+    try:
+        for task in asyncio.as_completed(tasks):
+            embedding = await task
+            if "embedding" not in embedding:
+                return create_error_response(embedding["error_code"], embedding["text"])
+    finally:
+        for task in tasks:
+            task.cancel()
+    token_num = 0
+    for (batch, _), task in zip(batches, tasks):
+        embedding = task.result()
+        for i, emb in zip(batch, embedding["embedding"]):
+            embeddings[i] = emb
         token_num += embedding["token_num"]
-    return EmbeddingsResponse(
-        data=data,
-        model=request.model,
-        usage=UsageInfo(
-            prompt_tokens=token_num,
-            total_tokens=token_num,
-            completion_tokens=None,
-        ),
-    ).dict(exclude_none=True)
-
-
-async def get_embedding(payload: Dict[str, Any]):
-    controller_address = app_settings.controller_address
-    model_name = payload["model"]
-    async with httpx.AsyncClient() as client:
-        worker_addr = await _get_worker_address(model_name, client)
+    data = [
+        {
+            "object": "embedding",
+            "embedding": encode_embedding(
+                emb, request.encoding_format, request.embedding_dtype
+            ),
+            "index": i,
+        }
+        for i, emb in enumerate(embeddings)
+    ]
+    # Skip the validation of every float by FastAPI.
+    return JSONResponse(
+        EmbeddingsResponse(
+            data=data,
+            model=request.model,
+            usage=UsageInfo(
+                prompt_tokens=token_num,
+                total_tokens=token_num,
+                completion_tokens=None,
+            ),
+        ).dict(exclude_none=True)
+    )
 
-        response = await client.post(
-            worker_addr + "/worker_get_embeddings",
-            headers=headers,
-            json=payload,
-            timeout=WORKER_API_TIMEOUT,
-        )
-        embedding = response.json()
-        return embedding
+
+def get_embedding_batches(
+    texts: List[str], indices: List[int]
+) -> List[Tuple[List[int], int]]:
+    """Cut the texts at `indices` into batches of similar lengths, each with
+    at most WORKER_API_EMBEDDING_BATCH_TOKENS estimated tokens. Returns the
+    indices and the estimated tokens of every batch."""
+    batches = []
+    batch, batch_tokens = [], 0
+    for i in sorted(indices, key=lambda i: len(texts[i])):
+        num_tokens = len(texts[i]) // CHARS_PER_TOKEN + 1
+        if batch and (
+            batch_tokens + num_tokens > WORKER_API_EMBEDDING_BATCH_TOKENS
+            or len(batch) >= WORKER_API_EMBEDDING_BATCH_SIZE
+        ):
+            batches.append((batch, batch_tokens))
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += num_tokens
+    if batch:
+        batches.append((batch, batch_tokens))
+    return batches
+
+
+def encode_embedding(embedding: np.ndarray, encoding_format: str, dtype: str):
+    embedding = quantize_embeddings(embedding, dtype)
+    if encoding_format == "base64":
+        return base64.b64encode(embedding.tobytes()).decode()
+    return embedding.tolist()
+
+
+@app.get("/v1/embedding_cache")
+async def get_embedding_cache_status():
+    """
+    Returns the hit rate of the embedding cache
+    This is not part of the OpenAI API spec.
+    """
+    if embedding_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **embedding_cache.get_status()}
+
+
+async def get_embedding(payload: Dict[str, Any], num_tokens: int = 0):
+    model_name = payload["model"]
+    client = get_async_client()
+    worker_addr = await _get_worker_address(model_name, client, num_tokens)
+
+    response = await client.post(
+        worker_addr + "/worker_get_embeddings",
+        headers=headers,
+        json=payload,
+        timeout=WORKER_API_TIMEOUT,
+    )
+    return decode_embeddings(response.content)
 
 
 if __name__ == "__main__":
@@ -706,6 +964,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--allowed-headers", type=json.loads, default=["*"], help="allowed headers"
     )
+    add_embedding_cache_args(parser)
     args = parser.parse_args()
 
     app.add_middleware(
@@ -716,6 +975,7 @@ if __name__ == "__main__":
         allow_headers=args.allowed_headers,
     )
     app_settings.controller_address = args.controller_address
+    embedding_cache = create_embedding_cache(args)
 
     logger.info(f"args: {args}")
 
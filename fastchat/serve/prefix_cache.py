@@ -0,0 +1,131 @@
+"""
+A prefix cache that shares the kv cache of common prompt prefixes across requests.
+
+Chat prompts repeat a lot: all conversations of a template start with the
+same system message, and the prompt of turn N+1 starts with the prompt and
+the reply of turn N. The cache keeps the kv cache of full blocks of tokens,
+keyed by a hash of the whole token prefix up to the end of the block, so a
+new request only prefills the tokens after its longest cached prefix.
+
+Blocks live in a dedicated PagedKVCache and are evicted in LRU order once
+the pool is full. Prefixes are also keyed by a namespace, like the LoRA
+adapter of a request, whose kv cache differs for the same tokens.
+"""
+from collections import OrderedDict
+import threading
+from typing import List, Optional, Tuple
+
+from fastchat.serve.kv_cache import PagedKVCache
+
+
+class PrefixCache:
+    """An LRU cache of kv cache blocks keyed by their token prefix."""
+
+    def __init__(self, kv_cache: PagedKVCache):
+        self.kv_cache = kv_cache
+        self.block_size = kv_cache.block_size
+        # OrderedDict[prefix hash -> block], the least recently used first
+        self.cached_blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_hit_tokens = 0
+
+    def _get_prefix_hashes(self, token_ids: List[int], namespace: int) -> List[int]:
+        """Hash every full block together with all the tokens before it."""
+        hashes = []
+        prefix_hash = namespace
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            block = tuple(token_ids[start : start + self.block_size])
+            prefix_hash = hash((prefix_hash, block))
+            hashes.append(prefix_hash)
+        return hashes
+
+    def match(
+        self, token_ids: List[int], namespace: int = 0
+    ) -> Tuple[int, Optional[tuple]]:
+        """Find the longest cached prefix of `token_ids`.
+
+        Returns the number of cached tokens and their kv cache in the Hugging
+        Face format. At least one token is left uncached, so the caller always
+        gets the logits of the last prompt token.
+        """
+        with self.lock:
+            block_table = []
+            hashes = self._get_prefix_hashes(token_ids, namespace)
+            for prefix_hash in hashes:
+                block = self.cached_blocks.get(prefix_hash)
+                if block is None:
+                    break
+                block_table.append(block)
+            # Touch the longer prefixes first, so a prefix is never evicted
+            # before the blocks that extend it.
+            for prefix_hash in reversed(hashes[: len(block_table)]):
+                self.cached_blocks.move_to_end(prefix_hash)
+
+            num_tokens = min(len(block_table) * self.block_size, len(token_ids) - 1)
+            if num_tokens <= 0:
+                self.num_misses += 1
+                return 0, None
+
+            self.num_hits += 1
+            self.num_hit_tokens += num_tokens
+            return num_tokens, self.kv_cache.gather_blocks(block_table, num_tokens)
+
+    def insert(self, token_ids: List[int], past_key_values, namespace: int = 0):
+        """Cache the full blocks of a sequence whose kv cache is `past_key_values`."""
+        num_tokens = min(len(token_ids), past_key_values[0][0].shape[-2])
+        hashes = self._get_prefix_hashes(token_ids[:num_tokens], namespace)
+        allocator = self.kv_cache.allocator
+
+        with self.lock:
+            block_table = []
+            for i, prefix_hash in enumerate(hashes):
+                block = self.cached_blocks.get(prefix_hash)
+                if block is None:
+                    if allocator.get_num_free_blocks() == 0:
+                        if not self.cached_blocks:
+                            break
+                        _, evicted = self.cached_blocks.popitem(last=False)
+                        allocator.free(evicted)
+                    block = allocator.allocate()
+                    block_table.append(block)
+                    self.kv_cache.write_blocks(
+                        block_table,
+                        past_key_values,
+                        i * self.block_size,
+                        (i + 1) * self.block_size,
+                    )
+                    self.cached_blocks[prefix_hash] = block
+                else:
+                    # Keep the blocks of this sequence away from the eviction.
+                    self.cached_blocks.move_to_end(prefix_hash)
+                    block_table.append(block)
+            for prefix_hash in reversed(hashes[: len(block_table)]):
+                self.cached_blocks.move_to_end(prefix_hash)
+
+    def get_status(self):
+        num_requests = self.num_hits + self.num_misses
+        return {
+            "num_hits": self.num_hits,
+            "num_misses": self.num_misses,
+            "hit_rate": self.num_hits / num_requests if num_requests else 0.0,
+            "num_hit_tokens": self.num_hit_tokens,
+            "num_cached_blocks": len(self.cached_blocks),
+            "num_blocks": self.kv_cache.num_blocks,
+        }
+
+
+class PrefixCacheView:
+    """The prefixes of one namespace of a PrefixCache."""
+
+    def __init__(self, prefix_cache: PrefixCache, namespace: int):
+        self.prefix_cache = prefix_cache
+        self.namespace = namespace
+
+    def match(self, token_ids: List[int]) -> Tuple[int, Optional[tuple]]:
+        return self.prefix_cache.match(token_ids, self.namespace)
+
+    def insert(self, token_ids: List[int], past_key_values):
+        self.prefix_cache.insert(token_ids, past_key_values, self.namespace)
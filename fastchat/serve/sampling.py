@@ -0,0 +1,271 @@
+"""
+Batched sampling of the next tokens.
+
+A `SamplingBatch` keeps the sampling parameters and the token counts of every
+sequence of a batch as tensors, so one decode step samples the whole batch
+with a few tensor ops instead of running a `LogitsProcessorList` per
+sequence:
+
+- the repetition, presence and frequency penalties are applied from token
+  counts that are updated in place, instead of gathering `output_ids`;
+- top-k and top-p share a single partial sort of the candidates, instead of
+  a full sort of the vocab for top-p and another pass for top-k.
+"""
+import dataclasses
+from typing import Iterable, List, Optional, Sequence
+
+import torch
+
+# The candidates tried for top-p before falling back to a sort of the vocab
+TOP_P_NUM_CANDIDATES = 256
+
+
+@dataclasses.dataclass
+class SamplingParams:
+    temperature: float = 1.0
+    top_p: float = 1.0
+    top_k: int = -1  # -1 means disable
+    repetition_penalty: float = 1.0
+    presence_penalty: float = 0.0
+    frequency_penalty: float = 0.0
+
+    @classmethod
+    def from_params(cls, params: dict):
+        """Get the sampling parameters of a generation request."""
+        return cls(
+            temperature=float(params.get("temperature", 1.0)),
+            top_p=float(params.get("top_p", 1.0)),
+            top_k=int(params.get("top_k", -1)),
+            repetition_penalty=float(params.get("repetition_penalty", 1.0)),
+            presence_penalty=float(params.get("presence_penalty", None) or 0.0),
+            frequency_penalty=float(params.get("frequency_penalty", None) or 0.0),
+        )
+
+    @property
+    def greedy(self) -> bool:
+        return self.temperature < 1e-5 or self.top_p < 1e-8
+
+
+class SamplingBatch:
+    """The sampling state of a batch of sequences, one row per sequence.
+
+    The rows must follow the order of the batch: callers add rows for new
+    sequences and `select` the rows of the sequences they keep, like they do
+    for the kv cache.
+    """
+
+    def __init__(self, vocab_size: int, device):
+        if torch.device(device).type == "mps":
+            # Switch to CPU by avoiding some bugs in mps backend.
+            device = "cpu"
+        self.vocab_size = vocab_size
+        self.device = device
+        self.params: List[SamplingParams] = []
+        # The number of times each token was generated, [batch, vocab]
+        self.counts = torch.zeros((0, vocab_size), dtype=torch.int32, device=device)
+        # Whether each token is in the prompt, [batch, vocab]
+        self.prompt_mask = torch.zeros((0, vocab_size), dtype=torch.bool, device=device)
+        self._tensors = None
+
+    def __len__(self):
+        return len(self.params)
+
+    def add(self, params: SamplingParams, prompt_ids: List[int], num_rows: int = 1):
+        """Add rows for `num_rows` sequences that continue the same prompt."""
+        prompt_ids = torch.as_tensor(prompt_ids, dtype=torch.long, device=self.device)
+        prompt_mask = torch.zeros(
+            (num_rows, self.vocab_size), dtype=torch.bool, device=self.device
+        )
+        prompt_mask[:, prompt_ids[prompt_ids < self.vocab_size]] = True
+        self.prompt_mask = torch.cat([self.prompt_mask, prompt_mask])
+        self.counts = torch.cat(
+            [
+                self.counts,
+                torch.zeros(
+                    (num_rows, self.vocab_size), dtype=torch.int32, device=self.device
+                ),
+            ]
+        )
+        self.params.extend([params] * num_rows)
+        self._tensors = None
+
+    def select(self, index: Sequence[int]) -> "SamplingBatch":
+        """Get a batch with the given rows, which may repeat."""
+        batch = SamplingBatch(self.vocab_size, self.device)
+        batch.params = [self.params[i] for i in index]
+        index = torch.as_tensor(index, dtype=torch.long, device=self.device)
+        batch.counts = self.counts.index_select(0, index)
+        batch.prompt_mask = self.prompt_mask.index_select(0, index)
+        return batch
+
+    @staticmethod
+    def cat(batches: List["SamplingBatch"]) -> "SamplingBatch":
+        batch = SamplingBatch(batches[0].vocab_size, batches[0].device)
+        batch.params = [p for b in batches for p in b.params]
+        batch.counts = torch.cat([b.counts for b in batches])
+        batch.prompt_mask = torch.cat([b.prompt_mask for b in batches])
+        return batch
+
+    def append_tokens(self, tokens, rows: Optional[Iterable[int]] = None):
+        """Count one generated token for each of `rows`, or for every row."""
+        tokens = torch.as_tensor(tokens, dtype=torch.long, device=self.device)
+        if rows is None:
+            rows = torch.arange(len(self), device=self.device)
+        else:
+            rows = torch.as_tensor(list(rows), dtype=torch.long, device=self.device)
+        valid = tokens < self.vocab_size
+        self.counts.index_put_(
+            (rows[valid], tokens[valid]),
+            torch.ones((), dtype=self.counts.dtype, device=self.device),
+            accumulate=True,
+        )
+
+    @torch.inference_mode()
+    def sample(self, logits: torch.Tensor) -> List[int]:
+        """Sample the next token of every row from `logits` of shape
+        [batch, vocab] and count it."""
+        logits = self._process(logits)
+        tokens = torch.argmax(logits, dim=-1)
+        for rows, filtered in self._get_sampled_rows():
+            probs, indices = self._get_candidates(logits, rows, filtered)
+            choices = torch.multinomial(probs, num_samples=1)
+            if indices is not None:
+                choices = indices.gather(1, choices)
+            tokens[rows] = choices[:, 0]
+        self.append_tokens(tokens)
+        return tokens.tolist()
+
+    @torch.inference_mode()
+    def get_probs(self, logits: torch.Tensor) -> torch.Tensor:
+        """Get the next token distribution of every row, without counting a
+        token. Greedy rows get a one-hot distribution."""
+        logits = self._process(logits)
+        probs = torch.zeros_like(logits)
+        probs.scatter_(1, torch.argmax(logits, dim=-1, keepdim=True), 1.0)
+        for rows, filtered in self._get_sampled_rows():
+            row_probs, indices = self._get_candidates(logits, rows, filtered)
+            row_probs = row_probs / row_probs.sum(dim=-1, keepdim=True)
+            if indices is not None:
+                row_probs = torch.zeros(
+                    (len(rows), logits.shape[-1]), device=logits.device
+                ).scatter_(1, indices, row_probs)
+            probs[rows] = row_probs
+        return probs
+
+    def _get_tensors(self):
+        if self._tensors is not None:
+            return self._tensors
+
+        def to_tensor(values, dtype=torch.float32):
+            return torch.as_tensor(values, dtype=dtype, device=self.device)[:, None]
+
+        params = self.params
+        # Greedy rows skip the temperature, and repetition penalties below 1
+        # and top_p below 1e-8 are ignored, as in `prepare_logits_processor`.
+        temperature = [1.0 if p.greedy else p.temperature for p in params]
+        repetition_penalty = [max(p.repetition_penalty, 1.0) for p in params]
+        top_k = [
+            min(p.top_k, self.vocab_size) if p.top_k > 0 else self.vocab_size
+            for p in params
+        ]
+        top_p = [p.top_p if 1e-8 <= p.top_p < 1.0 else 1.0 for p in params]
+        sampled = [i for i, p in enumerate(params) if not p.greedy]
+        filtered = [i for i in sampled if top_k[i] < self.vocab_size or top_p[i] < 1]
+        unfiltered = [i for i in sampled if i not in filtered]
+        self._tensors = {
+            "temperature": to_tensor(temperature),
+            "repetition_penalty": to_tensor(repetition_penalty),
+            "presence_penalty": to_tensor([p.presence_penalty for p in params]),
+            "frequency_penalty": to_tensor([p.frequency_penalty for p in params]),
+            "top_k": top_k,
+            "top_p": top_p,
+            "top_k_tensor": to_tensor(top_k, torch.long),
+            "top_p_tensor": to_tensor(top_p),
+            "has_temperature": any(t != 1.0 for t in temperature),
+            "has_repetition_penalty": any(r > 1.0 for r in repetition_penalty),
+            "has_count_penalty": any(
+                p.presence_penalty != 0 or p.frequency_penalty != 0 for p in params
+            ),
+            # The sampled rows with and without top-k/top-p
+            "sampled_rows": [
+                (rows, is_filtered)
+                for rows, is_filtered in ((filtered, True), (unfiltered, False))
+                if rows
+            ],
+        }
+        return self._tensors
+
+    def _get_sampled_rows(self):
+        return self._get_tensors()["sampled_rows"]
+
+    def _process(self, logits: torch.Tensor) -> torch.Tensor:
+        """Apply the penalties and the temperature to the logits."""
+        t = self._get_tensors()
+        logits = logits.to(self.device, torch.float32)
+        if t["has_repetition_penalty"]:
+            # The temperature commutes with the repetition penalty, which
+            # keeps the sign of the logits.
+            penalty = t["repetition_penalty"]
+            seen = self.prompt_mask | (self.counts > 0)
+            logits = torch.where(
+                seen,
+                torch.where(logits < 0, logits * penalty, logits / penalty),
+                logits,
+            )
+        if t["has_count_penalty"]:
+            logits = (
+                logits
+                - t["frequency_penalty"] * self.counts
+                - t["presence_penalty"] * (self.counts > 0)
+            )
+        if t["has_temperature"]:
+            logits = logits / t["temperature"]
+        return logits
+
+    def _get_candidates(self, logits, rows: List[int], filtered: bool):
+        """Get the unnormalized probabilities of the candidates of `rows`.
+
+        Returns the probabilities and the token ids of the candidates, or
+        None for the token ids when the candidates are the whole vocab.
+        """
+        t = self._get_tensors()
+        index = torch.as_tensor(rows, device=logits.device)
+        logits = logits.index_select(0, index)
+        if not filtered:
+            return torch.softmax(logits, dim=-1), None
+
+        vocab_size = logits.shape[-1]
+        top_k = [t["top_k"][i] for i in rows]
+        top_p = t["top_p_tensor"].index_select(0, index)
+        log_probs = logits - torch.logsumexp(logits, dim=-1, keepdim=True)
+
+        # Rows with only top-p need an unknown number of candidates, so try
+        # a few first.
+        top_p_only = [
+            j
+            for j, i in enumerate(rows)
+            if top_k[j] == vocab_size and t["top_p"][i] < 1
+        ]
+        num_candidates = max((k for k in top_k if k < vocab_size), default=0)
+        if top_p_only:
+            num_candidates = max(num_candidates, TOP_P_NUM_CANDIDATES)
+        num_candidates = min(num_candidates, vocab_size)
+
+        values, indices = torch.topk(log_probs, num_candidates, dim=-1)
+        probs = values.exp()
+        if top_p_only and num_candidates < vocab_size:
+            mass = probs[top_p_only].sum(dim=-1)
+            if bool((mass < top_p[top_p_only, 0]).any()):
+                values, indices = torch.sort(log_probs, dim=-1, descending=True)
+                probs = values.exp()
+                num_candidates = vocab_size
+
+        # Keep a candidate if the candidates before it have less than top_p
+        # of the mass and it is within top_k. The first one is always kept.
+        exclusive_cumsum = probs.cumsum(dim=-1) - probs
+        ranks = torch.arange(num_candidates, device=logits.device)
+        keep = (exclusive_cumsum < top_p) & (
+            ranks < t["top_k_tensor"].index_select(0, index)
+        )
+        keep[:, 0] = True
+        return probs.masked_fill(~keep, 0.0), indices
@@ -0,0 +1,259 @@
+"""
+Speculative decoding with a small draft model.
+
+The draft model proposes a few tokens one by one and the main model scores
+all of them in a single forward pass. A proposed token x is accepted with
+probability min(1, p(x) / q(x)), where p and q are the next token
+distributions of the main and the draft model, and the first rejected token
+is resampled from max(0, p - q). The output follows the distribution of the
+main model, while the main model runs once for several tokens.
+"""
+import gc
+from typing import List
+
+import torch
+import torch.nn.functional as F
+
+from fastchat.serve.detokenizer import IncrementalDetokenizer, StopStringMatcher
+from fastchat.serve.inference import generate_stream_n
+from fastchat.serve.sampling import SamplingBatch, SamplingParams
+
+
+def _get_cache_len(past_key_values):
+    return 0 if past_key_values is None else past_key_values[0][0].shape[-2]
+
+
+def _truncate_past_key_values(past_key_values, length):
+    return tuple(tuple(t[:, :, :length, :] for t in layer) for layer in past_key_values)
+
+
+def _pad_vocab(p, q):
+    """Pad two distributions to the same vocab size."""
+    vocab_size = max(p.shape[-1], q.shape[-1])
+    return (
+        F.pad(p, (0, vocab_size - p.shape[-1])),
+        F.pad(q, (0, vocab_size - q.shape[-1])),
+    )
+
+
+def _sample(probs):
+    return int(torch.multinomial(probs, num_samples=1))
+
+
+@torch.inference_mode()
+def speculative_generate_stream(
+    model,
+    tokenizer,
+    params,
+    device,
+    context_len=2048,
+    stream_interval=2,
+    draft_model=None,
+    num_speculative_tokens=4,
+    kv_budget=None,
+    prefix_cache=None,
+):
+    """A drop-in replacement of `generate_stream` for decoder-only models.
+
+    The usage of every frame also has the `acceptance_rate` of the draft tokens.
+    """
+    if int(params.get("n", 1)) > 1:
+        # The draft model decodes one sequence, so sample n completions as
+        # a batch of the main model instead.
+        yield from generate_stream_n(
+            model,
+            tokenizer,
+            params,
+            device,
+            context_len,
+            stream_interval,
+            kv_budget,
+            prefix_cache,
+        )
+        return
+
+    prompt = params["prompt"]
+    len_prompt = len(prompt)
+    sampling_params = SamplingParams.from_params(params)
+    max_new_tokens = int(params.get("max_new_tokens", 256))
+    stop_str = params.get("stop", None)
+    echo = bool(params.get("echo", True))
+    stop_token_ids = params.get("stop_token_ids", None) or []
+    stop_token_ids.append(tokenizer.eos_token_id)
+
+    input_ids = tokenizer(prompt).input_ids
+    input_echo_len = len(input_ids)
+    output_ids = list(input_ids)
+
+    max_src_len = context_len - max_new_tokens - 8
+    input_ids = input_ids[-max_src_len:]
+
+    if echo:
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        stop_matcher = StopStringMatcher(stop_str, len_prompt)
+    else:
+        detokenizer = IncrementalDetokenizer(tokenizer, input_echo_len)
+        stop_matcher = StopStringMatcher(stop_str)
+
+    if kv_budget is not None:
+        seq_id = kv_budget.allocate(len(input_ids) + max_new_tokens)
+
+    past_key_values = draft_past_key_values = out = None
+    # The sampling states of the accepted tokens. Greedy decoding uses
+    # one-hot distributions, which turns the acceptance rule into "accept if
+    # the draft token is the argmax of the main model".
+    sampler = draft_sampler = None
+    if prefix_cache is not None:
+        _, past_key_values = prefix_cache.match(input_ids)
+    num_draft_tokens = num_accepted_tokens = 0
+    # The index of the last sampled token
+    i = -1
+    stopped = False
+    output = ""
+
+    def create_sampler(logits):
+        sampler = SamplingBatch(logits.shape[-1], logits.device)
+        sampler.add(sampling_params, output_ids[:input_echo_len])
+        for token in output_ids[input_echo_len:]:
+            sampler.append_tokens([token])
+        return sampler
+
+    def get_usage():
+        return {
+            "prompt_tokens": input_echo_len,
+            "completion_tokens": i,
+            "total_tokens": input_echo_len + i,
+            "acceptance_rate": num_accepted_tokens / num_draft_tokens
+            if num_draft_tokens
+            else 0.0,
+        }
+
+    try:
+        while True:
+            # The tokens seen by the models. The kv caches cover all of them
+            # but the last sampled token.
+            token_ids = input_ids + output_ids[input_echo_len:]
+            num_tokens = min(num_speculative_tokens, max_new_tokens - i - 2)
+
+            # Propose draft tokens
+            draft_ids: List[int] = []
+            draft_probs = []
+            proposal_sampler = None
+            for _ in range(num_tokens):
+                cache_len = _get_cache_len(draft_past_key_values)
+                out = draft_model(
+                    torch.as_tensor(
+                        [(token_ids + draft_ids)[cache_len:]], device=device
+                    ),
+                    use_cache=True,
+                    past_key_values=draft_past_key_values,
+                )
+                draft_past_key_values = out.past_key_values
+                if draft_sampler is None:
+                    draft_sampler = create_sampler(out.logits)
+                if proposal_sampler is None:
+                    proposal_sampler = draft_sampler.select([0])
+                probs = proposal_sampler.get_probs(out.logits[:, -1])[0]
+                draft_ids.append(_sample(probs))
+                draft_probs.append(probs)
+                proposal_sampler.append_tokens(draft_ids[-1:])
+
+            # Score all draft tokens with the main model
+            cache_len = _get_cache_len(past_key_values)
+            out = model(
+                torch.as_tensor([(token_ids + draft_ids)[cache_len:]], device=device),
+                use_cache=True,
+                past_key_values=past_key_values,
+            )
+            past_key_values = out.past_key_values
+            logits = out.logits[0, -(num_tokens + 1) :]
+
+            # The distributions after each draft prefix, as one batch
+            if sampler is None:
+                sampler = create_sampler(logits)
+            scoring_sampler = sampler.select([0] * (num_tokens + 1))
+            for j, token in enumerate(draft_ids):
+                scoring_sampler.append_tokens(
+                    [token] * (num_tokens - j), range(j + 1, num_tokens + 1)
+                )
+            main_probs = scoring_sampler.get_probs(logits)
+
+            new_ids = []
+            for j, token in enumerate(draft_ids):
+                p, q = _pad_vocab(main_probs[j], draft_probs[j])
+                if torch.rand(1, device=p.device) * q[token] < p[token]:
+                    new_ids.append(token)
+                    continue
+                residual = torch.clamp(p - q, min=0)
+                if residual.sum() <= 0:
+                    residual = p
+                new_ids.append(_sample(residual / residual.sum()))
+                break
+            else:
+                new_ids.append(_sample(main_probs[-1]))
+            num_draft_tokens += num_tokens
+            num_accepted_tokens += len(new_ids) - 1
+            for token in new_ids:
+                sampler.append_tokens([token])
+                if draft_sampler is not None:
+                    draft_sampler.append_tokens([token])
+
+            # Drop the kv cache of the rejected tokens
+            num_cached = len(token_ids) + len(new_ids) - 1
+            past_key_values = _truncate_past_key_values(past_key_values, num_cached)
+            if draft_past_key_values is not None:
+                draft_past_key_values = _truncate_past_key_values(
+                    draft_past_key_values,
+                    min(_get_cache_len(draft_past_key_values), num_cached),
+                )
+
+            for token in new_ids:
+                i += 1
+                output_ids.append(token)
+                stopped = token in stop_token_ids
+
+                if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
+                    output, stop_hit, partially_stopped = stop_matcher.match(
+                        detokenizer.decode(output_ids), detokenizer.num_stable_chars
+                    )
+                    stopped = stopped or stop_hit
+
+                    # prevent yielding partial stop sequence
+                    if not partially_stopped:
+                        yield {
+                            "text": output,
+                            "usage": get_usage(),
+                            "finish_reason": None,
+                        }
+
+                if stopped or i == max_new_tokens - 1:
+                    break
+            if stopped or i == max_new_tokens - 1:
+                break
+
+        # finish stream event, which contains finish reason
+        if i == max_new_tokens - 1:
+            finish_reason = "length"
+        elif stopped:
+            finish_reason = "stop"
+        else:
+            finish_reason = None
+
+        yield {
+            "text": output,
+            "usage": get_usage(),
+            "finish_reason": finish_reason,
+        }
+
+        if prefix_cache is not None:
+            prefix_cache.insert(
+                input_ids + output_ids[input_echo_len:], past_key_values
+            )
+    finally:
+        # clean
+        del past_key_values, draft_past_key_values, out
+        if kv_budget is not None:
+            kv_budget.free(seq_id)
+        else:
+            gc.collect()
+            torch.cuda.empty_cache()
@@ -0,0 +1,202 @@
+"""
+The framing of generation streams between workers, the controller and clients.
+
+The legacy format sends every frame as `json.dumps(frame) + b"\\0"` and each
+frame holds the whole text generated so far, so the bytes of a stream grow
+quadratically with the length of the answer.
+
+Clients that pass `stream_protocol` in the request get the delta format:
+
+    header: b"FCST" + version (1 byte) + encoding (1 byte)
+    frame:  payload length (4 bytes, big-endian) + payload
+
+A payload is a msgpack (or JSON, if msgpack is not installed) encoded frame
+whose "text" is replaced by the new text in "delta". A frame only carries
+the whole "text" if it does not extend the previous text of its index,
+e.g. for errors. Workers that do not know the protocol keep answering with
+the legacy format, which `StreamDecoder` detects from the first bytes.
+"""
+import json
+import struct
+from typing import Dict, List, Optional
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+STREAM_PROTOCOL_VERSION = 1
+STREAM_MAGIC = b"FCST"
+STREAM_HEADER_LEN = len(STREAM_MAGIC) + 2
+ENCODING_IDS = {"json": 0, "msgpack": 1}
+DEFAULT_STREAM_ENCODING = "msgpack" if msgpack is not None else "json"
+
+_length_prefix = struct.Struct(">I")
+
+
+def get_stream_protocol_params():
+    """The request params that ask a worker for the delta format."""
+    return {
+        "stream_protocol": STREAM_PROTOCOL_VERSION,
+        "stream_encoding": DEFAULT_STREAM_ENCODING,
+    }
+
+
+def _dumps(frame: dict, encoding: str) -> bytes:
+    if encoding == "msgpack":
+        return msgpack.packb(frame, use_bin_type=True)
+    return json.dumps(frame, ensure_ascii=False).encode()
+
+
+def _loads(payload: bytes, encoding: str) -> dict:
+    if encoding == "msgpack":
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
+
+def encode_json_frame(frame: dict) -> bytes:
+    """Encode a frame in the legacy format."""
+    return json.dumps(frame).encode() + b"\0"
+
+
+class StreamEncoder:
+    """Encode the frames of one stream in the delta format."""
+
+    def __init__(self, encoding: str = DEFAULT_STREAM_ENCODING):
+        if encoding not in ENCODING_IDS or (encoding == "msgpack" and msgpack is None):
+            encoding = "json"
+        self.encoding = encoding
+        self.header = STREAM_MAGIC + bytes(
+            [STREAM_PROTOCOL_VERSION, ENCODING_IDS[encoding]]
+        )
+        self.header_sent = False
+        # Dict[index -> text sent so far]
+        self.texts: Dict[int, str] = {}
+
+    @classmethod
+    def from_header(cls, header: bytes):
+        """Continue a stream whose header was already sent, e.g. to append an
+        error frame. Returns None for a stream in the legacy format."""
+        encoding = get_stream_encoding(header)
+        if encoding is None:
+            return None
+        encoder = cls(encoding)
+        encoder.header_sent = True
+        return encoder
+
+    def encode(self, frame: dict) -> bytes:
+        frame = dict(frame)
+        if "text" in frame and frame.get("error_code", 0) == 0:
+            index = frame.get("index", 0)
+            text = frame.pop("text")
+            previous_text = self.texts.get(index, "")
+            if text.startswith(previous_text):
+                frame["delta"] = text[len(previous_text) :]
+            else:
+                frame["text"] = text
+            self.texts[index] = text
+
+        payload = _dumps(frame, self.encoding)
+        data = _length_prefix.pack(len(payload)) + payload
+        if not self.header_sent:
+            self.header_sent = True
+            data = self.header + data
+        return data
+
+
+def get_stream_encoder(params: dict) -> Optional[StreamEncoder]:
+    """Get the encoder a client asked for, or None for the legacy format."""
+    version = params.get("stream_protocol", None)
+    if version is None or int(version) < STREAM_PROTOCOL_VERSION:
+        return None
+    return StreamEncoder(params.get("stream_encoding", DEFAULT_STREAM_ENCODING))
+
+
+def get_stream_encoding(header: bytes) -> Optional[str]:
+    """Get the encoding of a delta stream from its first bytes, or None for
+    the legacy format."""
+    if not header.startswith(STREAM_MAGIC) or len(header) < STREAM_HEADER_LEN:
+        return None
+    encoding_id = header[len(STREAM_MAGIC) + 1]
+    for encoding, i in ENCODING_IDS.items():
+        if i == encoding_id:
+            return encoding
+    raise ValueError(f"Unknown stream encoding: {encoding_id}")
+
+
+class StreamDecoder:
+    """Decode a stream in either format from chunks of bytes.
+
+    Every decoded frame has the new text of its index in "delta". The whole
+    text of an index is kept as pieces and only joined by `get_text`.
+
+    For a frame with the whole text, the delta is cut after the length of the
+    previous text without replacement characters, which a later frame may
+    turn into the complete character.
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        # None until the format is known
+        self.encoding = None
+        self.legacy = None
+        # Dict[index -> pieces of text]
+        self.texts: Dict[int, List[str]] = {}
+        # Dict[index -> length of text without replacement characters]
+        self.text_lens: Dict[int, int] = {}
+
+    def feed(self, data: bytes) -> List[dict]:
+        self.buffer += data
+        if self.legacy is None:
+            if len(self.buffer) < STREAM_HEADER_LEN and STREAM_MAGIC.startswith(
+                self.buffer[: len(STREAM_MAGIC)]
+            ):
+                return []
+            self.encoding = get_stream_encoding(self.buffer)
+            self.legacy = self.encoding is None
+            if not self.legacy:
+                self.buffer = self.buffer[STREAM_HEADER_LEN:]
+
+        frames = []
+        if self.legacy:
+            *chunks, self.buffer = self.buffer.split(b"\0")
+            for chunk in chunks:
+                if chunk:
+                    frames.append(self._add_frame(json.loads(chunk.decode())))
+            return frames
+
+        offset = 0
+        while len(self.buffer) - offset >= _length_prefix.size:
+            (length,) = _length_prefix.unpack_from(self.buffer, offset)
+            end = offset + _length_prefix.size + length
+            if len(self.buffer) < end:
+                break
+            payload = self.buffer[offset + _length_prefix.size : end]
+            frames.append(self._add_frame(_loads(payload, self.encoding)))
+            offset = end
+        self.buffer = self.buffer[offset:]
+        return frames
+
+    def _add_frame(self, frame: dict) -> dict:
+        if frame.get("error_code", 0) != 0:
+            return frame
+        index = frame.get("index", 0)
+        if "delta" in frame:
+            delta = frame["delta"]
+            self.texts.setdefault(index, []).append(delta)
+            self.text_lens[index] = (
+                self.text_lens.get(index, 0) + len(delta) - delta.count("\ufffd")
+            )
+        elif "text" in frame:
+            text = frame["text"]
+            decoded_text = text.replace("\ufffd", "")
+            frame["delta"] = decoded_text[self.text_lens.get(index, 0) :]
+            self.texts[index] = [text]
+            self.text_lens[index] = len(decoded_text)
+        return frame
+
+    def get_text(self, index: int = 0) -> str:
+        pieces = self.texts.get(index, [])
+        if len(pieces) > 1:
+            self.texts[index] = pieces = ["".join(pieces)]
+        return pieces[0] if pieces else ""
@@ -0,0 +1,169 @@
+"""
+Load signals for token-budget dispatch.
+
+Queue lengths treat a 20-token request like a 2000-token one. Instead,
+workers report the tokens they still have to process (the prompts not yet
+prefilled plus the tokens left to generate), their free kv cache and a
+recent tokens/sec rate. The controller routes a request to the worker that
+would finish its outstanding work first.
+"""
+import dataclasses
+import math
+import threading
+import time
+from typing import Dict, List, Optional
+
+# The time constant of the tokens/sec EWMA, in busy seconds
+TOKENS_PER_SECOND_TIME_CONSTANT = 60.0
+# Dispatchers estimate the prompt length from its characters
+CHARS_PER_TOKEN = 4
+
+
+@dataclasses.dataclass
+class RequestLoad:
+    num_prompt_tokens: int
+    max_new_tokens: int
+    prefilled: bool = False
+    # Dict[index -> number of generated tokens]
+    num_completion_tokens: Dict[int, int] = dataclasses.field(default_factory=dict)
+
+    def get_outstanding_tokens(self) -> int:
+        num_tokens = self.max_new_tokens - sum(self.num_completion_tokens.values())
+        if not self.prefilled:
+            num_tokens += self.num_prompt_tokens
+        return max(num_tokens, 0)
+
+
+class WorkerLoad:
+    """Track the outstanding tokens and the throughput of a worker.
+
+    A request is counted from the moment it is queued until it finishes. The
+    tokens/sec rate only counts the time the worker is busy, so an idle
+    worker keeps its last known speed.
+    """
+
+    def __init__(self, time_constant: float = TOKENS_PER_SECOND_TIME_CONSTANT):
+        self.time_constant = time_constant
+        self.lock = threading.Lock()
+        self.requests: List[RequestLoad] = []
+        self.tokens_per_second: Optional[float] = None
+
+        # The processed tokens and busy time since the last speed update
+        self.num_processed_tokens = 0
+        self.busy_time = 0.0
+        self.busy_since = None
+
+    def start_request(self, num_prompt_tokens: int, max_new_tokens: int):
+        request = RequestLoad(num_prompt_tokens, max_new_tokens)
+        with self.lock:
+            if not self.requests:
+                self.busy_since = time.time()
+            self.requests.append(request)
+        return request
+
+    def update_request(self, request: RequestLoad, output: dict):
+        """Count the tokens processed for a request from a generated frame."""
+        if "usage" not in output:
+            return
+        index = output.get("index", 0)
+        num_completion_tokens = output["usage"].get("completion_tokens", 0)
+        with self.lock:
+            if not request.prefilled:
+                request.prefilled = True
+                self.num_processed_tokens += request.num_prompt_tokens
+            self.num_processed_tokens += num_completion_tokens - (
+                request.num_completion_tokens.get(index, 0)
+            )
+            request.num_completion_tokens[index] = num_completion_tokens
+
+    def finish_request(self, request: RequestLoad):
+        with self.lock:
+            self.requests.remove(request)
+            if not self.requests:
+                self.busy_time += time.time() - self.busy_since
+                self.busy_since = None
+
+    def _update_tokens_per_second(self):
+        now = time.time()
+        busy_time = self.busy_time
+        if self.busy_since is not None:
+            busy_time += now - self.busy_since
+            self.busy_since = now
+        # Too short to measure a rate
+        if busy_time < 1.0:
+            self.busy_time = busy_time
+            return
+
+        rate = self.num_processed_tokens / busy_time
+        if self.tokens_per_second is None:
+            self.tokens_per_second = rate
+        else:
+            alpha = 1 - math.exp(-busy_time / self.time_constant)
+            self.tokens_per_second += alpha * (rate - self.tokens_per_second)
+        self.num_processed_tokens = 0
+        self.busy_time = 0.0
+
+    def get_status(self):
+        with self.lock:
+            self._update_tokens_per_second()
+            return {
+                "outstanding_tokens": sum(
+                    r.get_outstanding_tokens() for r in self.requests
+                ),
+                "tokens_per_second": self.tokens_per_second,
+            }
+
+
+def estimate_num_tokens(params: dict) -> int:
+    """Estimate the tokens of a generation request before tokenizing it."""
+    prompt = params.get("prompt", "")
+    num_prompt_tokens = len(str(prompt)) // CHARS_PER_TOKEN
+    max_new_tokens = int(params.get("max_new_tokens", 256))
+    return num_prompt_tokens + max_new_tokens * int(params.get("n", 1) or 1)
+
+
+def get_token_budget_index(
+    outstanding_tokens: List[int],
+    tokens_per_second: List[Optional[float]],
+    free_kv_tokens: List[Optional[int]],
+    num_tokens: int,
+) -> int:
+    """Pick the worker that would finish its outstanding tokens and a new
+    request of `num_tokens` tokens first.
+
+    Workers without room for the request in their kv cache are only picked
+    if no worker has room. Workers that did not measure their speed yet are
+    assumed to be as fast as the average worker.
+    """
+    known_speeds = [s for s in tokens_per_second if s]
+    default_speed = sum(known_speeds) / len(known_speeds) if known_speeds else 1.0
+
+    indices = list(range(len(outstanding_tokens)))
+    fits = [
+        i
+        for i in indices
+        if free_kv_tokens[i] is None or free_kv_tokens[i] >= num_tokens
+    ]
+    return min(
+        fits or indices,
+        key=lambda i: (outstanding_tokens[i] + num_tokens)
+        / (tokens_per_second[i] or default_speed),
+    )
+
+
+def get_warm_workers(
+    worker_names: List[str],
+    warm_models: List[Optional[List[str]]],
+    model_name: str,
+) -> List[str]:
+    """Keep the workers that have `model_name` on the device, if any.
+
+    Multi-model workers report their warm models, and a worker that reports
+    none has all its models warm.
+    """
+    warm_workers = [
+        w_name
+        for w_name, models in zip(worker_names, warm_models)
+        if models is None or model_name in models
+    ]
+    return warm_workers or worker_names
@@ -0,0 +1,126 @@
+"""Unit tests of the kv cache blocks. They run on CPU without a model.
+
+Usage: python -m pytest tests/test_kv_cache.py
+"""
+import pytest
+import torch
+
+from fastchat.serve.kv_cache import BlockAllocator, KVCacheBudget, PagedKVCache
+
+
+def test_allocator_allocate_and_free():
+    allocator = BlockAllocator(2)
+    a = allocator.allocate()
+    b = allocator.allocate()
+    assert a != b
+    assert allocator.get_num_free_blocks() == 0
+    with pytest.raises(ValueError):
+        allocator.allocate()
+    allocator.free(a)
+    assert allocator.get_num_free_blocks() == 1
+    assert allocator.allocate() == a
+
+
+def test_allocator_ref_counts():
+    allocator = BlockAllocator(1)
+    block = allocator.allocate()
+    allocator.fork(block)
+    assert allocator.ref_counts[block] == 2
+    allocator.free(block)
+    assert allocator.ref_counts[block] == 1
+    assert allocator.get_num_free_blocks() == 0
+    allocator.free(block)
+    assert allocator.ref_counts[block] == 0
+    assert allocator.get_num_free_blocks() == 1
+
+
+def test_budget_allocate():
+    budget = KVCacheBudget(num_blocks=4, block_size=16)
+    seq_id = budget.allocate(17)
+    assert len(budget.block_tables[seq_id]) == 2
+    assert budget.get_num_free_tokens() == 32
+
+    # Growing a sequence only allocates the missing blocks.
+    assert budget.allocate(32, seq_id) == seq_id
+    assert len(budget.block_tables[seq_id]) == 2
+    budget.allocate(33, seq_id)
+    assert len(budget.block_tables[seq_id]) == 3
+
+    assert budget.can_allocate(16)
+    assert not budget.can_allocate(17)
+    with pytest.raises(ValueError):
+        budget.allocate(17)
+    # A failed allocation does not take any block.
+    assert budget.get_num_free_tokens() == 16
+
+
+def test_budget_fork_shares_full_prompt_blocks():
+    budget = KVCacheBudget(num_blocks=8, block_size=4)
+    # A prompt of 10 tokens has 2 full blocks, and 6 new tokens make 4 blocks.
+    parent = budget.allocate(16)
+    child = budget.fork(parent, 16, 10)
+    parent_table = budget.block_tables[parent]
+    child_table = budget.block_tables[child]
+    assert child_table[:2] == parent_table[:2]
+    assert not set(child_table[2:]) & set(parent_table)
+    for block in parent_table[:2]:
+        assert budget.allocator.ref_counts[block] == 2
+    assert budget.allocator.get_num_free_blocks() == 8 - 4 - 2
+
+
+def test_budget_fork_out_of_blocks():
+    budget = KVCacheBudget(num_blocks=3, block_size=4)
+    parent = budget.allocate(8)
+    with pytest.raises(ValueError):
+        budget.fork(parent, 16, 4)
+    assert budget.allocator.get_num_free_blocks() == 1
+    assert budget.allocator.ref_counts[budget.block_tables[parent][0]] == 1
+
+
+def test_budget_free():
+    budget = KVCacheBudget(num_blocks=8, block_size=4)
+    parent = budget.allocate(16)
+    child = budget.fork(parent, 16, 8)
+    shared = budget.block_tables[parent][:2]
+
+    budget.free(parent)
+    assert parent not in budget.block_tables
+    # The shared blocks stay with the child.
+    for block in shared:
+        assert budget.allocator.ref_counts[block] == 1
+    assert budget.allocator.get_num_free_blocks() == 8 - 4
+
+    budget.free(child)
+    assert budget.allocator.get_num_free_blocks() == 8
+    assert all(count == 0 for count in budget.allocator.ref_counts)
+    # Freeing an unknown sequence is a no-op.
+    budget.free(child)
+    assert budget.get_status()["num_free_tokens"] == 32
+
+
+def test_paged_kv_cache_write_and_gather():
+    num_layers, num_heads, head_dim, block_size = 2, 3, 4, 4
+    kv_cache = PagedKVCache(
+        num_layers,
+        num_heads,
+        head_dim,
+        num_blocks=4,
+        block_size=block_size,
+        dtype=torch.float32,
+        device="cpu",
+    )
+    seq_len = 7
+    past_key_values = tuple(
+        (
+            torch.randn(1, num_heads, seq_len, head_dim),
+            torch.randn(1, num_heads, seq_len, head_dim),
+        )
+        for _ in range(num_layers)
+    )
+    # Blocks do not need to be contiguous.
+    block_table = [3, 1]
+    kv_cache.write_blocks(block_table, past_key_values, 0, seq_len)
+    gathered = kv_cache.gather_blocks(block_table, seq_len)
+    for (key, value), (gathered_key, gathered_value) in zip(past_key_values, gathered):
+        assert torch.equal(key, gathered_key)
+        assert torch.equal(value, gathered_value)